@@ -363,6 +363,51 @@ LOGGING = {
                 ),
             ),
         },
+        "renew_payments": {
+            "level": "INFO",
+            "class": "logging.FileHandler",
+            "formatter": "verbose",
+            "filename": settings.get(
+                "RENEW_PAYMENTS_LOG_FILE",
+                fallback=os.path.join(LOG_DIR, "renew_payments.log"),
+            ),
+        },
+        "refresh_expired": {
+            "level": "INFO",
+            "class": "logging.FileHandler",
+            "formatter": "verbose",
+            "filename": settings.get(
+                "REFRESH_EXPIRED_LOG_FILE",
+                fallback=os.path.join(LOG_DIR, "refresh_expired.log"),
+            ),
+        },
+        "rebuild_year_totals": {
+            "level": "INFO",
+            "class": "logging.FileHandler",
+            "formatter": "verbose",
+            "filename": settings.get(
+                "REBUILD_YEAR_TOTALS_LOG_FILE",
+                fallback=os.path.join(LOG_DIR, "rebuild_year_totals.log"),
+            ),
+        },
+        "run_dst_payload_jobs": {
+            "level": "INFO",
+            "class": "logging.FileHandler",
+            "formatter": "verbose",
+            "filename": settings.get(
+                "RUN_DST_PAYLOAD_JOBS_LOG_FILE",
+                fallback=os.path.join(LOG_DIR, "run_dst_payload_jobs.log"),
+            ),
+        },
+        "send_appropriations": {
+            "level": "INFO",
+            "class": "logging.FileHandler",
+            "formatter": "verbose",
+            "filename": settings.get(
+                "SEND_APPROPRIATIONS_LOG_FILE",
+                fallback=os.path.join(LOG_DIR, "send_appropriations.log"),
+            ),
+        },
         "generate_payment_date_exclusions": {
             "level": "INFO",
             "class": "logging.FileHandler",
@@ -469,6 +514,31 @@ LOGGING = {
             "level": "INFO",
             "propagate": True,
         },
+        "bevillingsplatform.renew_payments": {
+            "handlers": ["renew_payments"],
+            "level": "INFO",
+            "propagate": True,
+        },
+        "bevillingsplatform.refresh_expired": {
+            "handlers": ["refresh_expired"],
+            "level": "INFO",
+            "propagate": True,
+        },
+        "bevillingsplatform.rebuild_year_totals": {
+            "handlers": ["rebuild_year_totals"],
+            "level": "INFO",
+            "propagate": True,
+        },
+        "bevillingsplatform.run_dst_payload_jobs": {
+            "handlers": ["run_dst_payload_jobs"],
+            "level": "INFO",
+            "propagate": True,
+        },
+        "bevillingsplatform.send_appropriations": {
+            "handlers": ["send_appropriations"],
+            "level": "INFO",
+            "propagate": True,
+        },
         "bevillingsplatform.generate_payment_date_exclusions": {
             "handlers": ["generate_payment_date_exclusions"],
             "level": "INFO",
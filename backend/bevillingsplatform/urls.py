@@ -73,6 +73,7 @@ router.register(
 )
 router.register(r"efforts", views.EffortViewSet)
 router.register(r"dst_payloads", views.DSTPayloadViewSet)
+router.register(r"dst_payload_jobs", views.DSTPayloadJobViewSet)
 
 urlpatterns = [
     # These are the SAML2 related URLs. You can change
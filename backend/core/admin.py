@@ -52,6 +52,9 @@ from core.models import (
     InternalPaymentRecipient,
     ActivityCategory,
     DSTPayload,
+    DSTPayloadJob,
+    AppropriationDispatch,
+    invalidate_account_resolver,
 )
 from core.proxies import (
     SectionEffortStepProxy,
@@ -825,6 +828,8 @@ class AccountAliasMappingAdmin(ClassificationAdmin):
                 objects = AccountAliasMapping.objects.bulk_create(
                     account_alias_objs
                 )
+                # bulk_create sends no signals.
+                invalidate_account_resolver()
                 self.message_user(
                     request,
                     _(
@@ -862,4 +867,23 @@ class ActivityCategoryAdmin(ClassificationAdmin):
 class DSTPayloadAdmin(ClassificationAdmin):
     """ModelAdmin for DSTPayload."""
 
-    pass
+    list_display = ("name", "dst_type", "date", "size")
+    readonly_fields = ("size", "checksum")
+
+
+@admin.register(DSTPayloadJob)
+class DSTPayloadJobAdmin(ClassificationAdmin):
+    """ModelAdmin for DSTPayloadJob."""
+
+    list_display = ("name", "dst_type", "status", "created", "finished")
+    list_filter = ("status", "dst_type")
+    exclude = ("content",)
+
+
+@admin.register(AppropriationDispatch)
+class AppropriationDispatchAdmin(ClassificationAdmin):
+    """ModelAdmin for AppropriationDispatch."""
+
+    list_display = ("appropriation", "status", "attempts", "created", "sent")
+    list_filter = ("status",)
+    raw_id_fields = ("appropriation", "included_activities")
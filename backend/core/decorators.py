@@ -54,3 +54,30 @@ def log_to_prometheus(job_name):
         return wrapper_log_to_prometheus
 
     return decorator_log_to_prometheus
+
+
+def log_chunk_to_prometheus(job_name, duration, rows):
+    """
+    Log the metrics of a single chunk of a batch job to prometheus.
+
+    for example log_chunk_to_prometheus('renew_payments', 1.5, 500)
+    """
+    if not settings.PUSHGATEWAY_HOST:
+        return
+
+    registry = CollectorRegistry()
+    chunk_duration = Gauge(
+        f"os2bos_{job_name}_chunk_duration_seconds",
+        f"Duration of the last chunk of {job_name}",
+        registry=registry,
+    )
+    chunk_duration.set(duration)
+    chunk_rows = Gauge(
+        f"os2bos_{job_name}_chunk_rows",
+        f"Rows processed in the last chunk of {job_name}",
+        registry=registry,
+    )
+    chunk_rows.set(rows)
+    pushadd_to_gateway(
+        settings.PUSHGATEWAY_HOST, job=f"{job_name}", registry=registry
+    )
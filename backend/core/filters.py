@@ -52,6 +52,8 @@ class CaseFilter(filters.FilterSet):
 class AppropriationFilter(filters.FilterSet):
     """Filter appropriation."""
 
+    expired = filters.BooleanFilter(label=gettext("Udgået"))
+
     main_activity__details__id = filters.NumberFilter(
         label=gettext("Aktivitetsdetalje for hovedaktivitet")
     )
@@ -0,0 +1,160 @@
+# Copyright (C) 2019 Magenta ApS, http://magenta.dk.
+# Contact: info@magenta.dk.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""DataLoaders batching the computed fields of the GraphQL schema.
+
+The loaders are created per request, so nothing is cached across requests.
+"""
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from core.models import (
+    Activity,
+    Payment,
+    PaymentSchedule,
+    MAIN_ACTIVITY,
+    STATUS_GRANTED,
+)
+
+
+def get_loader(info, loader_class, *args):
+    """Return the loader of the given class for the current request."""
+    loaders = getattr(info.context, "dataloaders", None)
+    if loaders is None:
+        loaders = info.context.dataloaders = {}
+    key = (loader_class, *args)
+    if key not in loaders:
+        loaders[key] = loader_class(*args)
+    return loaders[key]
+
+
+class ModelLoader(DataLoader):
+    """Load the objects of a model by primary key."""
+
+    def __init__(self, model):
+        """Set up the loader for the given model."""
+        super().__init__()
+        self.model = model
+
+    def batch_load_fn(self, keys):
+        """Load the objects in one query."""
+        objects = self.model.objects.in_bulk(keys)
+        return Promise.resolve([objects.get(key) for key in keys])
+
+
+def load_related(instance, info, field_name):
+    """Retrieve a foreign key of an instance, loading it if not cached.
+
+    The related objects of all instances in the response are loaded in
+    one query.
+    """
+    field = instance._meta.get_field(field_name)
+    if field.is_cached(instance):
+        return getattr(instance, field_name)
+    related_id = getattr(instance, field.attname)
+    if related_id is None:
+        return None
+    return get_loader(info, ModelLoader, field.related_model).load(related_id)
+
+
+class ActivityTotalsLoader(DataLoader):
+    """Load activities with their yearly totals and total cost annotated."""
+
+    def batch_load_fn(self, keys):
+        """Load the activities in one grouped query."""
+        activities = (
+            Activity.objects.filter(pk__in=keys)
+            .select_related(
+                "service_provider",
+                "payment_plan__price_per_unit",
+                "payment_plan__payment_rate",
+            )
+            .annotate_totals()
+            .in_bulk()
+        )
+        return Promise.resolve([activities.get(key) for key in keys])
+
+
+def load_activity_total(activity, info, name):
+    """Retrieve an annotated total of an activity, loading it if needed.
+
+    Activities which are not fetched with annotate_totals, e.g. as the
+    activity of a payment schedule, have their totals loaded in one
+    grouped query for all of them.
+    """
+    if hasattr(activity, name):
+        return getattr(activity, name)
+    return (
+        get_loader(info, ActivityTotalsLoader)
+        .load(activity.pk)
+        .then(lambda loaded_activity: getattr(loaded_activity, name))
+    )
+
+
+def total_cost_full_year(activity):
+    """Return total_cost_full_year of an activity from ActivityTotalsLoader.
+
+    Individual payments use the annotated total cost rather than querying
+    it again.
+    """
+    payment_plan = getattr(activity, "payment_plan", None)
+    if (
+        payment_plan
+        and payment_plan.payment_type == PaymentSchedule.INDIVIDUAL_PAYMENT
+    ):
+        return activity.annotated_total_cost
+    return activity.total_cost_full_year
+
+
+class MonthlyPaymentPlanLoader(DataLoader):
+    """Load the monthly payment plans of activities."""
+
+    def batch_load_fn(self, keys):
+        """Load the monthly amounts of all the activities in one query."""
+        payment_plans = Payment.objects.filter(
+            payment_schedule__activity__in=keys
+        ).monthly_payment_plans()
+        return Promise.resolve([payment_plans[key] for key in keys])
+
+
+class GrantedDatesLoader(DataLoader):
+    """Load the granted from and to dates of appropriations."""
+
+    def batch_load_fn(self, keys):
+        """Load the granted main activities of the appropriations at once.
+
+        The dates match granted_from_date and granted_to_date.
+        """
+        from_dates = {}
+        to_dates = {}
+        for (
+            appropriation_id,
+            start_date,
+            end_date,
+            modifies_id,
+            modified_by_id,
+        ) in (
+            Activity.objects.filter(
+                appropriation__in=keys,
+                activity_type=MAIN_ACTIVITY,
+                status=STATUS_GRANTED,
+            )
+            .order_by("pk")
+            .values_list(
+                "appropriation_id",
+                "start_date",
+                "end_date",
+                "modifies_id",
+                "modified_by",
+            )
+        ):
+            if modifies_id is None:
+                from_dates.setdefault(appropriation_id, start_date)
+            if modified_by_id is None:
+                to_dates.setdefault(appropriation_id, end_date)
+        return Promise.resolve(
+            [(from_dates.get(key), to_dates.get(key)) for key in keys]
+        )
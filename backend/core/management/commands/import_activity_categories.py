@@ -12,7 +12,13 @@ import csv
 from django.db import transaction
 from django.core.management.base import BaseCommand
 
-from core.models import ActivityDetails, Section, SectionInfo, ActivityCategory
+from core.models import (
+    ActivityDetails,
+    Section,
+    SectionInfo,
+    ActivityCategory,
+    invalidate_account_resolver,
+)
 
 
 class Command(BaseCommand):
@@ -95,3 +101,4 @@ class Command(BaseCommand):
                     name=activity_category_name,
                 )
                 section_infos.update(activity_category=obj)
+                invalidate_account_resolver()
@@ -11,6 +11,7 @@ import logging
 from datetime import datetime
 
 from django.db import transaction
+from django.db.models import Q, Count, Sum
 from django.core.management.base import BaseCommand
 from core.models import Payment, STATUS_GRANTED, SD, CASH, PaymentSchedule
 from core.decorators import log_to_prometheus
@@ -25,6 +26,11 @@ class Command(BaseCommand):
         parser.add_argument(
             "-d", "--date", help=("Mark payments for date"), default=None
         )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report the payments to mark paid without marking them",
+        )
 
     @log_to_prometheus("mark_payments_paid")
     @transaction.atomic
@@ -45,30 +51,49 @@ class Command(BaseCommand):
 
         try:
             # Filter cash payments except for PERSON payments as
-            # those are handled by the PRISM export management command.
-            non_person_cash_payments = Payment.objects.filter(
+            # those are handled by the PRISM export management command,
+            # and SD payments.
+            payments = Payment.objects.filter(
+                (
+                    Q(payment_method=CASH)
+                    & ~Q(recipient_type=PaymentSchedule.PERSON)
+                )
+                | Q(payment_schedule__payment_method=SD),
                 date=date,
-                payment_method=CASH,
                 paid=False,
                 payment_schedule__activity__status=STATUS_GRANTED,
-            ).exclude(recipient_type=PaymentSchedule.PERSON)
+            )
+            payable_payments = payments.payable()
 
-            sd_payments = Payment.objects.filter(
-                date=date,
-                payment_schedule__payment_method=SD,
-                paid=False,
-                payment_schedule__activity__status=STATUS_GRANTED,
+            # Payments with a payment method not allowed for the recipient
+            # can't be marked paid.
+            invalid_payment_ids = list(
+                payments.exclude(
+                    pk__in=payable_payments.values("pk")
+                ).values_list("pk", flat=True)
             )
-            payments = list(non_person_cash_payments) + list(sd_payments)
-            payment_ids = [payment.id for payment in payments]
-            for payment in payments:
-                print(payment)
-                payment.paid = True
-                payment.paid_amount = payment.amount
-                payment.paid_date = date
-                payment.save()
+            if invalid_payment_ids:
+                logger.error(
+                    f"{len(invalid_payment_ids)} payment(s) with ids: "
+                    f"{invalid_payment_ids} can't be marked paid on {date}"
+                )
+
+            if options["dry_run"]:
+                totals = payable_payments.aggregate(
+                    count=Count("pk"), amount=Sum("amount")
+                )
+                message = (
+                    f"Dry run: {totals['count']} payment(s) with a total "
+                    f"amount of {totals['amount'] or 0} would be marked "
+                    f"paid on {date}"
+                )
+                self.stdout.write(message)
+                logger.info(message)
+                return
+
+            payment_ids = payable_payments.mark_paid(date)
             logger.info(
-                f"{len(payments)} payment(s) with ids: "
+                f"{len(payment_ids)} payment(s) with ids: "
                 f"{payment_ids} were marked paid on {date}"
             )
         except Exception:
@@ -0,0 +1,41 @@
+# Copyright (C) 2019 Magenta ApS, http://magenta.dk.
+# Contact: info@magenta.dk.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from core.models import ActivityYearTotal
+from core.decorators import log_to_prometheus
+
+logger = logging.getLogger("bevillingsplatform.rebuild_year_totals")
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the yearly totals of all activities from the payments."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of year totals created per bulk insert",
+        )
+
+    @log_to_prometheus("rebuild_year_totals")
+    def handle(self, *args, **options):
+        """Rebuild the year totals of all activities."""
+        try:
+            created = ActivityYearTotal.objects.rebuild(
+                batch_size=options["batch_size"]
+            )
+            logger.info(f"Success: Rebuilt {created} year total(s).")
+        except Exception:
+            logger.exception(
+                "An exception occurred while rebuilding year totals"
+            )
@@ -7,36 +7,103 @@
 
 
 import logging
+import time
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
-from core.models import Rate, PaymentSchedule, Activity
-from core.decorators import log_to_prometheus
+from core.models import Rate, PaymentSchedule, Activity, JobCheckpoint
+from core.decorators import log_to_prometheus, log_chunk_to_prometheus
 
 logger = logging.getLogger("bevillingsplatform.recalculate_on_changed_rate")
 
+JOB_NAME = "recalculate_on_changed_rate"
+
 
 class Command(BaseCommand):
     help = "Recalculate payments schedules if they use a rate that has changed"
 
-    @log_to_prometheus("recalculate_on_changed_rate")
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of payment schedules recalculated per transaction",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore the checkpoint of an interrupted run",
+        )
+
+    @log_to_prometheus(JOB_NAME)
     def handle(self, *args, **options):
-        """Find rates and corresponding schedules, recalculate."""
+        """Find rates and corresponding schedules, recalculate in chunks."""
+        batch_size = options["batch_size"]
         try:
             logger.info("Start recalculating payment schedules.")
-            rates = Rate.objects.filter(needs_recalculation=True)
-            logger.info("Recalculating rates: {}".format(list(rates)))
+            # The rates are captured up front, so rates flagged during the
+            # run are left for the next run.
+            rate_ids = list(
+                Rate.objects.filter(needs_recalculation=True)
+                .order_by("id")
+                .values_list("id", flat=True)
+            )
+            logger.info(f"Recalculating rates: {rate_ids}")
             payment_schedules = PaymentSchedule.objects.filter(
                 payment_cost_type=PaymentSchedule.GLOBAL_RATE_PRICE,
-                payment_rate__in=rates,
+                payment_rate__in=rate_ids,
                 activity__in=Activity.objects.ongoing(),
+            ).order_by("id")
+
+            if options["restart"]:
+                JobCheckpoint.objects.filter(name=JOB_NAME).delete()
+            checkpoint, created = JobCheckpoint.objects.get_or_create(
+                name=JOB_NAME, defaults={"scope": rate_ids}
             )
-            for payment_schedule in payment_schedules:
-                payment_schedule.recalculate_prices()
+            if not created and checkpoint.scope == rate_ids:
                 logger.info(
-                    f"Recalculated payment schedule: {payment_schedule}"
+                    f"Resuming after payment schedule {checkpoint.last_id}."
                 )
-            rates.update(needs_recalculation=False)
+            elif not created:
+                # Schedules of newly flagged rates may precede the
+                # checkpoint, so resuming could skip them.
+                logger.info("The rates have changed, restarting.")
+                checkpoint.last_id = 0
+                checkpoint.scope = rate_ids
+                checkpoint.save()
+
+            while True:
+                ids = list(
+                    payment_schedules.filter(
+                        id__gt=checkpoint.last_id
+                    ).values_list("id", flat=True)[:batch_size]
+                )
+                if not ids:
+                    break
+
+                started = time.monotonic()
+                with transaction.atomic():
+                    summary = PaymentSchedule.objects.filter(
+                        id__in=ids
+                    ).recalculate_prices()
+                    checkpoint.last_id = ids[-1]
+                    checkpoint.save()
+                duration = time.monotonic() - started
+
+                log_chunk_to_prometheus(
+                    JOB_NAME, duration, summary["payments"]
+                )
+                logger.info(
+                    f"Recalculated {summary['payments']} payments on "
+                    f"{len(ids)} payment schedules up to "
+                    f"{checkpoint.last_id} in {duration:.2f} seconds."
+                )
+
+            Rate.objects.filter(id__in=rate_ids).update(
+                needs_recalculation=False
+            )
+            checkpoint.delete()
             logger.info("Success: Done recalculating payment schedules.")
         except Exception:
             logger.exception(
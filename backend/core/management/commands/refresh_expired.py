@@ -0,0 +1,38 @@
+# Copyright (C) 2019 Magenta ApS, http://magenta.dk.
+# Contact: info@magenta.dk.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import Appropriation, Case
+from core.decorators import log_to_prometheus
+
+logger = logging.getLogger("bevillingsplatform.refresh_expired")
+
+
+class Command(BaseCommand):
+    help = (
+        "Refreshes the stored expiry of cases and appropriations "
+        "whose activities have expired since the last run."
+    )
+
+    @log_to_prometheus("refresh_expired")
+    def handle(self, *args, **options):
+        """Refresh the expired field of appropriations and cases."""
+        try:
+            with transaction.atomic():
+                appropriations = Appropriation.objects.refresh_expired()
+                cases = Case.objects.refresh_expired()
+            logger.info(
+                f"Success: Refreshed {appropriations} appropriation(s) "
+                f"and {cases} case(s)."
+            )
+        except Exception:
+            logger.exception("An exception occurred while refreshing expiry")
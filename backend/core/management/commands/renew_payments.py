@@ -6,26 +6,82 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 from django.core.management.base import BaseCommand
+from django.db import connections, transaction
 
 from core.models import PaymentSchedule
 from core.decorators import log_to_prometheus
 
+logger = logging.getLogger("bevillingsplatform.renew_payments")
+
+
+def renew_payment_schedules(schedule_ids, batch_size):
+    """Renew the payments of the given payment schedules in a transaction."""
+    with transaction.atomic():
+        return PaymentSchedule.objects.filter(
+            pk__in=schedule_ids
+        ).renew_payments(batch_size=batch_size)
+
 
 class Command(BaseCommand):
     help = "Renews payments for an unbounded Activity"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of payments created per bulk insert",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes renewing payment schedules",
+        )
+
     @log_to_prometheus("renew_payments")
     def handle(self, *args, **options):
-        # Find recurring unbounded payment schedules
-        # which has an associated Activity.
-        recurring_schedules = PaymentSchedule.objects.filter(
-            activity__isnull=False, activity__end_date__isnull=True
-        ).exclude(payment_type=PaymentSchedule.ONE_TIME_PAYMENT)
-
-        for schedule in recurring_schedules:
-            activity = schedule.activity
-            vat_factor = activity.vat_factor
-            schedule.synchronize_payments(
-                activity.start_date, activity.end_date, vat_factor
+        """Renew the payments of the schedules needing renewal."""
+        batch_size = options["batch_size"]
+        workers = options["workers"]
+        try:
+            # Find recurring unbounded payment schedules
+            # which has an associated Activity and needs renewal.
+            schedule_ids = list(
+                PaymentSchedule.objects.needing_renewal()
+                .order_by("pk")
+                .values_list("pk", flat=True)
+            )
+            logger.info(
+                f"Renewing payments for {len(schedule_ids)} "
+                f"payment schedule(s)."
             )
+            if workers > 1 and len(schedule_ids) > 1:
+                # One chunk per worker. The workers must open their own
+                # database connections.
+                chunks = [
+                    schedule_ids[i::workers]
+                    for i in range(min(workers, len(schedule_ids)))
+                ]
+                connections.close_all()
+                with ProcessPoolExecutor(
+                    max_workers=len(chunks),
+                    mp_context=multiprocessing.get_context("fork"),
+                ) as executor:
+                    created = sum(
+                        executor.map(
+                            renew_payment_schedules,
+                            chunks,
+                            [batch_size] * len(chunks),
+                        )
+                    )
+            else:
+                created = renew_payment_schedules(schedule_ids, batch_size)
+            logger.info(f"Success: Created {created} payment(s).")
+        except Exception:
+            logger.exception("An exception occurred while renewing payments")
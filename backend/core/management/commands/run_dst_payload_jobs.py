@@ -0,0 +1,61 @@
+# Copyright (C) 2019 Magenta ApS, http://magenta.dk.
+# Contact: info@magenta.dk.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import logging
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import DSTPayloadJob
+from core.decorators import log_to_prometheus
+
+logger = logging.getLogger("bevillingsplatform.run_dst_payload_jobs")
+
+
+class Command(BaseCommand):
+    help = "Generates the DST payloads queued through the REST API."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--timeout",
+            type=int,
+            default=60,
+            help=(
+                "Minutes without a heartbeat after which a running job is "
+                "considered stopped"
+            ),
+        )
+
+    @log_to_prometheus("run_dst_payload_jobs")
+    def handle(self, *args, **options):
+        """Run queued jobs until there are none left."""
+        try:
+            stale = DSTPayloadJob.objects.fail_stale(
+                timezone.now() - timedelta(minutes=options["timeout"])
+            )
+            if stale:
+                logger.info(f"Failed {stale} stopped job(s).")
+
+            done = failed = 0
+            job = DSTPayloadJob.objects.claim_next()
+            while job is not None:
+                try:
+                    job.run()
+                    done += 1
+                    logger.info(f"Generated {job.name} for job {job.pk}.")
+                except Exception as e:
+                    failed += 1
+                    logger.exception(
+                        f"An exception occurred while running job {job.pk}"
+                    )
+                    job.fail(str(e))
+                job = DSTPayloadJob.objects.claim_next()
+            logger.info(f"Success: Ran {done} job(s), {failed} failed.")
+        except Exception:
+            logger.exception("An exception occurred while running jobs")
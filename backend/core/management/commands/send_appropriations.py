@@ -0,0 +1,119 @@
+# Copyright (C) 2019 Magenta ApS, http://magenta.dk.
+# Contact: info@magenta.dk.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from core.models import AppropriationDispatch
+from core.decorators import log_to_prometheus
+
+logger = logging.getLogger("bevillingsplatform.send_appropriations")
+
+
+def render_dispatch(dispatch_id):
+    """Render the files of the dispatch with the given id."""
+    return AppropriationDispatch.objects.get(pk=dispatch_id).render()
+
+
+class Command(BaseCommand):
+    help = "Sends granted appropriations to SBSYS."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes rendering appropriations",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of dispatches claimed at a time",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=int,
+            default=60,
+            help="Minutes after which a running dispatch is considered "
+            "stopped",
+        )
+
+    def render_dispatches(self, dispatches, workers):
+        """Yield each dispatch with its rendered files or an exception."""
+        if workers > 1 and len(dispatches) > 1:
+            # The workers must open their own database connections.
+            connections.close_all()
+            with ProcessPoolExecutor(
+                max_workers=min(workers, len(dispatches)),
+                mp_context=multiprocessing.get_context("fork"),
+            ) as executor:
+                futures = [
+                    executor.submit(render_dispatch, dispatch.pk)
+                    for dispatch in dispatches
+                ]
+                for dispatch, future in zip(dispatches, futures):
+                    try:
+                        yield dispatch, future.result(), None
+                    except Exception as e:
+                        yield dispatch, None, e
+        else:
+            for dispatch in dispatches:
+                try:
+                    yield dispatch, dispatch.render(), None
+                except Exception as e:
+                    yield dispatch, None, e
+
+    @log_to_prometheus("send_appropriations")
+    def handle(self, *args, **options):
+        """Send the dispatches due until there are none left."""
+        workers = options["workers"]
+        batch_size = options["batch_size"]
+        try:
+            stale = AppropriationDispatch.objects.requeue_stale(
+                timezone.now() - timedelta(minutes=options["timeout"])
+            )
+            if stale:
+                logger.info(f"Queued {stale} stopped dispatch(es) again.")
+
+            sent = failed = 0
+            dispatches = AppropriationDispatch.objects.claim_due(batch_size)
+            while dispatches:
+                for dispatch, attachments, error in self.render_dispatches(
+                    dispatches, workers
+                ):
+                    try:
+                        if error is not None:
+                            raise error
+                        dispatch.send(attachments)
+                        sent += 1
+                        logger.info(
+                            f"Sent appropriation {dispatch.appropriation_id} "
+                            f"for dispatch {dispatch.pk}."
+                        )
+                    except Exception as e:
+                        failed += 1
+                        logger.exception(
+                            f"An exception occurred while sending "
+                            f"dispatch {dispatch.pk}"
+                        )
+                        dispatch.fail(str(e))
+                dispatches = AppropriationDispatch.objects.claim_due(
+                    batch_size
+                )
+            logger.info(f"Success: Sent {sent} dispatch(es), {failed} failed.")
+        except Exception:
+            logger.exception(
+                "An exception occurred while sending appropriations"
+            )
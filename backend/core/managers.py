@@ -6,9 +6,12 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """Custom query set managers."""
 import datetime
+from collections import defaultdict
+
+from dateutil.relativedelta import relativedelta
 
 from django.utils import timezone
-from django.db import models
+from django.db import models, connection, transaction
 from django.db.models import (
     Case,
     When,
@@ -16,11 +19,14 @@ from django.db.models import (
     CharField,
     DecimalField,
     IntegerField,
+    DateField,
     Func,
     Value,
     Q,
     F,
     Count,
+    Max,
+    Exists,
     OuterRef,
     Subquery,
 )
@@ -31,9 +37,15 @@ from django.db.models.functions import (
     ExtractMonth,
     ExtractYear,
     LPad,
+    TruncMonth,
 )
 from django.contrib.postgres.aggregates import ArrayAgg
 
+from simple_history.utils import (
+    bulk_create_with_history,
+    bulk_update_with_history,
+)
+
 
 class PaymentQuerySet(models.QuerySet):
     """Handle payments properly - some are paid and others are not.
@@ -56,6 +68,143 @@ class PaymentQuerySet(models.QuerySet):
         output_field=DecimalField(),
     )
 
+    def payable(self):
+        """Filter payments which may be marked paid.
+
+        This checks in SQL what Payment.save validates for paid payments -
+        the payment method must be allowed for the recipient and the
+        activity must be granted.
+        """
+        from core.models import PaymentSchedule, STATUS_GRANTED
+
+        allowed = Q()
+        for (
+            recipient_type,
+            payment_methods,
+        ) in PaymentSchedule.allowed_payment_methods.items():
+            allowed |= Q(
+                recipient_type=recipient_type,
+                payment_method__in=payment_methods,
+            )
+        return self.filter(
+            allowed, payment_schedule__activity__status=STATUS_GRANTED
+        )
+
+    def mark_paid(self, paid_date):
+        """Mark the payable of these payments paid on the given date.
+
+        The paid amount is the amount, and the account string and alias
+        are saved just like when saving a paid payment. All payments are
+        updated in one statement and their history created in another.
+        Return the ids of the payments marked paid.
+        """
+        from core.models import (
+            Activity,
+            Payment,
+            PaymentSchedule,
+            refresh_year_totals,
+            resolve_accounts,
+        )
+
+        rows = list(
+            self.payable().values_list(
+                "pk",
+                "amount",
+                "recipient_type",
+                "payment_method",
+                "saved_account_string",
+                "saved_account_alias",
+                "payment_schedule__activity_id",
+            )
+        )
+        if not rows:
+            return []
+
+        accounts = resolve_accounts(
+            Activity.objects.filter(
+                pk__in={row[-1] for row in rows}
+            ).select_related("appropriation")
+        )
+        account_settings = PaymentSchedule.get_account_settings()
+        payments = []
+        for (
+            pk,
+            amount,
+            recipient_type,
+            payment_method,
+            saved_account_string,
+            saved_account_alias,
+            activity_id,
+        ) in rows:
+            account_info = accounts[activity_id]
+            payments.append(
+                Payment(
+                    pk=pk,
+                    paid=True,
+                    paid_amount=amount,
+                    paid_date=paid_date,
+                    saved_account_string=saved_account_string
+                    or PaymentSchedule.format_account_string(
+                        recipient_type,
+                        payment_method,
+                        account_info.account_number,
+                        account_settings,
+                    ),
+                    saved_account_alias=saved_account_alias
+                    or account_info.account_alias
+                    or "",
+                )
+            )
+        bulk_update_with_history(
+            payments,
+            Payment,
+            [
+                "paid",
+                "paid_amount",
+                "paid_date",
+                "saved_account_string",
+                "saved_account_alias",
+            ],
+        )
+        refresh_year_totals({row[-1] for row in rows})
+        return [payment.pk for payment in payments]
+
+    def applicable(self):
+        """Exclude payments overruled by expected activities.
+
+        On a granted activity, the payments from the earliest payment date
+        of the activities modifying it on are overruled - one time payments
+        entirely.
+        """
+        from core.models import Payment, PaymentSchedule, STATUS_GRANTED
+
+        overruled_from_date = (
+            Payment.objects.filter(
+                payment_schedule__activity__modified_activities__activity=(
+                    OuterRef("payment_schedule__activity")
+                )
+            )
+            .order_by("date")
+            .values("date")[:1]
+        )
+        return self.annotate(
+            overruled_from_date=Subquery(overruled_from_date)
+        ).exclude(
+            Q(payment_schedule__activity__status=STATUS_GRANTED)
+            & (
+                Q(
+                    payment_schedule__payment_type=(
+                        PaymentSchedule.ONE_TIME_PAYMENT
+                    ),
+                    payment_schedule__activity__modified_by__isnull=False,
+                )
+                | Q(
+                    overruled_from_date__isnull=False,
+                    date__gte=F("overruled_from_date"),
+                )
+            )
+        )
+
     def annotate_paid_date_or_date(self):
         """Annotate all payments with paid date or payment date."""
         return self.annotate(paid_date_or_date=self.paid_date_or_date_case)
@@ -137,9 +286,129 @@ class PaymentQuerySet(models.QuerySet):
             .annotate(amount=Sum(self.amount_case))
         )
 
+    def monthly_amounts_by_activity(self):
+        """Sum the amounts by activity and month in one grouped query.
+
+        Return a dict from (activity id, first day of month) to amount,
+        ordered by activity and month. The months are truncated dates
+        rather than strings built in SQL.
+        """
+        rows = (
+            self.annotate(
+                month=TruncMonth(
+                    self.paid_date_or_date_case, output_field=DateField()
+                )
+            )
+            .values_list("payment_schedule__activity", "month")
+            .order_by("payment_schedule__activity", "month")
+            .annotate(amount=Sum(self.amount_case))
+        )
+        return {
+            (activity_id, month): amount for activity_id, month, amount in rows
+        }
+
+    def monthly_payment_plans(self):
+        """Return the monthly payment plans of the payments' activities.
+
+        The plans are keyed by activity id and look like the output of
+        group_by_monthly_amounts.
+        """
+        payment_plans = defaultdict(list)
+        amounts = self.monthly_amounts_by_activity()
+        for (activity_id, month), amount in amounts.items():
+            payment_plans[activity_id].append(
+                {"date_month": month.strftime("%Y-%m"), "amount": amount}
+            )
+        return payment_plans
+
+    def year_totals(self):
+        """Build the year totals of the activities of these payments.
+
+        The totals are summed in one grouped query by activity and the
+        year of the paid date or payment date, like in_year. The granted
+        sum only includes the payments of granted activities, the expected
+        sum only the applicable payments and the paid sum only paid ones.
+        Return the unsaved ActivityYearTotal objects.
+        """
+        from core.models import (
+            ActivityYearTotal,
+            Payment,
+            PaymentSchedule,
+            STATUS_GRANTED,
+        )
+
+        overruled_from_date = Subquery(
+            Payment.objects.filter(
+                payment_schedule__activity__modified_activities__activity=(
+                    OuterRef("payment_schedule__activity")
+                )
+            )
+            .order_by("date")
+            .values("date")[:1]
+        )
+        # Payments on a granted activity overruled by the activities
+        # modifying it, just like in applicable().
+        overruled = Q(payment_schedule__activity__status=STATUS_GRANTED) & (
+            Q(
+                payment_schedule__payment_type=(
+                    PaymentSchedule.ONE_TIME_PAYMENT
+                ),
+                payment_schedule__activity__modified_by__isnull=False,
+            )
+            | Q(
+                overruled_from_date__isnull=False,
+                date__gte=F("overruled_from_date"),
+            )
+        )
+        rows = (
+            self.filter(payment_schedule__activity__isnull=False)
+            .annotate(
+                overruled_from_date=overruled_from_date,
+                year=ExtractYear(self.paid_date_or_date_case),
+            )
+            .values_list("payment_schedule__activity", "year")
+            .order_by("payment_schedule__activity", "year")
+            .annotate(
+                granted_sum=Coalesce(
+                    Sum(
+                        self.amount_case,
+                        filter=Q(
+                            payment_schedule__activity__status=STATUS_GRANTED
+                        ),
+                    ),
+                    0,
+                    output_field=DecimalField(),
+                ),
+                expected_sum=Coalesce(
+                    Sum(self.amount_case, filter=~overruled),
+                    0,
+                    output_field=DecimalField(),
+                ),
+                paid_sum=Coalesce(
+                    Sum("paid_amount", filter=Q(paid=True)),
+                    0,
+                    output_field=DecimalField(),
+                ),
+            )
+        )
+        return [
+            ActivityYearTotal(
+                activity_id=activity_id,
+                year=year,
+                granted_sum=granted_sum,
+                expected_sum=expected_sum,
+                paid_sum=paid_sum,
+            )
+            for activity_id, year, granted_sum, expected_sum, paid_sum in rows
+        ]
+
     def expected_payments_for_report_list(self):
-        """Filter payments for a report of granted AND expected payments."""
-        from core.models import STATUS_GRANTED, STATUS_EXPECTED, Activity
+        """Filter payments for a report of granted AND expected payments.
+
+        Overruled payments are excluded in SQL, so the result can be
+        streamed with iterator().
+        """
+        from core.models import STATUS_GRANTED, STATUS_EXPECTED
 
         current_year = timezone.now().year
         two_years_ago = current_year - 2
@@ -147,16 +416,14 @@ class PaymentQuerySet(models.QuerySet):
             year=two_years_ago
         )
 
-        expected_activities = Activity.objects.filter(
-            Q(status=STATUS_GRANTED) | Q(status=STATUS_EXPECTED)
-        )
-        payment_ids = [
-            payment.id
-            for activity in expected_activities
-            for payment in activity.applicable_payments
-        ]
         return (
-            self.filter(id__in=payment_ids)
+            self.filter(
+                payment_schedule__activity__status__in=[
+                    STATUS_GRANTED,
+                    STATUS_EXPECTED,
+                ]
+            )
+            .applicable()
             .paid_date_or_date_gte(beginning_of_two_years_ago)
             .select_related(
                 "payment_schedule__activity__appropriation__case",
@@ -167,7 +434,7 @@ class PaymentQuerySet(models.QuerySet):
 
     def granted_payments_for_report_list(self):
         """Filter payments for a report of only granted payments."""
-        from core.models import STATUS_GRANTED, Activity
+        from core.models import STATUS_GRANTED
 
         current_year = timezone.now().year
         two_years_ago = current_year - 2
@@ -175,13 +442,8 @@ class PaymentQuerySet(models.QuerySet):
             year=two_years_ago
         )
 
-        granted_activities = Activity.objects.filter(status=STATUS_GRANTED)
-        payment_ids = granted_activities.values_list(
-            "payment_plan__payments__pk", flat=True
-        )
-
         return (
-            self.filter(id__in=payment_ids)
+            self.filter(payment_schedule__activity__status=STATUS_GRANTED)
             .paid_date_or_date_gte(beginning_of_two_years_ago)
             .select_related(
                 "payment_schedule__activity__appropriation__case",
@@ -191,6 +453,166 @@ class PaymentQuerySet(models.QuerySet):
         )
 
 
+class PaymentScheduleQuerySet(models.QuerySet):
+    """QuerySet and Manager for the PaymentSchedule model."""
+
+    # Recalculate unpaid payments from the schedules' rate periods in a
+    # single statement. The rate in effect on a payment date is the period
+    # with the latest start date covering it, just like the rate timeline.
+    # Payments of individual payment schedules are left alone.
+    RECALCULATE_PRICES_SQL = """
+        WITH new_amounts AS (
+            SELECT DISTINCT ON (payment.id)
+                payment.id AS id,
+                ROUND(
+                    CASE schedule.payment_cost_type
+                        WHEN %s THEN schedule.payment_amount
+                        ELSE COALESCE(schedule.payment_units, 0)
+                            * COALESCE(period.rate, 0)
+                    END / 100 * COALESCE(provider.vat_factor, 100),
+                    2
+                ) AS amount
+            FROM core_payment payment
+            JOIN core_paymentschedule schedule
+                ON schedule.id = payment.payment_schedule_id
+            JOIN core_activity activity
+                ON activity.id = schedule.activity_id
+            LEFT JOIN core_serviceprovider provider
+                ON provider.id = activity.service_provider_id
+            LEFT JOIN core_price price
+                ON price.payment_schedule_id = schedule.id
+            LEFT JOIN core_rateperdate period
+                ON period.main_rate_id = CASE schedule.payment_cost_type
+                    WHEN %s THEN schedule.payment_rate_id
+                    WHEN %s THEN price.variablerate_ptr_id
+                END
+                AND (period.start_date IS NULL
+                     OR period.start_date <= payment.date)
+                AND (period.end_date IS NULL
+                     OR payment.date < period.end_date)
+            WHERE payment.paid_amount IS NULL
+                AND schedule.payment_type <> %s
+                AND schedule.payment_cost_type IN (%s, %s, %s)
+                AND schedule.id IN ({schedules})
+            ORDER BY payment.id, period.start_date DESC NULLS LAST
+        )
+        UPDATE core_payment
+        SET amount = new_amounts.amount
+        FROM new_amounts
+        WHERE core_payment.id = new_amounts.id
+            AND core_payment.amount <> new_amounts.amount
+        RETURNING core_payment.id, core_payment.payment_schedule_id
+    """
+
+    def needing_renewal(self, horizon=None):
+        """Filter running schedules of open ended activities to renew.
+
+        These are the schedules whose newest payment is before the horizon,
+        six months from today by default. The date of the newest payment
+        is annotated as newest_payment_date.
+        """
+        from core.models import PaymentSchedule
+
+        if horizon is None:
+            horizon = datetime.date.today() + relativedelta(months=6)
+
+        return (
+            self.filter(
+                activity__isnull=False, activity__end_date__isnull=True
+            )
+            .exclude(
+                payment_type__in=[
+                    PaymentSchedule.ONE_TIME_PAYMENT,
+                    PaymentSchedule.INDIVIDUAL_PAYMENT,
+                ]
+            )
+            .annotate(newest_payment_date=Max("payments__date"))
+            .filter(newest_payment_date__lt=horizon)
+        )
+
+    def renew_payments(self, batch_size=1000):
+        """Generate the next period of payments for schedules to renew.
+
+        The payments of all the schedules are created in batches of bulk
+        inserts. Return the number of payments created.
+        """
+        from core.models import Payment, refresh_year_totals
+
+        schedules = self.needing_renewal().select_related(
+            "activity__service_provider", "price_per_unit", "payment_rate"
+        )
+        created = 0
+        payments = []
+        activity_ids = set()
+        for schedule in schedules.iterator(chunk_size=batch_size):
+            activity_ids.add(schedule.activity_id)
+            # The renewal starts at the next payment date after the newest.
+            _, new_start = schedule.create_rrule(
+                schedule.newest_payment_date, count=2
+            )
+            payments.extend(
+                schedule.build_payments(
+                    new_start.date(), None, schedule.activity.vat_factor
+                )
+            )
+            if len(payments) >= batch_size:
+                bulk_create_with_history(
+                    payments, Payment, batch_size=batch_size
+                )
+                created += len(payments)
+                payments = []
+        if payments:
+            bulk_create_with_history(payments, Payment, batch_size=batch_size)
+            created += len(payments)
+        refresh_year_totals(activity_ids)
+        return created
+
+    def recalculate_prices(self):
+        """Recalculate the amounts of all unpaid payments in one UPDATE.
+
+        Only payments whose amount actually changes are written. The amount
+        is excluded from the payment history, so no history records are
+        created for the changes.
+
+        The amounts of individual payment schedules are entered by hand and
+        are not recalculated.
+
+        Returns the number of updated payments and payment schedules.
+        """
+        from core.models import Activity, PaymentSchedule, refresh_year_totals
+
+        schedules_sql, schedules_params = (
+            self.order_by().values("id").query.sql_with_params()
+        )
+        params = (
+            PaymentSchedule.FIXED_PRICE,
+            PaymentSchedule.GLOBAL_RATE_PRICE,
+            PaymentSchedule.PER_UNIT_PRICE,
+            PaymentSchedule.INDIVIDUAL_PAYMENT,
+            PaymentSchedule.FIXED_PRICE,
+            PaymentSchedule.PER_UNIT_PRICE,
+            PaymentSchedule.GLOBAL_RATE_PRICE,
+            *schedules_params,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self.RECALCULATE_PRICES_SQL.format(schedules=schedules_sql),
+                params,
+            )
+            rows = cursor.fetchall()
+
+        if rows:
+            refresh_year_totals(
+                Activity.objects.filter(
+                    payment_plan__in={schedule_id for _, schedule_id in rows}
+                ).values_list("pk", flat=True)
+            )
+        return {
+            "payments": len(rows),
+            "payment_schedules": len({schedule_id for _, schedule_id in rows}),
+        }
+
+
 class ActivityQuerySet(models.QuerySet):
     """QuerySet and Manager for the Activity model."""
 
@@ -206,17 +628,123 @@ class ActivityQuerySet(models.QuerySet):
         today = timezone.now().date()
         return self.filter(end_date__lt=today)
 
+    def annotate_totals(self):
+        """Annotate yearly granted and expected totals and the total cost.
+
+        The totals granted and expected for the previous, the current and
+        the next year and the total cost are summed from the stored year
+        totals in one grouped query. They match total_granted_in_year,
+        total_expected_in_year and total_cost, the latter being annotated
+        as annotated_total_cost.
+        """
+        year = timezone.now().year
+        totals = {}
+        for name, total_year in [
+            ("previous_year", year - 1),
+            ("this_year", year),
+            ("next_year", year + 1),
+        ]:
+            in_year = Q(year_totals__year=total_year)
+            totals[f"total_granted_{name}"] = Coalesce(
+                Sum("year_totals__granted_sum", filter=in_year),
+                0,
+                output_field=DecimalField(),
+            )
+            totals[f"total_expected_{name}"] = Coalesce(
+                Sum("year_totals__expected_sum", filter=in_year),
+                0,
+                output_field=DecimalField(),
+            )
+        totals["annotated_total_cost"] = Coalesce(
+            Sum("year_totals__expected_sum"), 0, output_field=DecimalField()
+        )
+        return self.annotate(**totals)
+
+
+class ActivityYearTotalQuerySet(models.QuerySet):
+    """QuerySet and Manager for the ActivityYearTotal model."""
+
+    def sum(self, field):
+        """Sum one of the totals over these year totals."""
+        return self.aggregate(
+            total=Coalesce(Sum(field), 0, output_field=DecimalField())
+        )["total"]
+
+    def refresh(self, activity_ids):
+        """Recompute the year totals of the given activities.
+
+        The activities they modify are refreshed too, as the expected
+        totals of those depend on the payments of the activities modifying
+        them. Return the number of year totals stored.
+        """
+        from core.models import Activity, ActivityModification, Payment
+
+        activity_ids = set(activity_ids)
+        activity_ids.discard(None)
+        if not activity_ids:
+            return 0
+        activity_ids |= set(
+            ActivityModification.objects.filter(
+                modified_by__in=activity_ids
+            ).values_list("activity_id", flat=True)
+        )
+        with transaction.atomic():
+            # Lock the activities, so concurrent refreshes of their year
+            # totals are serialized.
+            activity_ids = list(
+                Activity.objects.select_for_update()
+                .filter(pk__in=activity_ids)
+                .order_by("pk")
+                .values_list("pk", flat=True)
+            )
+            year_totals = Payment.objects.filter(
+                payment_schedule__activity__in=activity_ids
+            ).year_totals()
+            self.filter(activity__in=activity_ids).delete()
+            return len(self.bulk_create(year_totals))
+
+    def rebuild(self, batch_size=1000):
+        """Recompute the year totals of all activities from scratch.
+
+        Return the number of year totals stored.
+        """
+        from core.models import Payment
+
+        year_totals = Payment.objects.year_totals()
+        with transaction.atomic():
+            self.all().delete()
+            return len(self.bulk_create(year_totals, batch_size=batch_size))
+
+
+def sbsys_common_expression():
+    """Return the 'common sbsys_id' of an Appropriation as an expression.
+
+    The 'common sbsys_id' is the sbsys_id without any suffix, e.g.
+    '27.24.36-G01-7-20-Far' -> '27.24.36-G01-7-20', or NULL.
+    """
+    return Func(
+        F("sbsys_id"),
+        Value("(\\d{2}\\.\\d{2}\\.\\d{2}-\\D\\d{2}-\\d+-\\d+)?.*"),
+        function="substring",
+    )
+
 
 class AppropriationQuerySet(models.QuerySet):
     """QuerySet and Manager for the Appropriation model."""
 
     def ongoing(self):
         """Only include ongoing, i.e. non-expired Appropriations."""
-        expired_ids = self.expired().values_list("id", flat=True)
-        return self.exclude(id__in=expired_ids)
+        return self.filter(expired=False)
 
     def expired(self):
         """Only include expired Appropriations."""
+        return self.filter(expired=True)
+
+    def calculated_expired(self):
+        """Only include Appropriations expired according to the activities.
+
+        This is what the stored expired field is refreshed from.
+        """
         from core.models import MAIN_ACTIVITY
 
         today = timezone.now().date()
@@ -241,6 +769,47 @@ class AppropriationQuerySet(models.QuerySet):
             .filter(expired_main_activities_count=F("main_activities_count"))
         ).distinct()
 
+    def refresh_expired(self):
+        """Store whether the Appropriations are expired.
+
+        Only the Appropriations whose expiry has changed are updated.
+        Return the number of updated Appropriations.
+        """
+        expired_ids = self.calculated_expired().values("id")
+        return self.filter(expired=False, id__in=expired_ids).update(
+            expired=True
+        ) + self.filter(expired=True).exclude(id__in=expired_ids).update(
+            expired=False
+        )
+
+    def refresh_status(self):
+        """Store the status of the Appropriations from their activities.
+
+        Only the Appropriations whose status has changed are updated.
+        Return the number of updated Appropriations.
+        """
+        from core.models import (
+            Activity,
+            STATUS_DRAFT,
+            STATUS_EXPECTED,
+            STATUS_GRANTED,
+        )
+
+        activities = Activity.objects.filter(appropriation=OuterRef("pk"))
+        status = Case(
+            When(
+                Exists(activities.filter(status=STATUS_EXPECTED)),
+                then=Value(STATUS_EXPECTED),
+            ),
+            When(
+                Exists(activities.filter(status=STATUS_GRANTED)),
+                then=Value(STATUS_GRANTED),
+            ),
+            default=Value(STATUS_DRAFT),
+            output_field=CharField(),
+        )
+        return self.exclude(status=status).update(status=status)
+
     def annotate_main_activity_details_id(self):
         """Annotate the main_activity__details__id as a subquery."""
         from core.models import Activity, MAIN_ACTIVITY
@@ -450,13 +1019,7 @@ class AppropriationQuerySet(models.QuerySet):
         ]
         """
         return (
-            self.annotate(
-                sbsys_common=Func(
-                    F("sbsys_id"),
-                    Value("(\\d{2}\\.\\d{2}\\.\\d{2}-\\D\\d{2}-\\d+-\\d+)?.*"),
-                    function="substring",
-                )
-            )
+            self.annotate(sbsys_common=sbsys_common_expression())
             .exclude(sbsys_common=None)
             .values("sbsys_common")
             .annotate(ids=ArrayAgg("id", distinct=True))
@@ -471,17 +1034,75 @@ class AppropriationQuerySet(models.QuerySet):
             .filter(id_count__gt=1)
         )
 
+    def annotate_dst_payload_details(self):
+        """Annotate the details of a Danmarks Statistik payload.
+
+        This is the dates and payment plan of the main activity, the
+        granted from and to dates, the cpr number of the first mother or
+        father of the case and the 'common sbsys_id', so a payload can be
+        generated without querying each appropriation.
+        """
+        from core.models import (
+            Activity,
+            RelatedPerson,
+            MAIN_ACTIVITY,
+            STATUS_GRANTED,
+        )
+
+        main_activities = Activity.objects.filter(
+            appropriation=OuterRef("pk"), activity_type=MAIN_ACTIVITY
+        ).order_by("pk")
+        main_activity = main_activities.filter(modifies__isnull=True)
+        first_granted_activity = main_activity.filter(status=STATUS_GRANTED)
+        last_granted_activity = main_activities.filter(
+            modified_by__isnull=True, status=STATUS_GRANTED
+        )
+        father_or_mother = RelatedPerson.objects.filter(
+            main_case=OuterRef("case"), relation_type__in=["mor", "far"]
+        ).order_by("pk")
+
+        return self.annotate(
+            main_activity_start_date=Subquery(
+                main_activity.values("start_date")[:1]
+            ),
+            main_activity_end_date=Subquery(
+                main_activity.values("end_date")[:1]
+            ),
+            main_activity_payment_type=Subquery(
+                main_activity.values("payment_plan__payment_type")[:1]
+            ),
+            main_activity_payment_date=Subquery(
+                main_activity.values("payment_plan__payment_date")[:1]
+            ),
+            annotated_granted_from_date=Subquery(
+                first_granted_activity.values("start_date")[:1]
+            ),
+            annotated_granted_to_date=Subquery(
+                last_granted_activity.values("end_date")[:1]
+            ),
+            father_or_mother_cpr_number=Subquery(
+                father_or_mother.values("cpr_number")[:1]
+            ),
+            sbsys_common=sbsys_common_expression(),
+        )
+
 
 class CaseQuerySet(models.QuerySet):
     """Distinguish between expired and ongoing cases."""
 
     def ongoing(self):
         """Only include ongoing, i.e. non-expired Cases."""
-        expired_ids = self.expired().values_list("id", flat=True)
-        return self.exclude(id__in=expired_ids)
+        return self.filter(expired=False)
 
     def expired(self):
         """Only include expired Cases."""
+        return self.filter(expired=True)
+
+    def calculated_expired(self):
+        """Only include Cases expired according to their activities.
+
+        This is what the stored expired field is refreshed from.
+        """
         from core.models import MAIN_ACTIVITY
 
         today = timezone.now().date()
@@ -510,6 +1131,19 @@ class CaseQuerySet(models.QuerySet):
             .filter(expired_main_activities_count=F("main_activities_count"))
         ).distinct()
 
+    def refresh_expired(self):
+        """Store whether the Cases are expired.
+
+        Only the Cases whose expiry has changed are updated.
+        Return the number of updated Cases.
+        """
+        expired_ids = self.calculated_expired().values("id")
+        return self.filter(expired=False, id__in=expired_ids).update(
+            expired=True
+        ) + self.filter(expired=True).exclude(id__in=expired_ids).update(
+            expired=False
+        )
+
     def expected_cases_for_report_list(self):
         """Filter cases for a report of granted AND expected cases."""
         from core.models import STATUS_GRANTED, STATUS_EXPECTED
@@ -522,32 +1156,145 @@ class CaseQuerySet(models.QuerySet):
         return cases
 
     def filter_changed_cases_for_dst_payload(self, from_date, to_date=None):
-        """Filter changed cases for a DST payload."""
-        changed_case_ids = []
-
-        for case in self:
-            try:
-                from_case = case.history.as_of(from_date)
-            except case.DoesNotExist:
-                from_case = case.history.earliest()
-
-            if to_date:
-                try:
-                    to_case = case.history.as_of(to_date)
-                except case.DoesNotExist:
-                    to_case = case
-            else:
-                to_case = case
-
-            # If acting municipality has changed we include it as changed.
-            if (
-                hasattr(from_case, "acting_municipality")
-                and from_case.acting_municipality
-                and hasattr(to_case, "acting_municipality")
-                and to_case.acting_municipality
-                and not from_case.acting_municipality
-                == to_case.acting_municipality
-            ):
-                changed_case_ids.append(case.id)
-
-        return self.filter(id__in=changed_case_ids)
+        """Filter changed cases for a DST payload.
+
+        A case has changed if its acting municipality as of from_date
+        differs from the one as of to_date, or the current one if no
+        to_date is given. Cases created after from_date are compared from
+        their first historical record. This is done in one query over the
+        case history rather than looking up the history of each case.
+        """
+        from core.models import Case as CaseModel
+
+        history = CaseModel.history.filter(id=OuterRef("pk"))
+
+        def as_of(date):
+            # The latest historical record of a case at the date, like
+            # history.as_of() - except that records of deleted cases are
+            # returned rather than raising DoesNotExist.
+            return history.filter(history_date__lte=date).order_by(
+                "-history_date", "-history_id"
+            )[:1]
+
+        def acting_municipality_as_of(date, history_type, default):
+            # The subqueries select the municipality id of a historical
+            # record while the default may be the foreign key of the case,
+            # so the output field must be given.
+            return Case(
+                When(
+                    **{f"{history_type}__in": ["+", "~"]},
+                    then=Subquery(as_of(date).values("acting_municipality")),
+                ),
+                default=default,
+                output_field=models.BigIntegerField(),
+            )
+
+        earliest = history.order_by("history_date", "history_id")[:1]
+        cases = self.annotate(
+            from_history_type=Subquery(as_of(from_date).values("history_type"))
+        ).annotate(
+            from_acting_municipality=acting_municipality_as_of(
+                from_date,
+                "from_history_type",
+                Subquery(earliest.values("acting_municipality")),
+            )
+        )
+        if to_date:
+            cases = cases.annotate(
+                to_history_type=Subquery(as_of(to_date).values("history_type"))
+            ).annotate(
+                to_acting_municipality=acting_municipality_as_of(
+                    to_date, "to_history_type", F("acting_municipality")
+                )
+            )
+        else:
+            cases = cases.annotate(
+                to_acting_municipality=F("acting_municipality")
+            )
+
+        # If acting municipality has changed we include it as changed.
+        return cases.filter(
+            from_acting_municipality__isnull=False,
+            to_acting_municipality__isnull=False,
+        ).exclude(from_acting_municipality=F("to_acting_municipality"))
+
+
+class DSTPayloadJobQuerySet(models.QuerySet):
+    """QuerySet and Manager for the DSTPayloadJob model."""
+
+    def claim_next(self):
+        """Mark the oldest queued job running and return it, if any.
+
+        Jobs locked by another worker are skipped, so several workers can
+        run jobs at the same time.
+        """
+        from core.models import JOB_QUEUED, JOB_RUNNING
+
+        with transaction.atomic():
+            job = (
+                self.filter(status=JOB_QUEUED)
+                .select_for_update(skip_locked=True)
+                .order_by("created", "pk")
+                .first()
+            )
+            if job is not None:
+                job.status = JOB_RUNNING
+                job.started = job.heartbeat = timezone.now()
+                job.save(update_fields=["status", "started", "heartbeat"])
+        return job
+
+    def fail_stale(self, beat_before):
+        """Mark running jobs without a heartbeat since a time as failed.
+
+        Such jobs were left behind by a worker that stopped.
+        Return the number of failed jobs.
+        """
+        from core.models import JOB_RUNNING, JOB_FAILED
+
+        return self.filter(
+            status=JOB_RUNNING, heartbeat__lt=beat_before
+        ).update(
+            status=JOB_FAILED,
+            finished=timezone.now(),
+            error="Jobbet blev afbrudt",
+        )
+
+
+class AppropriationDispatchQuerySet(models.QuerySet):
+    """QuerySet and Manager for the AppropriationDispatch model."""
+
+    def claim_due(self, limit):
+        """Mark up to limit dispatches due to be sent running and return them.
+
+        Dispatches locked by another worker are skipped.
+        """
+        from core.models import JOB_QUEUED, JOB_RUNNING
+
+        with transaction.atomic():
+            dispatches = list(
+                self.filter(
+                    status=JOB_QUEUED, next_attempt__lte=timezone.now()
+                )
+                .select_for_update(skip_locked=True)
+                .order_by("next_attempt", "pk")[:limit]
+            )
+            started = timezone.now()
+            self.filter(
+                pk__in=[dispatch.pk for dispatch in dispatches]
+            ).update(status=JOB_RUNNING, started=started)
+            for dispatch in dispatches:
+                dispatch.status = JOB_RUNNING
+                dispatch.started = started
+        return dispatches
+
+    def requeue_stale(self, started_before):
+        """Queue dispatches still running since before the given time again.
+
+        Such dispatches were left behind by a worker that stopped.
+        Return the number of queued dispatches.
+        """
+        from core.models import JOB_QUEUED, JOB_RUNNING
+
+        return self.filter(
+            status=JOB_RUNNING, started__lt=started_before
+        ).update(status=JOB_QUEUED, next_attempt=timezone.now())
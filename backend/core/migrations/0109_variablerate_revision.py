@@ -0,0 +1,18 @@
+# Generated by Django 3.2.12 on 2026-10-17 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0108_auto_20220217_0820'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='variablerate',
+            name='revision',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='revision'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.12 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0109_variablerate_revision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128, unique=True, verbose_name='navn')),
+                ('last_id', models.PositiveBigIntegerField(default=0, verbose_name='sidst behandlede id')),
+                ('modified', models.DateTimeField(auto_now=True, verbose_name='sidst ændret')),
+            ],
+            options={
+                'verbose_name': 'jobstatus',
+                'verbose_name_plural': 'jobstatusser',
+            },
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 3.2.12 on 2026-10-17 11:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_activity_modifications(apps, schema_editor):
+    Activity = apps.get_model("core", "Activity")
+    ActivityModification = apps.get_model("core", "ActivityModification")
+
+    modifies = dict(
+        Activity.objects.filter(modifies__isnull=False).values_list(
+            "id", "modifies_id"
+        )
+    )
+    modifications = []
+    for activity_id in modifies:
+        ancestor_id = modifies[activity_id]
+        depth = 1
+        while ancestor_id is not None:
+            modifications.append(
+                ActivityModification(
+                    activity_id=ancestor_id,
+                    modified_by_id=activity_id,
+                    depth=depth,
+                )
+            )
+            ancestor_id = modifies.get(ancestor_id)
+            depth += 1
+    ActivityModification.objects.bulk_create(modifications, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0110_jobcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityModification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField(verbose_name='dybde')),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='modifications', to='core.activity', verbose_name='aktivitet')),
+                ('modified_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='modified_activities', to='core.activity', verbose_name='justeres af aktivitet')),
+            ],
+            options={
+                'verbose_name': 'justering',
+                'verbose_name_plural': 'justeringer',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='activitymodification',
+            constraint=models.UniqueConstraint(fields=('activity', 'modified_by'), name='unique_activity_modified_by'),
+        ),
+        migrations.RunPython(
+            populate_activity_modifications, migrations.RunPython.noop
+        ),
+    ]
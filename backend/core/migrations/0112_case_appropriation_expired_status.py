@@ -0,0 +1,96 @@
+# Generated by Django 3.2.12 on 2026-10-17 12:00
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def populate_expired_and_status(apps, schema_editor):
+    Activity = apps.get_model("core", "Activity")
+    Appropriation = apps.get_model("core", "Appropriation")
+    Case = apps.get_model("core", "Case")
+
+    today = timezone.now().date()
+    appropriation_statuses = defaultdict(set)
+    appropriation_end_dates = defaultdict(list)
+    case_end_dates = defaultdict(list)
+    for (
+        appropriation_id,
+        case_id,
+        status,
+        activity_type,
+        end_date,
+    ) in Activity.objects.values_list(
+        "appropriation_id",
+        "appropriation__case_id",
+        "status",
+        "activity_type",
+        "end_date",
+    ).iterator():
+        appropriation_statuses[appropriation_id].add(status)
+        if activity_type == "MAIN_ACTIVITY":
+            appropriation_end_dates[appropriation_id].append(end_date)
+            case_end_dates[case_id].append(end_date)
+
+    def is_expired(end_dates):
+        return all(end_date and end_date < today for end_date in end_dates)
+
+    def calculate_status(statuses):
+        if "EXPECTED" in statuses:
+            return "EXPECTED"
+        if "GRANTED" in statuses:
+            return "GRANTED"
+        return "DRAFT"
+
+    appropriations_by_status = defaultdict(list)
+    for appropriation_id, statuses in appropriation_statuses.items():
+        appropriations_by_status[calculate_status(statuses)].append(
+            appropriation_id
+        )
+    for status, appropriation_ids in appropriations_by_status.items():
+        Appropriation.objects.filter(id__in=appropriation_ids).update(
+            status=status
+        )
+    Appropriation.objects.filter(
+        id__in=[
+            appropriation_id
+            for appropriation_id, end_dates in appropriation_end_dates.items()
+            if is_expired(end_dates)
+        ]
+    ).update(expired=True)
+    Case.objects.filter(
+        id__in=[
+            case_id
+            for case_id, end_dates in case_end_dates.items()
+            if is_expired(end_dates)
+        ]
+    ).update(expired=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0111_activitymodification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appropriation',
+            name='expired',
+            field=models.BooleanField(db_index=True, default=False, editable=False, verbose_name='udgået'),
+        ),
+        migrations.AddField(
+            model_name='appropriation',
+            name='status',
+            field=models.CharField(choices=[('DRAFT', 'kladde'), ('EXPECTED', 'forventet'), ('GRANTED', 'bevilget')], db_index=True, default='DRAFT', editable=False, max_length=128, verbose_name='status'),
+        ),
+        migrations.AddField(
+            model_name='case',
+            name='expired',
+            field=models.BooleanField(db_index=True, default=False, editable=False, verbose_name='udgået'),
+        ),
+        migrations.RunPython(
+            populate_expired_and_status, migrations.RunPython.noop
+        ),
+    ]
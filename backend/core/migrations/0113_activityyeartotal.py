@@ -0,0 +1,129 @@
+# Generated by Django 3.2.12 on 2026-10-17 14:00
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_year_totals(apps, schema_editor):
+    Activity = apps.get_model("core", "Activity")
+    ActivityModification = apps.get_model("core", "ActivityModification")
+    ActivityYearTotal = apps.get_model("core", "ActivityYearTotal")
+    Payment = apps.get_model("core", "Payment")
+
+    activities = {
+        pk: (status, payment_type)
+        for pk, status, payment_type in Activity.objects.values_list(
+            "pk", "status", "payment_plan__payment_type"
+        ).iterator()
+    }
+    modified_ids = set(
+        Activity.objects.filter(modifies__isnull=False).values_list(
+            "modifies_id", flat=True
+        )
+    )
+    # The earliest payment date of the activities modifying an activity.
+    first_dates = {}
+    for activity_id, date in Payment.objects.values_list(
+        "payment_schedule__activity_id", "date"
+    ).iterator():
+        if activity_id is not None and (
+            activity_id not in first_dates or date < first_dates[activity_id]
+        ):
+            first_dates[activity_id] = date
+    overruled_from_dates = {}
+    for activity_id, modified_by_id in ActivityModification.objects.values_list(
+        "activity_id", "modified_by_id"
+    ).iterator():
+        date = first_dates.get(modified_by_id)
+        if date is not None and (
+            activity_id not in overruled_from_dates
+            or date < overruled_from_dates[activity_id]
+        ):
+            overruled_from_dates[activity_id] = date
+
+    totals = defaultdict(lambda: [Decimal(0), Decimal(0), Decimal(0)])
+    for (
+        activity_id,
+        date,
+        amount,
+        paid,
+        paid_date,
+        paid_amount,
+    ) in Payment.objects.filter(
+        payment_schedule__activity__isnull=False
+    ).values_list(
+        "payment_schedule__activity_id",
+        "date",
+        "amount",
+        "paid",
+        "paid_date",
+        "paid_amount",
+    ).iterator():
+        status, payment_type = activities[activity_id]
+        year = (paid_date or date).year
+        amount = paid_amount if paid_amount is not None else amount
+        overruled_from_date = overruled_from_dates.get(activity_id)
+        overruled = status == "GRANTED" and (
+            (payment_type == "ONE_TIME_PAYMENT" and activity_id in modified_ids)
+            or (overruled_from_date is not None and date >= overruled_from_date)
+        )
+        total = totals[(activity_id, year)]
+        if status == "GRANTED":
+            total[0] += amount
+        if not overruled:
+            total[1] += amount
+        if paid and paid_amount is not None:
+            total[2] += paid_amount
+
+    ActivityYearTotal.objects.bulk_create(
+        [
+            ActivityYearTotal(
+                activity_id=activity_id,
+                year=year,
+                granted_sum=granted_sum,
+                expected_sum=expected_sum,
+                paid_sum=paid_sum,
+            )
+            for (activity_id, year), (
+                granted_sum,
+                expected_sum,
+                paid_sum,
+            ) in totals.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0112_case_appropriation_expired_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityYearTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveIntegerField(verbose_name='år')),
+                ('granted_sum', models.DecimalField(decimal_places=2, max_digits=14, verbose_name='bevilget beløb')),
+                ('expected_sum', models.DecimalField(decimal_places=2, max_digits=14, verbose_name='forventet beløb')),
+                ('paid_sum', models.DecimalField(decimal_places=2, max_digits=14, verbose_name='betalt beløb')),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='year_totals', to='core.activity', verbose_name='aktivitet')),
+            ],
+            options={
+                'verbose_name': 'årstotal',
+                'verbose_name_plural': 'årstotaler',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='activityyeartotal',
+            constraint=models.UniqueConstraint(fields=('activity', 'year'), name='unique_activity_year'),
+        ),
+        migrations.RunPython(
+            populate_year_totals, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.12 on 2026-10-17 15:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0113_activityyeartotal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DSTPayloadJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dst_type', models.CharField(choices=[('PREVENTATIVE_MEASURES', 'forebyggende foranstaltninger'), ('HANDICAP', 'handicap')], max_length=128, verbose_name='type')),
+                ('from_date', models.DateField(blank=True, null=True, verbose_name='fra dato (skæringsdato)')),
+                ('to_date', models.DateField(blank=True, null=True, verbose_name='til dato (skæringsdato)')),
+                ('test', models.BooleanField(default=True, verbose_name='testudtræk')),
+                ('initial_load', models.BooleanField(default=False, verbose_name='fuldt udtræk')),
+                ('name', models.CharField(max_length=128, verbose_name='navn')),
+                ('status', models.CharField(choices=[('QUEUED', 'i kø'), ('RUNNING', 'i gang'), ('DONE', 'færdig'), ('FAILED', 'fejlet')], db_index=True, default='QUEUED', max_length=128, verbose_name='status')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='oprettet')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='startet')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='afsluttet')),
+                ('error', models.TextField(blank=True, verbose_name='fejl')),
+                ('content', models.BinaryField(blank=True, null=True, verbose_name='komprimeret indhold')),
+                ('payload', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='core.dstpayload', verbose_name='DST udtræk')),
+                ('sections', models.ManyToManyField(blank=True, to='core.section', verbose_name='paragraffer')),
+            ],
+            options={
+                'verbose_name': 'DST udtræksjob',
+                'verbose_name_plural': 'DST udtræksjob',
+                'ordering': ('-created',),
+            },
+        ),
+    ]
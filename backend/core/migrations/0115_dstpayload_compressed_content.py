@@ -0,0 +1,79 @@
+# Generated by Django 3.2.12 on 2026-10-17 16:00
+
+import gzip
+import hashlib
+
+from django.db import migrations, models
+
+# The payloads are whole XML deliveries, so only a few are held in memory
+# at a time.
+BATCH_SIZE = 50
+
+
+def compress_content(apps, schema_editor):
+    DSTPayload = apps.get_model("core", "DSTPayload")
+
+    last_pk = 0
+    while True:
+        payloads = list(
+            DSTPayload.objects.filter(pk__gt=last_pk)
+            .only("pk", "content")
+            .order_by("pk")[:BATCH_SIZE]
+        )
+        if not payloads:
+            break
+        for payload in payloads:
+            content = payload.content.encode("utf-8")
+            payload.compressed_content = gzip.compress(content)
+            payload.size = len(content)
+            payload.checksum = hashlib.sha256(content).hexdigest()
+        DSTPayload.objects.bulk_update(
+            payloads, ["compressed_content", "size", "checksum"]
+        )
+        last_pk = payloads[-1].pk
+
+
+def decompress_content(apps, schema_editor):
+    DSTPayload = apps.get_model("core", "DSTPayload")
+
+    last_pk = 0
+    while True:
+        payloads = list(
+            DSTPayload.objects.filter(pk__gt=last_pk)
+            .only("pk", "compressed_content")
+            .order_by("pk")[:BATCH_SIZE]
+        )
+        if not payloads:
+            break
+        for payload in payloads:
+            payload.content = gzip.decompress(
+                payload.compressed_content
+            ).decode("utf-8")
+        DSTPayload.objects.bulk_update(payloads, ["content"])
+        last_pk = payloads[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0114_dstpayloadjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dstpayload',
+            name='compressed_content',
+            field=models.BinaryField(null=True, verbose_name='komprimeret indhold'),
+        ),
+        migrations.AddField(
+            model_name='dstpayload',
+            name='size',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='størrelse'),
+        ),
+        migrations.AddField(
+            model_name='dstpayload',
+            name='checksum',
+            field=models.CharField(blank=True, max_length=64, verbose_name='SHA-256 checksum'),
+        ),
+        migrations.RunPython(compress_content, decompress_content),
+    ]
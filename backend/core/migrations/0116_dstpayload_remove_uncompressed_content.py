@@ -0,0 +1,27 @@
+# Generated by Django 3.2.12 on 2026-10-17 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0115_dstpayload_compressed_content'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='dstpayload',
+            name='content',
+        ),
+        migrations.RenameField(
+            model_name='dstpayload',
+            old_name='compressed_content',
+            new_name='content',
+        ),
+        migrations.AlterField(
+            model_name='dstpayload',
+            name='content',
+            field=models.BinaryField(verbose_name='komprimeret indhold'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.12 on 2026-10-17 18:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0116_dstpayload_remove_uncompressed_content'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppropriationDispatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('QUEUED', 'i kø'), ('RUNNING', 'i gang'), ('DONE', 'færdig'), ('FAILED', 'fejlet')], db_index=True, default='QUEUED', max_length=128, verbose_name='status')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='antal forsøg')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='oprettet')),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, verbose_name='næste forsøg')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='startet')),
+                ('sent', models.DateTimeField(blank=True, null=True, verbose_name='afsendt')),
+                ('error', models.TextField(blank=True, verbose_name='fejl')),
+                ('appropriation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dispatches', to='core.appropriation', verbose_name='bevilling')),
+                ('included_activities', models.ManyToManyField(blank=True, related_name='_core_appropriationdispatch_included_activities_+', to='core.activity', verbose_name='medtagne aktiviteter')),
+            ],
+            options={
+                'verbose_name': 'afsendelse til SBSYS',
+                'verbose_name_plural': 'afsendelser til SBSYS',
+                'ordering': ('-created',),
+            },
+        ),
+    ]
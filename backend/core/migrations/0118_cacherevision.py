@@ -0,0 +1,33 @@
+# Generated by Django 3.2.12 on 2026-10-17 19:00
+
+from django.db import migrations, models
+
+
+def create_account_resolver_revision(apps, schema_editor):
+    CacheRevision = apps.get_model("core", "CacheRevision")
+    CacheRevision.objects.get_or_create(name="account_resolver")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0117_appropriationdispatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheRevision',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128, unique=True, verbose_name='navn')),
+                ('revision', models.PositiveBigIntegerField(default=0, verbose_name='revision')),
+            ],
+            options={
+                'verbose_name': 'cacherevision',
+                'verbose_name_plural': 'cacherevisioner',
+            },
+        ),
+        migrations.RunPython(
+            create_account_resolver_revision, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.12 on 2026-10-17 20:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0118_cacherevision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobcheckpoint',
+            name='scope',
+            field=models.JSONField(blank=True, default=list, verbose_name='omfang'),
+        ),
+    ]
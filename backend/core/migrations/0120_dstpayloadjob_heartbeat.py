@@ -0,0 +1,29 @@
+# Generated by Django 3.2.12 on 2026-10-17 21:00
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_running_job_heartbeats(apps, schema_editor):
+    DSTPayloadJob = apps.get_model("core", "DSTPayloadJob")
+    DSTPayloadJob.objects.filter(status="RUNNING").update(
+        heartbeat=F("started")
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0119_jobcheckpoint_scope'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dstpayloadjob',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='sidst aktiv'),
+        ),
+        migrations.RunPython(
+            set_running_job_heartbeats, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.12 on 2026-10-17 22:00
+
+from django.db import migrations
+
+
+def clear_content_stored_with_payload(apps, schema_editor):
+    DSTPayloadJob = apps.get_model("core", "DSTPayloadJob")
+    DSTPayloadJob.objects.filter(payload__isnull=False).update(content=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0120_dstpayloadjob_heartbeat'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            clear_content_stored_with_payload, migrations.RunPython.noop
+        ),
+    ]
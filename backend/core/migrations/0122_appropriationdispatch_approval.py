@@ -0,0 +1,52 @@
+# Generated by Django 3.2.12 on 2026-10-17 23:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def set_dispatch_approvals(apps, schema_editor):
+    AppropriationDispatch = apps.get_model("core", "AppropriationDispatch")
+    for dispatch in AppropriationDispatch.objects.all():
+        # All activities in a dispatch were granted together.
+        activity = dispatch.included_activities.first()
+        if activity is not None:
+            dispatch.approval_level_id = activity.approval_level_id
+            dispatch.approval_note = activity.approval_note
+            dispatch.approval_user_id = activity.approval_user_id
+        dispatch.granted = dispatch.created
+        dispatch.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0121_clear_dstpayloadjob_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appropriationdispatch',
+            name='approval_level',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.approvallevel', verbose_name='bevillingsniveau'),
+        ),
+        migrations.AddField(
+            model_name='appropriationdispatch',
+            name='approval_note',
+            field=models.TextField(blank=True, verbose_name='evt. bemærkning'),
+        ),
+        migrations.AddField(
+            model_name='appropriationdispatch',
+            name='approval_user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='bevilget af bruger'),
+        ),
+        migrations.AddField(
+            model_name='appropriationdispatch',
+            name='granted',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='bevilget'),
+        ),
+        migrations.RunPython(
+            set_dispatch_approvals, migrations.RunPython.noop
+        ),
+    ]
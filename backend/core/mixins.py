@@ -99,3 +99,77 @@ class AuditModelMixin(models.Model):
 
     class Meta:
         abstract = True
+
+
+class DirtyFieldsMixin:
+    """Mixin for tracking which fields changed since an object was loaded.
+
+    Models using this must call reset_dirty_fields() when they are saved.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Take a snapshot of the values loaded from the database."""
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {
+            attname: value
+            for attname, value in zip(field_names, values)
+            if value is not models.DEFERRED
+        }
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        """Reload from the database and take a new snapshot."""
+        super().refresh_from_db(using=using, fields=fields)
+        self.reset_dirty_fields(fields)
+
+    def get_dirty_fields(self):
+        """Return the attribute names of all fields changed since loading.
+
+        Every field is dirty on an object that was never loaded or saved.
+        """
+        loaded_values = getattr(self, "_loaded_values", None)
+        if loaded_values is None:
+            return {field.attname for field in self._meta.concrete_fields}
+        return {
+            attname
+            for attname, value in loaded_values.items()
+            if getattr(self, attname) != value
+        }
+
+    def has_dirty_fields(self, attnames):
+        """Return True if any of the given fields changed since loading."""
+        return not self.get_dirty_fields().isdisjoint(attnames)
+
+    def get_loaded_value(self, attname):
+        """Return the value a field had when loaded, or None if unknown."""
+        loaded_values = getattr(self, "_loaded_values", None) or {}
+        return loaded_values.get(attname)
+
+    def is_tracking_dirty_fields(self):
+        """Return True if the object was loaded or saved and not just built.
+
+        This is not the case while an object is being created, e.g. in its
+        post_save signals.
+        """
+        return getattr(self, "_loaded_values", None) is not None
+
+    def reset_dirty_fields(self, fields=None):
+        """Take a new snapshot of all or the given fields."""
+        concrete_fields = self._meta.concrete_fields
+        if fields is None:
+            self._loaded_values = {}
+        elif getattr(self, "_loaded_values", None) is None:
+            # Without a full snapshot all fields stay dirty.
+            return
+        else:
+            concrete_fields = [
+                field
+                for field in concrete_fields
+                if field.name in fields or field.attname in fields
+            ]
+        for field in concrete_fields:
+            if field.attname in self.__dict__:
+                self._loaded_values[field.attname] = getattr(
+                    self, field.attname
+                )
@@ -6,14 +6,17 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """These are the Django models, defining the database layout."""
 
+import bisect
+import contextlib
+import threading
+from collections import namedtuple
 from datetime import datetime, date, timedelta
 from decimal import Decimal
 from dateutil.relativedelta import relativedelta
-from dateutil import rrule
 import portion as P
 
 from django import forms
-from django.db import models, transaction, IntegrityError
+from django.db import models, transaction, connection, IntegrityError
 from django.db.models import Q, F
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
@@ -27,17 +30,27 @@ from django_currentuser.middleware import get_current_user
 
 from constance import config
 
-from core.mixins import AuditModelMixin
+from core.mixins import AuditModelMixin, DirtyFieldsMixin
 from core.managers import (
     PaymentQuerySet,
+    PaymentScheduleQuerySet,
     CaseQuerySet,
     ActivityQuerySet,
+    ActivityYearTotalQuerySet,
     AppropriationQuerySet,
+    DSTPayloadJobQuerySet,
+    AppropriationDispatchQuerySet,
 )
 from core.utils import (
-    send_appropriation,
     create_rrule,
     get_company_info_from_cvr,
+    generate_dst_payload_filename,
+    stream_dst_payload_preventive_measures,
+    stream_dst_payload_handicap,
+    compress_chunks,
+    decompress_chunks,
+    render_appropriation,
+    send_appropriation_files,
 )
 
 # Payment methods and choice list.
@@ -80,6 +93,52 @@ dst_payload_types = (
     (HANDICAP, _("handicap")),
 )
 
+# Statuses of the background jobs and choice list.
+JOB_QUEUED = "QUEUED"
+JOB_RUNNING = "RUNNING"
+JOB_DONE = "DONE"
+JOB_FAILED = "FAILED"
+job_status_choices = (
+    (JOB_QUEUED, _("i kø")),
+    (JOB_RUNNING, _("i gang")),
+    (JOB_DONE, _("færdig")),
+    (JOB_FAILED, _("fejlet")),
+)
+
+
+# The activities whose year totals are refreshed at the end of the
+# outermost batch_year_totals block of this thread.
+_year_totals_batch = threading.local()
+
+
+@contextlib.contextmanager
+def batch_year_totals():
+    """Refresh the year totals of changed activities once, on exit.
+
+    Blocks may be nested, in which case the refresh is done on exit of
+    the outermost one. Nothing is refreshed if the block fails.
+    """
+    if getattr(_year_totals_batch, "activity_ids", None) is not None:
+        yield
+        return
+
+    _year_totals_batch.activity_ids = set()
+    try:
+        yield
+    finally:
+        activity_ids = _year_totals_batch.activity_ids
+        _year_totals_batch.activity_ids = None
+    ActivityYearTotal.objects.refresh(activity_ids)
+
+
+def refresh_year_totals(activity_ids):
+    """Refresh the year totals of activities, batched if in a batch."""
+    batch = getattr(_year_totals_batch, "activity_ids", None)
+    if batch is not None:
+        batch.update(activity_ids)
+    else:
+        ActivityYearTotal.objects.refresh(activity_ids)
+
 
 class Classification(models.Model):
     """Abstract base class for Classifications."""
@@ -297,9 +356,144 @@ class Team(Classification):
         return f"{self.name}"
 
 
+class CommittedMemo:
+    """Values memoized per process with the revision they were loaded at.
+
+    A value loaded inside a transaction may hold changes which are rolled
+    back later, so it is only used until that transaction ends and kept
+    only if it commits.
+    """
+
+    def __init__(self, max_size=None):
+        """Create an empty memo, cleared when it reaches max_size."""
+        self.max_size = max_size
+        self._committed = {}
+        self._pending = {}
+
+    def get(self, key, revision):
+        """Return the value memoized for key at revision, or None."""
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending_revision, value, keep = pending
+            # Callbacks are dropped when their transaction or savepoint
+            # is rolled back, and run when it commits.
+            if any(entry[1] is keep for entry in connection.run_on_commit):
+                if pending_revision == revision:
+                    return value
+            else:
+                self._pending.pop(key, None)
+        committed = self._committed.get(key)
+        if committed is not None and committed[0] == revision:
+            return committed[1]
+        return None
+
+    def set(self, key, revision, value):
+        """Memoize value for key at revision."""
+        if not connection.in_atomic_block:
+            self._store(self._committed, key, (revision, value))
+            return
+
+        def keep():
+            self._store(self._committed, key, (revision, value))
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+
+        pending = (revision, value, keep)
+        self._store(self._pending, key, pending)
+        transaction.on_commit(keep)
+
+    def discard(self, key):
+        """Forget the value memoized for key."""
+        self._committed.pop(key, None)
+        self._pending.pop(key, None)
+
+    def _store(self, values, key, entry):
+        if self.max_size is not None and len(values) >= self.max_size:
+            values.clear()
+        values[key] = entry
+
+
+# Compiled rate timelines, memoized per process by the id and revision of
+# their VariableRate.
+RATE_TIMELINE_CACHE_SIZE = 1024
+_rate_timelines = CommittedMemo(max_size=RATE_TIMELINE_CACHE_SIZE)
+
+
+class RateTimeline:
+    """Compiled, immutable timeline of the periods of a VariableRate.
+
+    The periods are resolved once with the same interval semantics as
+    ``portion.IntervalDict`` and kept as sorted arrays of start dates,
+    end dates and rates, so looking up a rate is a binary search.
+    """
+
+    __slots__ = ("_starts", "_ends", "_rates")
+
+    def __init__(self, periods):
+        """Compile from (start_date, end_date, rate) tuples in order."""
+        interval_dict = P.IntervalDict()
+        for start_date, end_date, rate in periods:
+            interval = VariableRate.create_interval(start_date, end_date)
+            interval_dict[interval] = rate
+
+        atomic_periods = sorted(
+            (
+                # The unbounded start is represented by date.min.
+                atomic.lower if atomic.lower != -P.inf else date.min,
+                atomic.upper if atomic.upper != P.inf else None,
+                rate,
+            )
+            for interval, rate in interval_dict.items()
+            for atomic in interval
+        )
+        self._starts = tuple(p[0] for p in atomic_periods)
+        self._ends = tuple(p[1] for p in atomic_periods)
+        self._rates = tuple(p[2] for p in atomic_periods)
+
+    def get(self, rate_date, default=0):
+        """Return the rate on the given date."""
+        index = bisect.bisect_right(self._starts, rate_date) - 1
+        if index >= 0:
+            end_date = self._ends[index]
+            if end_date is None or rate_date < end_date:
+                return self._rates[index]
+        return default
+
+    def get_many(self, rate_dates, default=0):
+        """Return the rates on the given dates as a list.
+
+        Dates in ascending order are resolved in a single sorted merge
+        with the periods, other dates fall back to a binary search.
+        """
+        rates = []
+        index = -1
+        previous_date = None
+        for rate_date in rate_dates:
+            if previous_date is not None and rate_date < previous_date:
+                index = bisect.bisect_right(self._starts, rate_date) - 1
+            while (
+                index + 1 < len(self._starts)
+                and self._starts[index + 1] <= rate_date
+            ):
+                index += 1
+            previous_date = rate_date
+
+            end_date = self._ends[index] if index >= 0 else None
+            if index >= 0 and (end_date is None or rate_date < end_date):
+                rates.append(self._rates[index])
+            else:
+                rates.append(default)
+        return rates
+
+
 class VariableRate(models.Model):
     """Superclass for time-dependent rates and prices."""
 
+    # Bumped whenever the periods change, see invalidate_timeline.
+    revision = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_("revision")
+    )
+
     @staticmethod
     def create_interval(start_date, end_date):
         """Create new interval for rates."""
@@ -312,21 +506,64 @@ class VariableRate(models.Model):
             raise ValueError(_("Slutdato skal være mindre end startdato"))
         return P.closedopen(start_date, end_date)
 
+    @staticmethod
+    def invalidate_timeline(rate_id):
+        """Invalidate the compiled timeline of the rate with the given id.
+
+        Bumping the revision in the database invalidates the timelines
+        memoized by other processes as well.
+        """
+        VariableRate.objects.filter(pk=rate_id).update(
+            revision=F("revision") + 1
+        )
+        _rate_timelines.discard(rate_id)
+
+    @property
+    def timeline(self):
+        """Return the compiled timeline of the periods of this rate."""
+        if self.pk is None:
+            return RateTimeline(())
+
+        timeline = _rate_timelines.get(self.pk, self.revision)
+        if timeline is None:
+            timeline = RateTimeline(
+                self.rates_per_date.values_list(
+                    "start_date", "end_date", "rate"
+                )
+            )
+            _rate_timelines.set(self.pk, self.revision, timeline)
+        return timeline
+
     def get_rate_amount(self, rate_date=date.today()):
         """Look up period in RatesPerDate."""
         # Date only, no datetime.
         if isinstance(rate_date, datetime):
             rate_date = rate_date.date()
 
-        periods = self.rates_per_date.all()
-        d = P.IntervalDict()
-        for p in periods:
-            i = self.create_interval(p.start_date, p.end_date)
-            d[i] = p.rate
-        return d.get(rate_date, 0)
+        return self.timeline.get(rate_date)
+
+    def get_rate_amounts(self, rate_dates):
+        """Look up the periods in RatesPerDate for several dates at once."""
+        # Date only, no datetime.
+        rate_dates = [
+            d.date() if isinstance(d, datetime) else d for d in rate_dates
+        ]
+        return self.timeline.get_many(rate_dates)
 
     rate_amount = property(get_rate_amount)
 
+    def save(self, *args, **kwargs):
+        """Save this rate without writing back a stale revision."""
+        if self.pk is not None:
+            revision = (
+                VariableRate.objects.filter(pk=self.pk)
+                .values_list("revision", flat=True)
+                .first()
+            )
+            if revision is not None:
+                self.revision = revision
+        super().save(*args, **kwargs)
+
     @transaction.atomic
     def set_rate_amount(self, amount, start_date=None, end_date=None):
         """Set amount, merge with existing periods."""
@@ -376,7 +613,8 @@ class VariableRate(models.Model):
                 )
                 rpd.save()
         # RatesPerDate belong to this object so notify that they have
-        # changed.
+        # changed. Saving picks up the revision bumped by the RatePerDate
+        # signals.
         self.save()
 
     def __str__(self):
@@ -462,13 +700,37 @@ class Rate(VariableRate, Classification):
         return f"{self.name}"
 
 
-class PaymentSchedule(models.Model):
+class PaymentSchedule(DirtyFieldsMixin, models.Model):
     """Schedule a payment for an Activity."""
 
     class Meta:
         verbose_name = _("betalingsplan")
         verbose_name_plural = _("betalingsplaner")
 
+    objects = PaymentScheduleQuerySet.as_manager()
+
+    # Fields which affect the payments of the schedule.
+    PAYMENT_FIELDS = (
+        "recipient_type",
+        "recipient_id",
+        "recipient_name",
+        "payment_method",
+        "activity_id",
+        "payment_frequency",
+        "payment_date",
+        "payment_day_of_month",
+        "payment_type",
+        "payment_units",
+        "payment_amount",
+        "payment_cost_type",
+        "payment_rate_id",
+    )
+    # Fields shown in the payment emails of the activity.
+    EMAIL_FIELDS = PAYMENT_FIELDS + (
+        "fictive",
+        "payment_method_details_id",
+    )
+
     # Recipient types and choice list.
     INTERNAL = "INTERNAL"
     PERSON = "PERSON"
@@ -478,6 +740,12 @@ class PaymentSchedule(models.Model):
         (PERSON, _("Person")),
         (COMPANY, _("Firma")),
     )
+    # The payment methods allowed for each type of recipient.
+    allowed_payment_methods = {
+        INTERNAL: [INTERNAL],
+        PERSON: [CASH, SD],
+        COMPANY: [INVOICE],
+    }
     recipient_type = models.CharField(
         max_length=128,
         verbose_name=_("betalingsmodtager"),
@@ -636,12 +904,10 @@ class PaymentSchedule(models.Model):
     @staticmethod
     def is_payment_and_recipient_allowed(payment_method, recipient_type):
         """Determine if this combination of method and recipient is allowed."""
-        allowed = {
-            PaymentSchedule.INTERNAL: [INTERNAL],
-            PaymentSchedule.PERSON: [CASH, SD],
-            PaymentSchedule.COMPANY: [INVOICE],
-        }
-        return payment_method in allowed[recipient_type]
+        return (
+            payment_method
+            in PaymentSchedule.allowed_payment_methods[recipient_type]
+        )
 
     @property
     def can_be_paid(self):
@@ -666,7 +932,21 @@ class PaymentSchedule(models.Model):
             raise ValueError(
                 _("ugyldig betalingsmetode for betalingsmodtager")
             )
-        super().save(*args, **kwargs)
+        with batch_year_totals():
+            super().save(*args, **kwargs)
+        self.reset_dirty_fields(kwargs.get("update_fields"))
+
+    def has_payment_changes(self):
+        """Determine if the payments may need to change after a save.
+
+        This is the case if a payment field of the schedule or its
+        activity changed since they were loaded.
+        """
+        if self.has_dirty_fields(self.PAYMENT_FIELDS):
+            return True
+        return bool(self.activity) and self.activity.has_dirty_fields(
+            Activity.PAYMENT_FIELDS
+        )
 
     def create_rrule(self, start, **kwargs):
         """Create a dateutil.rrule for this schedule specifically."""
@@ -697,22 +977,32 @@ class PaymentSchedule(models.Model):
 
     def calculate_per_payment_amount(self, vat_factor, date):
         """Calculate amount from payment type and units."""
+        return self.calculate_per_payment_amounts(vat_factor, [date])[0]
+
+    def calculate_per_payment_amounts(self, vat_factor, dates):
+        """Calculate amounts for a list of dates in one pass.
+
+        The rate periods are resolved once for all the dates rather than
+        looked up for each date.
+        """
         if self.payment_cost_type == self.FIXED_PRICE:
-            amount = self.payment_amount
+            amounts = [self.payment_amount] * len(dates)
         elif self.payment_cost_type == self.PER_UNIT_PRICE:
-            amount = self.payment_units * self.price_per_unit.get_rate_amount(
-                date
-            )
+            amounts = [
+                self.payment_units * rate
+                for rate in self.price_per_unit.get_rate_amounts(dates)
+            ]
         elif self.payment_cost_type == self.GLOBAL_RATE_PRICE:
-            amount = self.payment_units * self.payment_rate.get_rate_amount(
-                date
-            )
+            amounts = [
+                self.payment_units * rate
+                for rate in self.payment_rate.get_rate_amounts(dates)
+            ]
         else:
             # Keep coverage happy
             # TODO: Create sensible output for individual payments
-            amount = Decimal(0)
+            amounts = [Decimal(0)] * len(dates)
 
-        return (amount / 100) * vat_factor
+        return [(amount / 100) * vat_factor for amount in amounts]
 
     @property
     def rate_or_price_amount(self):
@@ -746,14 +1036,9 @@ class PaymentSchedule(models.Model):
             return False
         return True
 
-    @transaction.atomic
     def recalculate_prices(self):
-        """Recalculate price on all payments."""
-        for p in self.payments.filter(paid_amount__isnull=True):
-            p.amount = self.calculate_per_payment_amount(
-                self.activity.vat_factor, p.date
-            )
-            p.save()
+        """Recalculate price on all unpaid payments."""
+        return PaymentSchedule.objects.filter(pk=self.pk).recalculate_prices()
 
     def generate_payments(self, start, end=None, vat_factor=Decimal("100")):
         """Generate payments with a start and end date."""
@@ -761,6 +1046,28 @@ class PaymentSchedule(models.Model):
         if self.payment_type == self.INDIVIDUAL_PAYMENT:
             return
 
+        bulk_create_with_history(
+            self.build_payments(start, end, vat_factor), Payment
+        )
+
+    def build_payments(self, start, end=None, vat_factor=Decimal("100")):
+        """Build the unsaved payments between start and end."""
+        dates, amounts = self.expand_payments(start, end, vat_factor)
+        return [
+            Payment(
+                date=date_obj,
+                recipient_type=self.recipient_type,
+                recipient_id=self.recipient_id,
+                recipient_name=self.recipient_name,
+                payment_method=self.payment_method,
+                amount=amount,
+                payment_schedule=self,
+            )
+            for date_obj, amount in zip(dates, amounts)
+        ]
+
+    def expand_payments(self, start, end=None, vat_factor=Decimal("100")):
+        """Return the payment dates and amounts between start and end."""
         # If no end is specified, choose end of the next year.
         if not end:
             today = date.today()
@@ -768,27 +1075,64 @@ class PaymentSchedule(models.Model):
                 year=today.year + 1, month=date.max.month, day=date.max.day
             )
 
-        rrule_frequency = self.create_rrule(start, until=end)
+        # Expand all dates first and compute the amounts in one pass.
+        dates = list(self.create_rrule(start, until=end))
+        amounts = self.calculate_per_payment_amounts(vat_factor, dates)
+        return dates, amounts
 
-        dates = rrule_frequency
+    def update_payments(self, start, end=None, vat_factor=Decimal("100")):
+        """Update payments to match the schedule, writing only changes.
 
-        bulk_create_with_history(
-            [
-                Payment(
-                    date=date_obj,
-                    recipient_type=self.recipient_type,
-                    recipient_id=self.recipient_id,
-                    recipient_name=self.recipient_name,
-                    payment_method=self.payment_method,
-                    amount=self.calculate_per_payment_amount(
-                        vat_factor, date_obj
-                    ),
-                    payment_schedule=self,
-                )
-                for date_obj in dates
-            ],
-            Payment,
-        )
+        Payments on dates no longer in the schedule are deleted, payments
+        whose amount or recipient differ are updated and missing payments
+        are created. Payments which already match are left untouched.
+        """
+        # Individual is a special case and should not be handled.
+        if self.payment_type == self.INDIVIDUAL_PAYMENT:
+            return
+
+        dates, amounts = self.expand_payments(start, end, vat_factor)
+        wanted = {
+            date_obj.date(): amount.quantize(Decimal("0.01"))
+            for date_obj, amount in zip(dates, amounts)
+        }
+        recipient = {
+            "recipient_type": self.recipient_type,
+            "recipient_id": self.recipient_id,
+            "recipient_name": self.recipient_name,
+            "payment_method": self.payment_method,
+        }
+
+        obsolete_ids = []
+        changed = []
+        for payment in self.payments.all():
+            amount = wanted.pop(payment.date, None)
+            if amount is None:
+                obsolete_ids.append(payment.id)
+                continue
+            values = {"amount": amount, **recipient}
+            if any(getattr(payment, f) != v for f, v in values.items()):
+                for field, value in values.items():
+                    setattr(payment, field, value)
+                changed.append(payment)
+
+        if obsolete_ids:
+            self.payments.filter(id__in=obsolete_ids).delete()
+        if changed:
+            Payment.objects.bulk_update(changed, ["amount", *recipient.keys()])
+        if wanted:
+            bulk_create_with_history(
+                [
+                    Payment(
+                        date=date_obj,
+                        amount=amount,
+                        payment_schedule=self,
+                        **recipient,
+                    )
+                    for date_obj, amount in wanted.items()
+                ],
+                Payment,
+            )
 
     def synchronize_payments(self, start, end, vat_factor=Decimal("100")):
         """Synchronize the payments of an activity for a new end_date."""
@@ -827,6 +1171,34 @@ class PaymentSchedule(models.Model):
         if not end and (newest_payment.date < today + relativedelta(months=6)):
             self.generate_payments(new_start, end, vat_factor)
 
+    @staticmethod
+    def get_account_settings():
+        """Return the (department, kind, unknown number) account settings."""
+        return (
+            config.ACCOUNT_NUMBER_DEPARTMENT,
+            config.ACCOUNT_NUMBER_KIND,
+            config.ACCOUNT_NUMBER_UNKNOWN,
+        )
+
+    @staticmethod
+    def format_account_string(
+        recipient_type, payment_method, account_number, account_settings
+    ):
+        """Format an account string like account_string does.
+
+        The account settings are given as returned by get_account_settings,
+        so they can be looked up once for many payments.
+        """
+        department, kind, account_number_unknown = account_settings
+        if not (
+            recipient_type == PaymentSchedule.PERSON and payment_method == CASH
+        ):
+            department = "XXX"
+            kind = "XXX"
+        return (
+            f"{department}-{account_number or account_number_unknown}-{kind}"
+        )
+
     @property
     def account_string(self):
         """Calculate account string from activity."""
@@ -1115,6 +1487,14 @@ class Case(AuditModelMixin, models.Model):
         Effort, related_name="cases", verbose_name=_("indsatser"), blank=True
     )
     note = models.TextField(verbose_name=_("note"), blank=True)
+    # A case is considered to be expired if all its associated main
+    # activities have end date in the past. If it does not have any
+    # associated activities, it is not considered to be expired.
+    # This is refreshed when activities change and by the nightly
+    # refresh_expired job.
+    expired = models.BooleanField(
+        verbose_name=_("udgået"), default=False, editable=False, db_index=True
+    )
 
     # We only need to store historical records of effort_step, scaling_step,
     # case_worker, assessment_comment, team, acting_municipality -
@@ -1129,35 +1509,17 @@ class Case(AuditModelMixin, models.Model):
             "cpr_number",
             "sbsys_id",
             "note",
+            "expired",
         ]
     )
 
     def __str__(self):
         return f"{self.sbsys_id}"
 
-    @property
-    def expired(self):
-        """Determine if this case has expired.
-
-        A case is considered to be expired if all its associated
-        activites have end date in the past. If it does not have any
-        associated (non-deleted) activities, it is not considered to be
-        expired.
-        """
-        today = timezone.now().date()
-        all_main_activities = Activity.objects.filter(
-            activity_type=MAIN_ACTIVITY, appropriation__case=self
-        )
-        # If no activities exists, we will not consider it expired.
-        if not all_main_activities.exists():
-            return False
-
-        all_main_expired_activities = all_main_activities.filter(
-            end_date__lt=today
-        )
-        return (
-            all_main_activities.count() == all_main_expired_activities.count()
-        )
+    def refresh_expired(self):
+        """Store whether this case has expired."""
+        Case.objects.filter(pk=self.pk).refresh_expired()
+        self.refresh_from_db(fields=["expired"])
 
 
 class ApprovalLevel(Classification):
@@ -1264,17 +1626,29 @@ class Appropriation(AuditModelMixin, models.Model):
         verbose_name=_("supplerende oplysninger"), blank=True
     )
 
-    objects = AppropriationQuerySet.as_manager()
+    # The status and expiry are calculated from the activities and
+    # refreshed when they change. The expiry is also refreshed by the
+    # nightly refresh_expired job.
+    status = models.CharField(
+        verbose_name=_("status"),
+        max_length=128,
+        choices=status_choices,
+        default=STATUS_DRAFT,
+        editable=False,
+        db_index=True,
+    )
+    expired = models.BooleanField(
+        verbose_name=_("udgået"), default=False, editable=False, db_index=True
+    )
 
-    @property
-    def status(self):
-        """Calculate appropriation status from status of activities."""
-        if self.activities.filter(status=STATUS_EXPECTED).exists():
-            return STATUS_EXPECTED
-        if self.activities.filter(status=STATUS_GRANTED).exists():
-            return STATUS_GRANTED
+    objects = AppropriationQuerySet.as_manager()
 
-        return STATUS_DRAFT
+    def refresh_status(self):
+        """Store the status and expiry calculated from the activities."""
+        appropriations = Appropriation.objects.filter(pk=self.pk)
+        appropriations.refresh_status()
+        appropriations.refresh_expired()
+        self.refresh_from_db(fields=["status", "expired"])
 
     @property
     def granted_from_date(self):
@@ -1314,13 +1688,9 @@ class Appropriation(AuditModelMixin, models.Model):
         if not year:
             year = timezone.now().year
 
-        granted_activities = self.activities.filter(status=STATUS_GRANTED)
-
-        this_years_payments = Payment.objects.filter(
-            payment_schedule__activity__in=granted_activities
-        ).in_year(year)
-
-        return this_years_payments.amount_sum()
+        return ActivityYearTotal.objects.filter(
+            activity__appropriation=self, year=year
+        ).sum("granted_sum")
 
     def total_expected_in_year(self, year=None):
         """Retrieve total amount expected in year for this Appropriation.
@@ -1331,10 +1701,11 @@ class Appropriation(AuditModelMixin, models.Model):
         if not year:
             year = timezone.now().year
 
-        activities = self.activities.filter(
-            Q(status=STATUS_GRANTED) | Q(status=STATUS_EXPECTED)
-        )
-        return sum(a.total_expected_in_year(year) for a in activities)
+        return ActivityYearTotal.objects.filter(
+            activity__appropriation=self,
+            activity__status__in=[STATUS_GRANTED, STATUS_EXPECTED],
+            year=year,
+        ).sum("expected_sum")
 
     @property
     def main_activity(self):
@@ -1366,6 +1737,7 @@ class Appropriation(AuditModelMixin, models.Model):
                 return si_filter.first()
 
     @transaction.atomic
+    @batch_year_totals()
     def grant(self, activities, approval_level, approval_note, approval_user):
         """Grant all the given Activities."""
         # Please specify approval level.
@@ -1493,8 +1865,13 @@ class Appropriation(AuditModelMixin, models.Model):
             a.refresh_from_db()
             a.grant(approval_level, approval_note, approval_user)
 
-        # Everything went fine, we can send to SBSYS.
-        send_appropriation(self, to_be_granted)
+        # Everything went fine, we can send to SBSYS once committed.
+        AppropriationDispatch.objects.create(
+            appropriation=self,
+            approval_level=approval_level,
+            approval_note=approval_note,
+            approval_user=approval_user,
+        ).included_activities.set(to_be_granted)
 
     def __str__(self):
         return f"{self.sbsys_id} - {self.section}"
@@ -1747,7 +2124,184 @@ class AccountAliasMapping(models.Model):
         return f"{self.main_account_number} - {self.activity_number}"
 
 
-class Activity(AuditModelMixin, models.Model):
+# The account information resolved for an activity.
+AccountInfo = namedtuple(
+    "AccountInfo", ["activity_category", "account_number", "account_alias"]
+)
+NO_ACCOUNT_INFO = AccountInfo(None, None, None)
+
+
+class CacheRevision(models.Model):
+    """Model for the revision of data memoized by each process.
+
+    Bumping the revision makes every process reload its memoized copy.
+    """
+
+    name = models.CharField(
+        max_length=128, unique=True, verbose_name=_("navn")
+    )
+    revision = models.PositiveBigIntegerField(
+        default=0, verbose_name=_("revision")
+    )
+
+    def __str__(self):
+        return f"{self.name} - {self.revision}"
+
+    class Meta:
+        verbose_name = _("cacherevision")
+        verbose_name_plural = _("cacherevisioner")
+
+    @classmethod
+    def get_revision(cls, name):
+        """Return the current revision of the data with the given name."""
+        return (
+            cls.objects.filter(name=name)
+            .values_list("revision", flat=True)
+            .first()
+        ) or 0
+
+    @classmethod
+    def bump(cls, name):
+        """Bump the revision of the data with the given name."""
+        if not cls.objects.filter(name=name).update(
+            revision=F("revision") + 1
+        ):
+            cls.objects.get_or_create(name=name, defaults={"revision": 1})
+
+
+# The account resolver is memoized per process and checked against the
+# revision in the database, which is bumped whenever the account tables
+# change in any process.
+_account_resolver = CommittedMemo()
+ACCOUNT_RESOLVER_REVISION = "account_resolver"
+
+
+class AccountResolver:
+    """Resolve activity categories, account numbers and account aliases.
+
+    The section infos with their activity categories and the account
+    alias mappings are small tables, so they are indexed in memory
+    instead of being queried for each activity.
+    """
+
+    def __init__(self, revision=0):
+        """Load the index of the given revision from the database."""
+        self.revision = revision
+        self.section_infos = {}
+        for section_info in SectionInfo.objects.select_related(
+            "activity_category"
+        ).order_by("-pk"):
+            self.section_infos[
+                (section_info.activity_details_id, section_info.section_id)
+            ] = section_info
+        self.account_aliases = {
+            (main_account_number, activity_number): alias
+            for (
+                main_account_number,
+                activity_number,
+                alias,
+            ) in AccountAliasMapping.objects.values_list(
+                "main_account_number", "activity_number", "alias"
+            )
+        }
+
+    def resolve(self, activity):
+        """Resolve the account info of an activity.
+
+        Supplementary activities are resolved from the main activity of
+        their appropriation.
+        """
+        main_activity = None
+        if activity.activity_type != MAIN_ACTIVITY:
+            main_activity = activity.appropriation.main_activity
+        return self.resolve_with_main_activity(activity, main_activity)
+
+    def resolve_with_main_activity(self, activity, main_activity):
+        """Resolve the account info of an activity given its main activity."""
+        if activity.activity_type == MAIN_ACTIVITY:
+            details_id = activity.details_id
+        else:
+            if not main_activity:
+                return NO_ACCOUNT_INFO
+            details_id = main_activity.details_id
+
+        section_info = self.section_infos.get(
+            (details_id, activity.appropriation.section_id)
+        )
+        if not section_info or not section_info.activity_category:
+            return NO_ACCOUNT_INFO
+
+        if activity.activity_type == MAIN_ACTIVITY:
+            main_account_number = (
+                section_info.get_main_activity_main_account_number()
+            )
+        else:
+            main_account_number = (
+                section_info.get_supplementary_activity_main_account_number()
+            )
+        activity_category = section_info.activity_category
+        category_id = activity_category.category_id
+        return AccountInfo(
+            activity_category,
+            f"{main_account_number}-{category_id}",
+            self.account_aliases.get((main_account_number, category_id)),
+        )
+
+    def resolve_accounts(self, activities):
+        """Resolve the account info of activities, keyed by activity id.
+
+        The main activities of the appropriations are fetched in one
+        query.
+        """
+        activities = list(activities)
+        appropriation_ids = {
+            activity.appropriation_id
+            for activity in activities
+            if activity.activity_type != MAIN_ACTIVITY
+        }
+        main_activities = {}
+        if appropriation_ids:
+            for main_activity in Activity.objects.filter(
+                appropriation__in=appropriation_ids,
+                activity_type=MAIN_ACTIVITY,
+                modifies__isnull=True,
+            ).order_by("-pk"):
+                main_activities[main_activity.appropriation_id] = main_activity
+
+        return {
+            activity.pk: self.resolve_with_main_activity(
+                activity, main_activities.get(activity.appropriation_id)
+            )
+            for activity in activities
+        }
+
+
+def get_account_resolver():
+    """Return the account resolver of this process, loading it if needed.
+
+    The resolver is reloaded if the account tables changed since it was
+    loaded, which takes a single query to check.
+    """
+    revision = CacheRevision.get_revision(ACCOUNT_RESOLVER_REVISION)
+    resolver = _account_resolver.get(ACCOUNT_RESOLVER_REVISION, revision)
+    if resolver is None:
+        resolver = AccountResolver(revision)
+        _account_resolver.set(ACCOUNT_RESOLVER_REVISION, revision, resolver)
+    return resolver
+
+
+def invalidate_account_resolver():
+    """Make every process reload its account resolver."""
+    CacheRevision.bump(ACCOUNT_RESOLVER_REVISION)
+    _account_resolver.discard(ACCOUNT_RESOLVER_REVISION)
+
+
+def resolve_accounts(activities):
+    """Resolve the account info of activities, keyed by activity id."""
+    return get_account_resolver().resolve_accounts(activities)
+
+
+class Activity(DirtyFieldsMixin, AuditModelMixin, models.Model):
     """An activity is a specific service provided within an appropriation.
 
     The details object contains the name, tolerance, etc. of the service.
@@ -1774,6 +2328,21 @@ class Activity(AuditModelMixin, models.Model):
 
     objects = ActivityQuerySet.as_manager()
 
+    # Fields which affect the payments of the activity.
+    PAYMENT_FIELDS = (
+        "details_id",
+        "status",
+        "start_date",
+        "end_date",
+        "service_provider_id",
+    )
+    # Fields shown in the payment emails of the activity.
+    EMAIL_FIELDS = PAYMENT_FIELDS + (
+        "activity_type",
+        "appropriation_id",
+        "approval_user_id",
+    )
+
     details = models.ForeignKey(
         ActivityDetails,
         on_delete=models.PROTECT,
@@ -1853,6 +2422,7 @@ class Activity(AuditModelMixin, models.Model):
         return f"{self.details} - {activity_type_str} - {status_str}"
 
     @transaction.atomic
+    @batch_year_totals()
     def grant(self, approval_level, approval_note, approval_user):
         """Grant this activity - update payment info as needed."""
         self.appropriation_date = timezone.now().date()
@@ -1977,124 +2547,30 @@ class Activity(AuditModelMixin, models.Model):
 
         return True
 
+    def get_account_info(self):
+        """Resolve the activity category and accounts of this activity."""
+        return get_account_resolver().resolve(self)
+
     @property
     def activity_category(self):
         """Get the activity category of this activity."""
-        if self.activity_type == MAIN_ACTIVITY:
-            try:
-                section_info = SectionInfo.objects.get(
-                    activity_details=self.details,
-                    section=self.appropriation.section,
-                )
-            except SectionInfo.DoesNotExist:
-                return None
-        else:
-            main_activity = self.appropriation.main_activity
-            if not main_activity:
-                return None
-            try:
-                section_info = SectionInfo.objects.get(
-                    activity_details=main_activity.details,
-                    section=self.appropriation.section,
-                )
-            except SectionInfo.DoesNotExist:
-                return None
-
-        activity_category = section_info.activity_category
-        if not activity_category:
-            return None
-
-        return activity_category
+        return self.get_account_info().activity_category
 
     @property
     def account_number(self):
         """Calculate the account_number_new to use with this activity."""
-        if self.activity_type == MAIN_ACTIVITY:
-            try:
-                section_info = SectionInfo.objects.get(
-                    activity_details=self.details,
-                    section=self.appropriation.section,
-                )
-            except SectionInfo.DoesNotExist:
-                return None
-            main_account_number = (
-                section_info.get_main_activity_main_account_number()
-            )
-            activity_category = section_info.activity_category
-            if not activity_category:
-                return None
-            category_id = activity_category.category_id
-        else:
-            main_activity = self.appropriation.main_activity
-            if not main_activity:
-                return None
-            try:
-                section_info = SectionInfo.objects.get(
-                    activity_details=main_activity.details,
-                    section=self.appropriation.section,
-                )
-            except SectionInfo.DoesNotExist:
-                return None
-            main_account_number = (
-                section_info.get_supplementary_activity_main_account_number()
-            )
-            activity_category = section_info.activity_category
-            if not activity_category:
-                return None
-            category_id = activity_category.category_id
-        return f"{main_account_number}-{category_id}"
+        return self.get_account_info().account_number
 
     @property
     def account_alias(self):
         """Calculate the new account_alias to use with this activity."""
-        if self.activity_type == MAIN_ACTIVITY:
-            try:
-                section_info = SectionInfo.objects.get(
-                    activity_details=self.details,
-                    section=self.appropriation.section,
-                )
-            except SectionInfo.DoesNotExist:
-                return None
-            main_account_number = (
-                section_info.get_main_activity_main_account_number()
-            )
-            activity_category = section_info.activity_category
-            if not activity_category:
-                return None
-            category_id = activity_category.category_id
-        else:
-            main_activity = self.appropriation.main_activity
-            if not main_activity:
-                return None
-            try:
-                section_info = SectionInfo.objects.get(
-                    activity_details=main_activity.details,
-                    section=self.appropriation.section,
-                )
-            except SectionInfo.DoesNotExist:
-                return None
-            main_account_number = (
-                section_info.get_supplementary_activity_main_account_number()
-            )
-            activity_category = section_info.activity_category
-            if not activity_category:
-                return None
-            category_id = activity_category.category_id
-        try:
-            account_alias_mapping = AccountAliasMapping.objects.get(
-                main_account_number=main_account_number,
-                activity_number=category_id,
-            )
-        except AccountAliasMapping.DoesNotExist:
-            return None
-
-        return account_alias_mapping.alias
+        return self.get_account_info().account_alias
 
     @property
     def monthly_payment_plan(self):
         """Calculate the payment plan for this activity, grouped by months."""
         payments = Payment.objects.filter(payment_schedule__activity=self)
-        return payments.group_by_monthly_amounts()
+        return payments.monthly_payment_plans().get(self.pk, [])
 
     @property
     def applicable_payments(self):
@@ -2102,36 +2578,9 @@ class Activity(AuditModelMixin, models.Model):
         if not hasattr(self, "payment_plan") or not self.payment_plan:
             return Payment.objects.none()
 
+        payments = Payment.objects.filter(payment_schedule__activity=self)
         if self.status == STATUS_GRANTED and self.modified_by_exists():
-            # one time payments are always overruled entirely.
-            if (
-                self.payment_plan.payment_type
-                == PaymentSchedule.ONE_TIME_PAYMENT
-            ):
-                payments = Payment.objects.none()
-            else:
-                # Find the earliest payment date in the chain of
-                # modified_by activities and exclude from that point
-                # and onwards.
-                modified_by_activities = self.get_all_modified_by_activities()
-                min_payment = (
-                    Payment.objects.filter(
-                        payment_schedule__activity__in=modified_by_activities
-                    )
-                    .order_by("date")
-                    .first()
-                )
-                if not min_payment:
-                    payments = Payment.objects.filter(
-                        payment_schedule__activity=self
-                    )
-                else:
-                    min_date = min_payment.date
-                    payments = Payment.objects.filter(
-                        payment_schedule__activity=self
-                    ).exclude(date__gte=min_date)
-        else:
-            payments = Payment.objects.filter(payment_schedule__activity=self)
+            payments = payments.applicable()
 
         return payments
 
@@ -2191,13 +2640,12 @@ class Activity(AuditModelMixin, models.Model):
         now = timezone.now().date()
         start_date = date(now.year, month=1, day=1)
         end_date = date(now.year, month=12, day=31)
-        payment_amounts = (
-            self.payment_plan.calculate_per_payment_amount(vat_factor, date)
-            for date in self.payment_plan.create_rrule(
-                start_date, until=end_date
-            )
+        dates = list(
+            self.payment_plan.create_rrule(start_date, until=end_date)
+        )
+        return sum(
+            self.payment_plan.calculate_per_payment_amounts(vat_factor, dates)
         )
-        return sum(payment_amounts)
 
     @property
     def triggers_payment_email(self):
@@ -2231,24 +2679,10 @@ class Activity(AuditModelMixin, models.Model):
         """
         Retrieve all modified_by objects recursively.
 
-        As the Django ORM doesn't handle recursive objects and Python is slow,
-        we can use a "WITH RECURSIVE" query in SQL to fetch the objects:
-        https://www.postgresql.org/docs/current/queries-with.html
+        The chain of modifications is maintained in ActivityModification,
+        so no recursive query is needed.
         """
-        return Activity.objects.raw(
-            """
-            WITH RECURSIVE T AS (
-            SELECT core_activity.id, core_activity.status FROM core_activity
-            WHERE id=%(id)s
-            UNION
-            SELECT core_activity.id, core_activity.status FROM core_activity
-            JOIN T
-            ON (core_activity.modifies_id = T.id)
-            )
-            SELECT id FROM T WHERE id!=%(id)s;
-        """,
-            {"id": self.id},
-        )
+        return Activity.objects.filter(modified_activities__activity=self)
 
     def modifies_exists(self):
         """
@@ -2279,12 +2713,25 @@ class Activity(AuditModelMixin, models.Model):
         Save activity.
 
         Also updates "modified" field on appropriation and
-        payment_plan payments.
+        payment_plan payments, unless nothing relevant changed.
         """
-        super().save(*args, **kwargs)
-        self.appropriation.save()
-        if hasattr(self, "payment_plan") and self.payment_plan:
-            self.payment_plan.save()
+        dirty_fields = self.get_dirty_fields()
+        with batch_year_totals():
+            super().save(*args, **kwargs)
+            if dirty_fields:
+                self.appropriation.save()
+            if (
+                hasattr(self, "payment_plan")
+                and self.payment_plan
+                and self.has_dirty_fields(self.PAYMENT_FIELDS)
+            ):
+                self.payment_plan.save()
+        self.reset_dirty_fields(kwargs.get("update_fields"))
+
+    def delete(self, *args, **kwargs):
+        """Delete activity, refreshing year totals once for all payments."""
+        with batch_year_totals():
+            return super().delete(*args, **kwargs)
 
     def is_valid_activity_start_date(self):
         """Determine if a date is valid for a activity start_date."""
@@ -2305,27 +2752,122 @@ class Activity(AuditModelMixin, models.Model):
             )
             if start_date < today:
                 return False
-            exclusions = PaymentDateExclusion.objects.all()
-
             # We start counting days from tomorrow.
             tomorrow = today + relativedelta(days=1)
-            tomorrow_to_start_date_in_days = [
-                dt.date()
-                for dt in rrule.rrule(
-                    rrule.DAILY, dtstart=tomorrow, until=start_date
+            business_days = get_payment_date_calendar().next_business_days(
+                tomorrow, 2
+            )
+            return business_days[-1] <= start_date
+        return True
+
+
+class ActivityModification(models.Model):
+    """Model linking an activity to all activities modifying it.
+
+    This is a closure table of the chain of modifications, i.e. there is
+    a row for every activity modifying an activity directly (depth 1) or
+    through other modifications.
+    """
+
+    activity = models.ForeignKey(
+        Activity,
+        on_delete=models.CASCADE,
+        related_name="modifications",
+        verbose_name=_("aktivitet"),
+    )
+    modified_by = models.ForeignKey(
+        Activity,
+        on_delete=models.CASCADE,
+        related_name="modified_activities",
+        verbose_name=_("justeres af aktivitet"),
+    )
+    depth = models.PositiveIntegerField(verbose_name=_("dybde"))
+
+    class Meta:
+        verbose_name = _("justering")
+        verbose_name_plural = _("justeringer")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["activity", "modified_by"],
+                name="unique_activity_modified_by",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.activity} - {self.modified_by} - {self.depth}"
+
+    @staticmethod
+    def update_chain(activity):
+        """Link the activity and those modifying it to what it modifies."""
+        descendants = [(activity.pk, 0)] + list(
+            ActivityModification.objects.filter(activity=activity).values_list(
+                "modified_by_id", "depth"
+            )
+        )
+        descendant_ids = [pk for pk, depth in descendants]
+        ActivityModification.objects.filter(
+            modified_by__in=descendant_ids
+        ).exclude(activity__in=descendant_ids).delete()
+
+        if not activity.modifies_id:
+            return
+        ancestors = [(activity.modifies_id, 1)] + [
+            (pk, depth + 1)
+            for pk, depth in ActivityModification.objects.filter(
+                modified_by=activity.modifies_id
+            ).values_list("activity_id", "depth")
+        ]
+        ActivityModification.objects.bulk_create(
+            [
+                ActivityModification(
+                    activity_id=ancestor_id,
+                    modified_by_id=descendant_id,
+                    depth=ancestor_depth + descendant_depth,
                 )
+                for ancestor_id, ancestor_depth in ancestors
+                for descendant_id, descendant_depth in descendants
             ]
+        )
 
-            days_without_exclusions = 0
-            for day_date in tomorrow_to_start_date_in_days:
-                if not exclusions.filter(date=day_date).exists():
-                    days_without_exclusions += 1
 
-                if days_without_exclusions == 2:
-                    return True
+class ActivityYearTotal(models.Model):
+    """Model for the totals of the payments of an activity in a year.
 
-            return False
-        return True
+    The totals are refreshed whenever the payments of the activity or of
+    the activities modifying it change, and may be rebuilt from scratch
+    with the rebuild_year_totals management command.
+    """
+
+    activity = models.ForeignKey(
+        Activity,
+        on_delete=models.CASCADE,
+        related_name="year_totals",
+        verbose_name=_("aktivitet"),
+    )
+    year = models.PositiveIntegerField(verbose_name=_("år"))
+    granted_sum = models.DecimalField(
+        max_digits=14, decimal_places=2, verbose_name=_("bevilget beløb")
+    )
+    expected_sum = models.DecimalField(
+        max_digits=14, decimal_places=2, verbose_name=_("forventet beløb")
+    )
+    paid_sum = models.DecimalField(
+        max_digits=14, decimal_places=2, verbose_name=_("betalt beløb")
+    )
+
+    objects = ActivityYearTotalQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _("årstotal")
+        verbose_name_plural = _("årstotaler")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["activity", "year"], name="unique_activity_year"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.activity} - {self.year}"
 
 
 class RelatedPerson(AuditModelMixin, models.Model):
@@ -2392,11 +2934,103 @@ class PaymentDateExclusion(models.Model):
         ordering = ("-date",)
 
 
+# The payment date calendar is memoized per process and checked against
+# the revision in the database, which is bumped whenever the payment date
+# exclusions change in any process.
+_payment_date_calendar = CommittedMemo()
+PAYMENT_DATE_CALENDAR_REVISION = "payment_date_calendar"
+
+
+class PaymentDateCalendar:
+    """Calendar of the payment date exclusions, held in memory."""
+
+    def __init__(self, exclusion_dates):
+        """Build the calendar from the given exclusion dates."""
+        self.excluded = frozenset(exclusion_dates)
+
+    @classmethod
+    def load(cls):
+        """Load the calendar from the database."""
+        return cls(PaymentDateExclusion.objects.values_list("date", flat=True))
+
+    def is_excluded(self, day):
+        """Return whether payments are excluded on the given day."""
+        return day in self.excluded
+
+    def next_business_days(self, start, count):
+        """Return the first count days from start without exclusions."""
+        days = []
+        day = start
+        while len(days) < count:
+            if day not in self.excluded:
+                days.append(day)
+            day += timedelta(days=1)
+        return days
+
+    def prism_dates(self, day):
+        """Return the payment dates to bundle into the PRISM run for day.
+
+        If the days after day have exclusions, their payments are
+        included along with the payments of the first day after them, until
+        we reach two consecutive days with no exclusions.
+        """
+        dates = [day]
+        exclusions_found = False
+        consecutive_days = 1
+        days_delta = 1
+        while consecutive_days < 2:
+            while day + timedelta(days=days_delta) in self.excluded:
+                exclusions_found = True
+                dates.append(day + timedelta(days=days_delta))
+                days_delta += 1
+                consecutive_days = 0
+
+            # Also include payments for the first day after
+            # one or more excluded dates.
+            if exclusions_found:
+                dates.append(day + timedelta(days=days_delta))
+            consecutive_days += 1
+            days_delta += 1
+            exclusions_found = False
+        return dates
+
+
+def get_payment_date_calendar():
+    """Return the payment date calendar, loading it if needed.
+
+    The calendar is reloaded if the exclusions changed since it was
+    loaded, which takes a single query to check.
+    """
+    revision = CacheRevision.get_revision(PAYMENT_DATE_CALENDAR_REVISION)
+    calendar = _payment_date_calendar.get(
+        PAYMENT_DATE_CALENDAR_REVISION, revision
+    )
+    if calendar is None:
+        calendar = PaymentDateCalendar.load()
+        _payment_date_calendar.set(
+            PAYMENT_DATE_CALENDAR_REVISION, revision, calendar
+        )
+    return calendar
+
+
+def invalidate_payment_date_calendar():
+    """Make every process reload its payment date calendar."""
+    CacheRevision.bump(PAYMENT_DATE_CALENDAR_REVISION)
+    _payment_date_calendar.discard(PAYMENT_DATE_CALENDAR_REVISION)
+
+
 class DSTPayload(models.Model):
     """Model for a DST payload."""
 
     name = models.CharField(max_length=128, verbose_name=_("navn"))
-    content = models.TextField(verbose_name=_("indhold"))
+    # The XML content, gzip compressed.
+    content = models.BinaryField(verbose_name=_("komprimeret indhold"))
+    size = models.PositiveBigIntegerField(
+        default=0, verbose_name=_("størrelse")
+    )
+    checksum = models.CharField(
+        max_length=64, blank=True, verbose_name=_("SHA-256 checksum")
+    )
     from_date = models.DateField(
         null=True, blank=True, verbose_name=_("fra dato (skæringsdato)")
     )
@@ -2413,7 +3047,324 @@ class DSTPayload(models.Model):
     def __str__(self):
         return f"{self.date} - {self.name} - {self.dst_type}"
 
+    def iter_content(self):
+        """Return the uncompressed content in chunks."""
+        return decompress_chunks(self.content)
+
     class Meta:
         verbose_name = _("DST udtræk")
         verbose_name_plural = _("DST udtræk")
         ordering = ("-date",)
+
+
+class DSTPayloadJob(models.Model):
+    """Model for a DST payload generated in the background.
+
+    Jobs are queued through the REST API and run by the
+    run_dst_payload_jobs management command. The generated payload is
+    stored compressed.
+    """
+
+    dst_type = models.CharField(
+        max_length=128, choices=dst_payload_types, verbose_name=_("type")
+    )
+    from_date = models.DateField(
+        null=True, blank=True, verbose_name=_("fra dato (skæringsdato)")
+    )
+    to_date = models.DateField(
+        null=True, blank=True, verbose_name=_("til dato (skæringsdato)")
+    )
+    sections = models.ManyToManyField(
+        Section, blank=True, verbose_name=_("paragraffer")
+    )
+    test = models.BooleanField(default=True, verbose_name=_("testudtræk"))
+    initial_load = models.BooleanField(
+        default=False, verbose_name=_("fuldt udtræk")
+    )
+    name = models.CharField(max_length=128, verbose_name=_("navn"))
+    status = models.CharField(
+        max_length=128,
+        choices=job_status_choices,
+        default=JOB_QUEUED,
+        db_index=True,
+        verbose_name=_("status"),
+    )
+    created = models.DateTimeField(
+        default=timezone.now, verbose_name=_("oprettet")
+    )
+    started = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("startet")
+    )
+    finished = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("afsluttet")
+    )
+    heartbeat = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("sidst aktiv")
+    )
+    error = models.TextField(blank=True, verbose_name=_("fejl"))
+    # The content of a test job, gzip compressed. Other jobs store their
+    # content with their payload.
+    content = models.BinaryField(
+        null=True, blank=True, verbose_name=_("komprimeret indhold")
+    )
+    payload = models.ForeignKey(
+        DSTPayload,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="jobs",
+        verbose_name=_("DST udtræk"),
+    )
+
+    objects = DSTPayloadJobQuerySet.as_manager()
+
+    # How often a running job records that it is still running.
+    HEARTBEAT_INTERVAL = timedelta(minutes=1)
+
+    def __str__(self):
+        return f"{self.created} - {self.name} - {self.status}"
+
+    class Meta:
+        verbose_name = _("DST udtræksjob")
+        verbose_name_plural = _("DST udtræksjob")
+        ordering = ("-created",)
+
+    def save(self, *args, **kwargs):
+        """Name the payload of a new job."""
+        if not self.name:
+            self.name = generate_dst_payload_filename(
+                self.dst_type, self.test, self.created
+            )
+        super().save(*args, **kwargs)
+
+    def iter_content(self):
+        """Return the uncompressed content in chunks.
+
+        The content of a job which is not a test is only stored with its
+        payload.
+        """
+        if self.payload_id is not None:
+            return self.payload.iter_content()
+        return decompress_chunks(self.content)
+
+    def run(self):
+        """Generate the payload, storing it with the job.
+
+        As for payloads generated in a request, a payload which is not a
+        test is saved for later use, and only stored there. The job must be
+        running, and it stops if it is marked failed while generating.
+        """
+        stream = {
+            PREVENTATIVE_MEASURES: stream_dst_payload_preventive_measures,
+            HANDICAP: stream_dst_payload_handicap,
+        }[self.dst_type]
+        compressed = compress_chunks(
+            self.beat_while(
+                stream(
+                    self.from_date,
+                    self.to_date,
+                    self.sections.all(),
+                    self.test,
+                    self.initial_load,
+                )
+            )
+        )
+        content = compressed["content"] if self.test else None
+        with transaction.atomic():
+            payload = None
+            if not self.test:
+                payload = DSTPayload.objects.create(
+                    name=self.name,
+                    from_date=self.from_date,
+                    to_date=self.to_date,
+                    dst_type=self.dst_type,
+                    **compressed,
+                )
+            finished = timezone.now()
+            self.update_running(
+                status=JOB_DONE,
+                finished=finished,
+                content=content,
+                payload=payload,
+            )
+        self.status = JOB_DONE
+        self.finished = finished
+        self.content = content
+        self.payload = payload
+
+    def beat_while(self, chunks):
+        """Yield the chunks, recording a heartbeat while they are made."""
+        last_beat = timezone.now()
+        for chunk in chunks:
+            now = timezone.now()
+            if now - last_beat >= self.HEARTBEAT_INTERVAL:
+                self.update_running(heartbeat=now)
+                self.heartbeat = last_beat = now
+            yield chunk
+
+    def update_running(self, **fields):
+        """Update the fields of the job, if it is still running.
+
+        A job is no longer running if it was failed as stale, in which
+        case a ValueError is raised.
+        """
+        if not DSTPayloadJob.objects.filter(
+            pk=self.pk, status=JOB_RUNNING
+        ).update(**fields):
+            raise ValueError(_("Jobbet kører ikke længere"))
+
+    def fail(self, error):
+        """Mark the job as failed with the given error, if it is running."""
+        finished = timezone.now()
+        if DSTPayloadJob.objects.filter(pk=self.pk, status=JOB_RUNNING).update(
+            status=JOB_FAILED, finished=finished, error=error
+        ):
+            self.status = JOB_FAILED
+            self.finished = finished
+            self.error = error
+
+
+class AppropriationDispatch(models.Model):
+    """Model for sending a granted appropriation to SBSYS.
+
+    Dispatches are created in the transaction granting the appropriation
+    and sent by the send_appropriations management command, which retries
+    failed dispatches.
+    """
+
+    # The number of attempts before a dispatch is given up.
+    MAX_ATTEMPTS = 10
+
+    appropriation = models.ForeignKey(
+        Appropriation,
+        on_delete=models.CASCADE,
+        related_name="dispatches",
+        verbose_name=_("bevilling"),
+    )
+    included_activities = models.ManyToManyField(
+        Activity,
+        blank=True,
+        related_name="+",
+        verbose_name=_("medtagne aktiviteter"),
+    )
+    # The approval of the included activities as it was when granted, as
+    # the activities may be granted again before the dispatch is sent.
+    approval_level = models.ForeignKey(
+        ApprovalLevel,
+        related_name="+",
+        null=True,
+        blank=True,
+        on_delete=models.PROTECT,
+        verbose_name=_("bevillingsniveau"),
+    )
+    approval_note = models.TextField(
+        verbose_name=_("evt. bemærkning"), blank=True
+    )
+    approval_user = models.ForeignKey(
+        User,
+        related_name="+",
+        null=True,
+        blank=True,
+        on_delete=models.PROTECT,
+        verbose_name=_("bevilget af bruger"),
+    )
+    granted = models.DateTimeField(
+        default=timezone.now, verbose_name=_("bevilget")
+    )
+    status = models.CharField(
+        max_length=128,
+        choices=job_status_choices,
+        default=JOB_QUEUED,
+        db_index=True,
+        verbose_name=_("status"),
+    )
+    attempts = models.PositiveIntegerField(
+        default=0, verbose_name=_("antal forsøg")
+    )
+    created = models.DateTimeField(
+        default=timezone.now, verbose_name=_("oprettet")
+    )
+    next_attempt = models.DateTimeField(
+        default=timezone.now, verbose_name=_("næste forsøg")
+    )
+    started = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("startet")
+    )
+    sent = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("afsendt")
+    )
+    error = models.TextField(blank=True, verbose_name=_("fejl"))
+
+    objects = AppropriationDispatchQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.created} - {self.appropriation} - {self.status}"
+
+    class Meta:
+        verbose_name = _("afsendelse til SBSYS")
+        verbose_name_plural = _("afsendelser til SBSYS")
+        ordering = ("-created",)
+
+    def render(self):
+        """Render the files sent to SBSYS."""
+        return render_appropriation(
+            self.appropriation,
+            self.included_activities.all(),
+            approval={
+                "approval_level": self.approval_level,
+                "approval_note": self.approval_note,
+                "approval_user": self.approval_user,
+                "appropriation_date": self.granted.date(),
+            },
+        )
+
+    def send(self, attachments):
+        """Send the rendered files to SBSYS."""
+        send_appropriation_files(attachments)
+        self.status = JOB_DONE
+        self.sent = timezone.now()
+        self.save(update_fields=["status", "sent"])
+
+    def fail(self, error):
+        """Register a failed attempt, retrying later with a backoff."""
+        self.attempts += 1
+        self.error = error
+        if self.attempts >= self.MAX_ATTEMPTS:
+            self.status = JOB_FAILED
+        else:
+            self.status = JOB_QUEUED
+            self.next_attempt = timezone.now() + timedelta(
+                minutes=2**self.attempts
+            )
+        self.save(
+            update_fields=["attempts", "error", "status", "next_attempt"]
+        )
+
+
+class JobCheckpoint(models.Model):
+    """Model for the progress of a chunked management command.
+
+    A checkpoint is removed when its job completes, so a job finding one
+    resumes after the last processed id if it has the same scope, e.g. the
+    ids of the objects whose changes the job processes.
+    """
+
+    name = models.CharField(
+        max_length=128, unique=True, verbose_name=_("navn")
+    )
+    last_id = models.PositiveBigIntegerField(
+        default=0, verbose_name=_("sidst behandlede id")
+    )
+    scope = models.JSONField(
+        default=list, blank=True, verbose_name=_("omfang")
+    )
+    modified = models.DateTimeField(
+        auto_now=True, verbose_name=_("sidst ændret")
+    )
+
+    def __str__(self):
+        return f"{self.name} - {self.last_id}"
+
+    class Meta:
+        verbose_name = _("jobstatus")
+        verbose_name_plural = _("jobstatusser")
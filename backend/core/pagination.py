@@ -0,0 +1,183 @@
+# Copyright (C) 2019 Magenta ApS, http://magenta.dk.
+# Contact: info@magenta.dk.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Pagination classes used by the REST API."""
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Paginate by the ordering values of the last object on a page.
+
+    Pagination is only used if the ``cursor`` query parameter is given,
+    empty for the first page. Each page links to the next page, whose
+    objects are found with an indexed range predicate rather than an
+    OFFSET, and no COUNT(*) is needed. Without a cursor the fallback
+    pagination class is used, if any, or the results are not paginated.
+
+    The ordering must be unique and consist of fields on the model itself.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 1000
+    ordering = ("id",)
+    fallback_class = None
+    invalid_cursor_message = _("Ugyldig cursor")
+
+    def __init__(self):
+        """Set up the fallback pagination."""
+        self.fallback = self.fallback_class() if self.fallback_class else None
+        self.paginated = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """Return a page of the queryset or None if not paginating."""
+        if self.cursor_query_param not in request.query_params:
+            if self.fallback:
+                return self.fallback.paginate_queryset(queryset, request, view)
+            return None
+
+        self.paginated = True
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request, queryset.model)
+        if position is not None:
+            queryset = queryset.filter(self.get_position_filter(position))
+
+        # Fetch one more object to tell whether there is a next page.
+        limit = page_size + 1
+        results = list(queryset[:limit])
+        self.has_next = len(results) > page_size
+        results = results[:page_size]
+        self.next_position = (
+            [
+                getattr(results[-1], field.lstrip("-"))
+                for field in self.ordering
+            ]
+            if self.has_next
+            else None
+        )
+        return results
+
+    def get_page_size(self, request):
+        """Return the page size, as requested if it is valid."""
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_position_filter(self, position):
+        """Filter objects ordered after the given position."""
+        position_filter = Q()
+        equal = {}
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            position_filter |= Q(**equal, **{f"{name}__{lookup}": value})
+            equal[name] = value
+        return position_filter
+
+    def decode_cursor(self, request, model):
+        """Return the position of the cursor or None for the first page.
+
+        The values of the position are converted to the types of the
+        ordering fields of the model.
+        """
+        encoded = request.query_params[self.cursor_query_param]
+        if not encoded:
+            return None
+        try:
+            position = json.loads(urlsafe_b64decode(encoded.encode("ascii")))
+            if not isinstance(position, list) or len(position) != len(
+                self.ordering
+            ):
+                raise ValueError(position)
+            position = [
+                model._meta.get_field(field.lstrip("-")).to_python(value)
+                for field, value in zip(self.ordering, position)
+            ]
+            if None in position:
+                raise ValueError(position)
+        except (
+            BinasciiError,
+            UnicodeError,
+            ValueError,
+            TypeError,
+            ValidationError,
+        ):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def encode_cursor(self, position):
+        """Return the cursor of the given position."""
+        return urlsafe_b64encode(
+            json.dumps(position, cls=DjangoJSONEncoder).encode("ascii")
+        ).decode("ascii")
+
+    def get_next_link(self):
+        """Return the link to the next page, if any."""
+        if not self.has_next:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.encode_cursor(self.next_position),
+        )
+
+    def get_paginated_response(self, data):
+        """Return the page with a link to the next page."""
+        if not self.paginated:
+            return self.fallback.get_paginated_response(data)
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        """Describe the paginated response."""
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True},
+                "results": schema,
+            },
+        }
+
+    def to_html(self):  # pragma: no cover
+        """Render the fallback page controls in the browsable API."""
+        if not self.paginated and self.fallback:
+            return self.fallback.to_html()
+        return ""
+
+    @property
+    def display_page_controls(self):  # pragma: no cover
+        """Only display the page controls of the fallback pagination."""
+        return (
+            not self.paginated
+            and self.fallback is not None
+            and getattr(self.fallback, "display_page_controls", False)
+        )
+
+
+class PaymentKeysetPagination(KeysetPagination):
+    """Paginate payments by date, keeping page numbers as the fallback."""
+
+    ordering = ("date", "id")
+    fallback_class = PageNumberPagination
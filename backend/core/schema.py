@@ -7,7 +7,6 @@
 """Schema models for our graphene API."""
 
 from django.contrib.auth import get_user_model
-from django.utils import timezone
 
 import graphene
 from graphene import Node, Connection
@@ -35,6 +34,15 @@ from core.models import (
 )
 from core.filters import PaymentFilter, AppropriationFilter
 from core.serializers import CaseSerializer
+from core.loaders import (
+    get_loader,
+    load_activity_total,
+    load_related,
+    total_cost_full_year,
+    ActivityTotalsLoader,
+    MonthlyPaymentPlanLoader,
+    GrantedDatesLoader,
+)
 
 UserModel = get_user_model()
 
@@ -102,6 +110,30 @@ class Appropriation(OptimizedDjangoObjectType):
     granted_to_date = graphene.String()
     status = graphene.String()
 
+    def resolve_case(self, info):
+        """Retrieve the case, batched across appropriations."""
+        return load_related(self, info, "case")
+
+    def resolve_section(self, info):
+        """Retrieve the section, batched across appropriations."""
+        return load_related(self, info, "section")
+
+    def resolve_granted_from_date(self, info):
+        """Retrieve the granted from date, batched across appropriations."""
+        return (
+            get_loader(info, GrantedDatesLoader)
+            .load(self.pk)
+            .then(lambda dates: dates[0])
+        )
+
+    def resolve_granted_to_date(self, info):
+        """Retrieve the granted to date, batched across appropriations."""
+        return (
+            get_loader(info, GrantedDatesLoader)
+            .load(self.pk)
+            .then(lambda dates: dates[1])
+        )
+
     class Meta:
         model = AppropriationModel
         interfaces = (Node,)
@@ -233,41 +265,55 @@ class Activity(OptimizedDjangoObjectType):
     total_granted_next_year = graphene.Float()
     total_expected_next_year = graphene.Float()
 
+    @classmethod
+    def get_queryset(cls, queryset, info):
+        """Annotate the yearly totals and total cost."""
+        return super().get_queryset(queryset.annotate_totals(), info)
+
+    def resolve_total_cost(self, info):
+        """Retrieve total cost of all times."""
+        return load_activity_total(self, info, "annotated_total_cost")
+
+    def resolve_total_cost_this_year(self, info):
+        """Retrieve total cost for this year."""
+        # The total cost in a year is the total expected in that year.
+        return load_activity_total(self, info, "total_expected_this_year")
+
+    def resolve_total_cost_full_year(self, info):
+        """Retrieve total cost for this year, extrapolated to a full year."""
+        return (
+            get_loader(info, ActivityTotalsLoader)
+            .load(self.pk)
+            .then(total_cost_full_year)
+        )
+
+    def resolve_monthly_payment_plan(self, info):
+        """Retrieve the payment plan grouped by months."""
+        return get_loader(info, MonthlyPaymentPlanLoader).load(self.pk)
+
     def resolve_total_granted_this_year(self, info):
         """Retrieve total granted amount for this year."""
-        year = timezone.now().year
-
-        return self.total_granted_in_year(year)
+        return load_activity_total(self, info, "total_granted_this_year")
 
     def resolve_total_expected_this_year(self, info):
         """Retrieve total expected amount for this year."""
-        year = timezone.now().year
-
-        return self.total_expected_in_year(year)
+        return load_activity_total(self, info, "total_expected_this_year")
 
     def resolve_total_granted_previous_year(self, info):
         """Retrieve total granted amount for previous year."""
-        year = timezone.now().year - 1
-
-        return self.total_granted_in_year(year)
+        return load_activity_total(self, info, "total_granted_previous_year")
 
     def resolve_total_expected_previous_year(self, info):
         """Retrieve total expected amount for previous year."""
-        year = timezone.now().year - 1
-
-        return self.total_expected_in_year(year)
+        return load_activity_total(self, info, "total_expected_previous_year")
 
     def resolve_total_granted_next_year(self, info):
         """Retrieve total granted amount for next year."""
-        year = timezone.now().year + 1
-
-        return self.total_granted_in_year(year)
+        return load_activity_total(self, info, "total_granted_next_year")
 
     def resolve_total_expected_next_year(self, info):
         """Retrieve total expected amount for next year."""
-        year = timezone.now().year + 1
-
-        return self.total_expected_in_year(year)
+        return load_activity_total(self, info, "total_expected_next_year")
 
     class Meta:
         model = ActivityModel
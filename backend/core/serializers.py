@@ -47,14 +47,51 @@ from core.models import (
     Effort,
     ActivityCategory,
     DSTPayload,
+    DSTPayloadJob,
     STATUS_DRAFT,
     STATUS_EXPECTED,
     STATUS_GRANTED,
     MAIN_ACTIVITY,
+    HANDICAP,
 )
 from core.utils import validate_cvr
 
 
+def get_requested_fields(request):
+    """Return the fields requested with the fields query parameter.
+
+    Return None if all fields should be included.
+    """
+    if request is None or request.method != "GET":
+        return None
+    fields = request.query_params.get("fields")
+    if not fields:
+        return None
+    return {field.strip() for field in fields.split(",") if field.strip()}
+
+
+class SparseFieldsMixin:
+    """Only include the fields requested with the fields query parameter.
+
+    This only applies to the outermost serializer of a GET request, and
+    the fields that are not requested are not computed at all.
+    """
+
+    def get_fields(self):
+        """Drop the fields that are not requested."""
+        fields = super().get_fields()
+        if self.root is not self and self.root is not self.parent:
+            return fields
+        requested_fields = get_requested_fields(self.context.get("request"))
+        if requested_fields is None:
+            return fields
+        return {
+            name: field
+            for name, field in fields.items()
+            if name in requested_fields
+        }
+
+
 class UserSerializer(serializers.ModelSerializer):
     """Serializer for the User model."""
 
@@ -71,7 +108,7 @@ class UserSerializer(serializers.ModelSerializer):
         )
 
 
-class CaseSerializer(serializers.ModelSerializer):
+class CaseSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """Serializer for the Case model.
 
     Note validation to ensure that cases are always valid
@@ -103,15 +140,10 @@ class CaseSerializer(serializers.ModelSerializer):
 
     def get_num_ongoing_draft_or_expected_appropriations(self, case):
         """Get number of related expected or draft ongoing appropriations."""
-        return len(
-            [
-                appr
-                for appr in case.appropriations.ongoing()
-                if (
-                    appr.status == STATUS_EXPECTED
-                    or appr.status == STATUS_DRAFT
-                )
-            ]
+        return (
+            case.appropriations.ongoing()
+            .filter(status__in=[STATUS_EXPECTED, STATUS_DRAFT])
+            .count()
         )
 
     def validate(self, data):
@@ -160,7 +192,7 @@ class HistoricalCaseSerializer(serializers.ModelSerializer):
         )
 
 
-class PaymentSerializer(serializers.ModelSerializer):
+class PaymentSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """Serializer for the Payment model.
 
     Note the many options for filtering as well as the non-trivial
@@ -536,7 +568,7 @@ class ServiceProviderSerializer(
         fields = "__all__"
 
 
-class BaseActivitySerializer(WritableNestedModelSerializer):
+class BaseActivitySerializer(SparseFieldsMixin, WritableNestedModelSerializer):
     """Base Serializer for the Activity model."""
 
     total_granted_this_year = serializers.SerializerMethodField()
@@ -552,41 +584,44 @@ class BaseActivitySerializer(WritableNestedModelSerializer):
 
     details__name = serializers.ReadOnlyField(source="details.name")
 
+    year_offsets = {"previous_year": -1, "this_year": 0, "next_year": 1}
+
+    def get_year_total(self, obj, total, year_name):
+        """Retrieve a yearly total of an activity from its year totals.
+
+        The annotated total is used if the activity was fetched with
+        annotate_totals.
+        """
+        annotated_name = f"total_{total}_{year_name}"
+        if hasattr(obj, annotated_name):
+            return getattr(obj, annotated_name)
+        year = timezone.now().year + self.year_offsets[year_name]
+
+        return obj.year_totals.filter(year=year).sum(f"{total}_sum")
+
     def get_total_granted_this_year(self, obj):
         """Retrieve total granted amount for this year."""
-        year = timezone.now().year
-
-        return obj.total_granted_in_year(year)
+        return self.get_year_total(obj, "granted", "this_year")
 
     def get_total_expected_this_year(self, obj):
         """Retrieve total expected amount for this year."""
-        year = timezone.now().year
-
-        return obj.total_expected_in_year(year)
+        return self.get_year_total(obj, "expected", "this_year")
 
     def get_total_granted_previous_year(self, obj):
         """Retrieve total granted amount for previous year."""
-        year = timezone.now().year - 1
-
-        return obj.total_granted_in_year(year)
+        return self.get_year_total(obj, "granted", "previous_year")
 
     def get_total_expected_previous_year(self, obj):
         """Retrieve total expected amount for previous year."""
-        year = timezone.now().year - 1
-
-        return obj.total_expected_in_year(year)
+        return self.get_year_total(obj, "expected", "previous_year")
 
     def get_total_granted_next_year(self, obj):
         """Retrieve total granted amount for next year."""
-        year = timezone.now().year + 1
-
-        return obj.total_granted_in_year(year)
+        return self.get_year_total(obj, "granted", "next_year")
 
     def get_total_expected_next_year(self, obj):
         """Retrieve total expected amount for next year."""
-        year = timezone.now().year + 1
-
-        return obj.total_expected_in_year(year)
+        return self.get_year_total(obj, "expected", "next_year")
 
     @staticmethod
     def setup_eager_loading(queryset):
@@ -754,14 +789,26 @@ class ListActivitySerializer(BaseActivitySerializer):
 class ActivitySerializer(BaseActivitySerializer):
     """Serializer for the Activity model."""
 
-    monthly_payment_plan = serializers.ReadOnlyField()
+    monthly_payment_plan = serializers.SerializerMethodField()
     payment_plan = PaymentScheduleSerializer(partial=True, required=False)
     service_provider = ServiceProviderSerializer(
         partial=True, required=False, allow_null=True
     )
 
+    def get_monthly_payment_plan(self, obj):
+        """Retrieve the payment plan grouped by months.
+
+        The plans may be given in the context for a whole list of
+        activities, as loaded by monthly_payment_plans.
+        """
+        if "monthly_payment_plans" in self.context:
+            return self.context["monthly_payment_plans"].get(obj.pk, [])
+        return obj.monthly_payment_plan
+
 
-class BaseAppropriationSerializer(serializers.ModelSerializer):
+class BaseAppropriationSerializer(
+    SparseFieldsMixin, serializers.ModelSerializer
+):
     """Base Serializer for the Appropriation model."""
 
     status = serializers.ReadOnlyField()
@@ -830,9 +877,15 @@ class AppropriationSerializer(BaseAppropriationSerializer):
 
     def get_activities(self, appropriation):
         """Get activities on appropriation."""
-        activities = appropriation.activities.all()
+        activities = appropriation.activities.annotate_totals()
+        monthly_payment_plans = Payment.objects.filter(
+            payment_schedule__activity__appropriation=appropriation
+        ).monthly_payment_plans()
         serializer = ActivitySerializer(
-            instance=activities, many=True, read_only=True
+            instance=activities,
+            many=True,
+            read_only=True,
+            context={"monthly_payment_plans": monthly_payment_plans},
         )
         return serializer.data
 
@@ -994,8 +1047,38 @@ class ActivityCategorySerializer(serializers.ModelSerializer):
 
 
 class DSTPayloadSerializer(serializers.ModelSerializer):
-    """Serializer for the DSTPayload model."""
+    """Serializer for the metadata of the DSTPayload model."""
 
     class Meta:
         model = DSTPayload
-        fields = "__all__"
+        exclude = ("content",)
+
+
+class DSTPayloadJobSerializer(serializers.ModelSerializer):
+    """Serializer for the DSTPayloadJob model."""
+
+    class Meta:
+        model = DSTPayloadJob
+        exclude = ("content",)
+        read_only_fields = (
+            "name",
+            "status",
+            "created",
+            "started",
+            "finished",
+            "heartbeat",
+            "error",
+            "payload",
+        )
+
+    def validate(self, data):
+        """Use the sections reported in the type of payload by default."""
+        if not data.get("sections"):
+            if data["dst_type"] == HANDICAP:
+                sections = Section.objects.filter(dst_handicap=True)
+            else:
+                sections = Section.objects.filter(
+                    dst_preventative_measures=True
+                )
+            data["sections"] = list(sections)
+        return data
@@ -9,13 +9,25 @@
 from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from core.models import (
+    AccountAliasMapping,
     Activity,
+    ActivityCategory,
+    ActivityModification,
+    Appropriation,
     PaymentSchedule,
     Price,
     Rate,
+    RatePerDate,
+    VariableRate,
     Payment,
+    PaymentDateExclusion,
+    SectionInfo,
     STATUS_EXPECTED,
     STATUS_DRAFT,
+    batch_year_totals,
+    invalidate_account_resolver,
+    invalidate_payment_date_calendar,
+    refresh_year_totals,
 )
 from core.utils import (
     send_activity_created_email,
@@ -92,9 +104,102 @@ def send_activity_created_email_on_paymentschedule_create(
 )
 def send_activity_payment_email_on_save(sender, instance, created, **kwargs):
     """Send payment email when Activity is saved."""
+    # Forget about any email sent by a previous save.
+    instance._payment_email_sent = False
     if not instance.triggers_payment_email:
         return
+    if not (
+        instance.has_dirty_fields(Activity.EMAIL_FIELDS)
+        or instance.payment_plan.has_dirty_fields(PaymentSchedule.EMAIL_FIELDS)
+    ):
+        return
     send_activity_updated_email(instance)
+    # The payment plan is often saved right after its activity, which
+    # shouldn't send another email until the activity is saved again.
+    instance._payment_email_sent = True
+
+
+@receiver(
+    post_save,
+    sender=PaymentSchedule,
+    dispatch_uid="send_activity_payment_email_on_paymentschedule_save",
+)
+def send_activity_payment_email_on_paymentschedule_save(
+    sender, instance, created, **kwargs
+):
+    """Send payment email when the payment plan of an Activity is saved.
+
+    The REST API saves the payment plan after its activity, so changes to
+    the payment plan alone are only seen here.
+    """
+    if created or not instance.is_tracking_dirty_fields():
+        return
+    activity = instance.activity
+    if not activity:
+        return
+    if getattr(activity, "_payment_email_sent", False):
+        return
+    if not instance.has_dirty_fields(PaymentSchedule.EMAIL_FIELDS):
+        return
+    if not activity.triggers_payment_email:
+        return
+    send_activity_updated_email(activity)
+
+
+@receiver(
+    post_save,
+    sender=Activity,
+    dispatch_uid="update_modification_chain_on_save",
+)
+def update_modification_chain_on_save(sender, instance, created, **kwargs):
+    """Update the chain of modifications when modifies changes."""
+    if created and not instance.modifies_id:
+        return
+    if created or instance.has_dirty_fields(["modifies_id"]):
+        ActivityModification.update_chain(instance)
+
+
+@receiver(
+    post_save,
+    sender=Activity,
+    dispatch_uid="refresh_year_totals_on_activity_save",
+)
+def refresh_year_totals_on_activity_save(sender, instance, **kwargs):
+    """Refresh the year totals when the status or modifications change.
+
+    This must run after the chain of modifications is updated.
+    """
+    if kwargs.get("raw"):
+        return
+    if instance.has_dirty_fields(["status", "modifies_id"]):
+        refresh_year_totals([instance.pk])
+
+
+@receiver(
+    post_delete,
+    sender=Activity,
+    dispatch_uid="refresh_year_totals_on_activity_delete",
+)
+def refresh_year_totals_on_activity_delete(sender, instance, **kwargs):
+    """Refresh the year totals of the activity a deleted one modified."""
+    if instance.modifies_id:
+        refresh_year_totals([instance.modifies_id])
+
+
+@receiver(
+    [post_save, post_delete],
+    sender=Payment,
+    dispatch_uid="refresh_year_totals_on_payment_change",
+)
+def refresh_year_totals_on_payment_change(sender, instance, **kwargs):
+    """Refresh the year totals of the activity of a changed payment."""
+    if kwargs.get("raw"):
+        return
+    refresh_year_totals(
+        PaymentSchedule.objects.filter(
+            pk=instance.payment_schedule_id, activity__isnull=False
+        ).values_list("activity_id", flat=True)
+    )
 
 
 @receiver(
@@ -109,6 +214,51 @@ def send_activity_payment_email_on_delete(sender, instance, **kwargs):
     send_activity_deleted_email(instance)
 
 
+@receiver(
+    post_save,
+    sender=Activity,
+    dispatch_uid="refresh_appropriation_status_on_activity_save",
+)
+def refresh_appropriation_status_on_activity_save(sender, instance, **kwargs):
+    """Refresh the stored appropriation status and case expiry.
+
+    This is only done when a field they are calculated from changed. An
+    appropriation the activity was moved away from is refreshed as well.
+    """
+    if kwargs.get("raw"):
+        return
+    if not instance.has_dirty_fields(
+        ["status", "end_date", "activity_type", "appropriation_id"]
+    ):
+        return
+    appropriation = instance.appropriation
+    appropriation.refresh_status()
+    appropriation.case.refresh_expired()
+
+    previous_appropriation_id = instance.get_loaded_value("appropriation_id")
+    if previous_appropriation_id not in (None, appropriation.pk):
+        previous_appropriation = Appropriation.objects.filter(
+            pk=previous_appropriation_id
+        ).first()
+        if previous_appropriation:
+            previous_appropriation.refresh_status()
+            previous_appropriation.case.refresh_expired()
+
+
+@receiver(
+    post_delete,
+    sender=Activity,
+    dispatch_uid="refresh_appropriation_status_on_activity_delete",
+)
+def refresh_appropriation_status_on_activity_delete(
+    sender, instance, **kwargs
+):
+    """Refresh the stored appropriation status and case expiry."""
+    appropriation = instance.appropriation
+    appropriation.refresh_status()
+    appropriation.case.refresh_expired()
+
+
 @receiver(post_save, sender=Rate, dispatch_uid="on_save_rate")
 def set_needs_recalculation_on_save_rate(sender, instance, created, **kwargs):
     """Set "needs update" flag when changing a rate."""
@@ -117,12 +267,60 @@ def set_needs_recalculation_on_save_rate(sender, instance, created, **kwargs):
         instance.refresh_from_db()
 
 
+@receiver(
+    [post_save, post_delete],
+    sender=RatePerDate,
+    dispatch_uid="invalidate_rate_timeline_on_rate_per_date_change",
+)
+def invalidate_rate_timeline_on_rate_per_date_change(
+    sender, instance, **kwargs
+):
+    """Invalidate the compiled rate timeline when a period changes."""
+    VariableRate.invalidate_timeline(instance.main_rate_id)
+
+
+@receiver(
+    [post_save, post_delete],
+    sender=SectionInfo,
+    dispatch_uid="invalidate_account_resolver_on_section_info_change",
+)
+@receiver(
+    [post_save, post_delete],
+    sender=ActivityCategory,
+    dispatch_uid="invalidate_account_resolver_on_activity_category_change",
+)
+@receiver(
+    [post_save, post_delete],
+    sender=AccountAliasMapping,
+    dispatch_uid="invalidate_account_resolver_on_account_alias_change",
+)
+def invalidate_account_resolver_on_change(sender, instance, **kwargs):
+    """Invalidate the account resolver when the account tables change."""
+    invalidate_account_resolver()
+
+
+@receiver(
+    [post_save, post_delete],
+    sender=PaymentDateExclusion,
+    dispatch_uid="invalidate_payment_date_calendar_on_exclusion_change",
+)
+def invalidate_payment_date_calendar_on_exclusion_change(
+    sender, instance, **kwargs
+):
+    """Invalidate the payment date calendar when an exclusion changes."""
+    invalidate_payment_date_calendar()
+
+
 @receiver(post_save, sender=Price, dispatch_uid="on_save_price")
 def save_payment_schedule_on_save_price(sender, instance, created, **kwargs):
     """Save payment schedule too when saving price."""
     if instance.payment_schedule:
         generate_payments_on_post_save(
-            PaymentSchedule, instance.payment_schedule, created, **kwargs
+            PaymentSchedule,
+            instance.payment_schedule,
+            created,
+            force=True,
+            **kwargs,
         )
         instance.payment_schedule.save()
 
@@ -132,11 +330,22 @@ def save_payment_schedule_on_save_price(sender, instance, created, **kwargs):
     sender=PaymentSchedule,
     dispatch_uid="generate_payments_on_post_save",
 )
-def generate_payments_on_post_save(sender, instance, created, **kwargs):
-    """Generate payments for activity before saving."""
+@batch_year_totals()
+def generate_payments_on_post_save(
+    sender, instance, created, force=False, **kwargs
+):
+    """Generate payments for activity before saving.
+
+    Nothing is done if neither the schedule nor its activity changed in a
+    way that affects the payments, unless forced.
+    """
+    if not (created or force or instance.has_payment_changes()):
+        return
+
     if instance.is_ready_to_generate_payments():
 
         activity = instance.activity
+        refresh_year_totals([activity.pk])
 
         vat_factor = activity.vat_factor
 
@@ -149,11 +358,10 @@ def generate_payments_on_post_save(sender, instance, created, **kwargs):
                     activity.start_date, activity.end_date, vat_factor
                 )
             elif instance.payments.exists():
-                # If status is either STATUS_DRAFT or STATUS_EXPECTED we delete
-                # and regenerate payments.
+                # If status is either STATUS_DRAFT or STATUS_EXPECTED we bring
+                # the payments in line with the schedule.
                 if activity.status in [STATUS_DRAFT, STATUS_EXPECTED]:
-                    instance.payments.all().delete()
-                    instance.generate_payments(
+                    instance.update_payments(
                         activity.start_date, activity.end_date, vat_factor
                     )
                 else:
@@ -3,7 +3,7 @@ from unittest import mock
 from django.core.management import call_command
 from django.test import TestCase, override_settings
 
-from core.decorators import log_to_prometheus
+from core.decorators import log_to_prometheus, log_chunk_to_prometheus
 
 
 class TestLogToPrometheus(TestCase):
@@ -63,3 +63,30 @@ class TestLogToPrometheus(TestCase):
             "os2bos_raises_exception_last_success"
         )
         self.assertIsNone(last_success_value)
+
+
+class TestLogChunkToPrometheus(TestCase):
+    @override_settings(PUSHGATEWAY_HOST="pushgateway:9091")
+    @mock.patch("core.decorators.pushadd_to_gateway")
+    def test_pushgateway_host_chunk_logged(self, pushadd_mock):
+        log_chunk_to_prometheus("batch_job", 1.5, 500)
+
+        pushadd_call = pushadd_mock.call_args_list[0]
+        self.assertEqual(pushadd_call[1]["job"], "batch_job")
+        registry = pushadd_call[1]["registry"]
+        self.assertEqual(
+            registry.get_sample_value(
+                "os2bos_batch_job_chunk_duration_seconds"
+            ),
+            1.5,
+        )
+        self.assertEqual(
+            registry.get_sample_value("os2bos_batch_job_chunk_rows"), 500
+        )
+
+    @override_settings(PUSHGATEWAY_HOST="")
+    @mock.patch("core.decorators.pushadd_to_gateway")
+    def test_pushgateway_host_setting_not_set(self, pushadd_mock):
+        log_chunk_to_prometheus("batch_job", 1.5, 500)
+
+        self.assertFalse(pushadd_mock.called)
@@ -1,5 +1,7 @@
+from io import StringIO
 from unittest import mock
 from datetime import datetime, date, timedelta
+from decimal import Decimal
 
 from django.core.management import call_command
 from django.test import TestCase, override_settings
@@ -9,6 +11,7 @@ from django.db.utils import OperationalError
 from django.core import mail
 
 from freezegun import freeze_time
+from lxml import etree
 
 from core.models import (
     MAIN_ACTIVITY,
@@ -16,13 +19,28 @@ from core.models import (
     STATUS_GRANTED,
     STATUS_EXPECTED,
     INVOICE,
+    CASH,
+    Payment,
     PaymentSchedule,
     ActivityDetails,
     ServiceProvider,
     Section,
     AccountAliasMapping,
     ActivityCategory,
+    JobCheckpoint,
+    Rate,
+    ActivityYearTotal,
+    DSTPayload,
+    DSTPayloadJob,
+    AppropriationDispatch,
+    HANDICAP,
+    PREVENTATIVE_MEASURES,
+    JOB_DONE,
+    JOB_FAILED,
+    JOB_QUEUED,
+    JOB_RUNNING,
 )
+from core.managers import PaymentScheduleQuerySet
 from core.tests.testing_utils import (
     BasicTestMixin,
     create_payment_schedule,
@@ -32,6 +50,7 @@ from core.tests.testing_utils import (
     create_appropriation,
     create_activity,
     create_section,
+    create_related_person,
 )
 
 
@@ -87,6 +106,101 @@ class TestMarkPaymentsPaid(TestCase, BasicTestMixin):
         self.assertEqual(payment.paid_date, today)
         self.assertEqual(payment.paid_amount, payment.amount)
 
+    def test_mark_payments_paid_saves_account_and_history(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        payment_schedule = create_payment_schedule(
+            activity=activity, fictive=True
+        )
+        today = timezone.now().date()
+        payment = create_payment(payment_schedule, date=today)
+        account_string = payment.account_string
+        history_count = payment.history.count()
+
+        call_command("mark_payments_paid")
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.saved_account_string, account_string)
+        self.assertEqual(payment.history.count(), history_count + 1)
+        self.assertTrue(payment.history.latest().paid)
+
+    @mock.patch("core.management.commands.mark_payments_paid.logger")
+    def test_mark_payments_paid_dry_run(self, logger_mock):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        payment_schedule = create_payment_schedule(
+            activity=activity, fictive=True
+        )
+        today = timezone.now().date()
+        payment = create_payment(payment_schedule, date=today)
+
+        stdout = StringIO()
+        call_command("mark_payments_paid", "--dry-run", stdout=stdout)
+
+        payment.refresh_from_db()
+        self.assertFalse(payment.paid)
+        message = (
+            f"Dry run: 1 payment(s) with a total amount of 500.00 "
+            f"would be marked paid on {today}"
+        )
+        logger_mock.info.assert_called_with(message)
+        self.assertEqual(stdout.getvalue(), message + "\n")
+
+    @mock.patch("core.management.commands.mark_payments_paid.logger")
+    def test_mark_payments_paid_invalid_payment_method(self, logger_mock):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        payment_schedule = create_payment_schedule(
+            activity=activity,
+            recipient_type=PaymentSchedule.COMPANY,
+            payment_method=INVOICE,
+        )
+        today = timezone.now().date()
+        # Cash payments to companies are not allowed, so bypass save.
+        (payment,) = Payment.objects.bulk_create(
+            [
+                Payment(
+                    recipient_id="Test",
+                    recipient_name="Test",
+                    recipient_type=PaymentSchedule.COMPANY,
+                    payment_method=CASH,
+                    date=today + timedelta(days=100),
+                    amount=Decimal("500"),
+                    payment_schedule=payment_schedule,
+                )
+            ]
+        )
+
+        call_command(
+            "mark_payments_paid",
+            "--date=" + payment.date.strftime("%Y%m%d"),
+        )
+
+        payment.refresh_from_db()
+        self.assertFalse(payment.paid)
+        logger_mock.error.assert_called_with(
+            f"1 payment(s) with ids: [{payment.pk}] can't be marked paid "
+            f"on {payment.date}"
+        )
+
     @mock.patch("core.management.commands.mark_payments_paid.logger")
     def test_mark_payments_paid_wrong_date(self, logger_mock):
         payment_schedule = create_payment_schedule(fictive=True)
@@ -178,6 +292,363 @@ class TestRenewPayments(TestCase, BasicTestMixin):
 
         self.assertEqual(payment_schedule.payments.count(), 36)
 
+    def test_renew_payments_not_needed(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+
+        # Should generate payments to 2019-12-01.
+        with freeze_time("2018-01-01"):
+            activity = create_activity(
+                case=case,
+                appropriation=appropriation,
+                activity_type=MAIN_ACTIVITY,
+                status=STATUS_GRANTED,
+                start_date=date(year=2018, month=1, day=1),
+                end_date=None,
+            )
+            payment_schedule = create_payment_schedule(
+                payment_frequency=PaymentSchedule.MONTHLY,
+                payment_type=PaymentSchedule.RUNNING_PAYMENT,
+                activity=activity,
+            )
+
+        # Generated payments are still 6 months ahead.
+        with freeze_time("2019-05-01"):
+            call_command("renew_payments")
+
+        self.assertEqual(payment_schedule.payments.count(), 24)
+
+    @mock.patch("core.management.commands.renew_payments.connections")
+    @mock.patch("core.management.commands.renew_payments.ProcessPoolExecutor")
+    def test_renew_payments_workers(self, executor_mock, connections_mock):
+        # Run the chunks in this process, where the test data is visible.
+        executor_mock.return_value.__enter__.return_value.map = map
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+
+        payment_schedules = []
+        with freeze_time("2018-01-01"):
+            for details_id in ["111111", "222222", "333333"]:
+                activity = create_activity(
+                    case=case,
+                    appropriation=appropriation,
+                    activity_type=SUPPL_ACTIVITY,
+                    status=STATUS_GRANTED,
+                    start_date=date(year=2018, month=1, day=1),
+                    end_date=None,
+                    details=ActivityDetails.objects.create(
+                        activity_id=details_id,
+                        name=details_id,
+                        max_tolerance_in_percent=10,
+                        max_tolerance_in_dkk=1000,
+                    ),
+                )
+                payment_schedules.append(
+                    create_payment_schedule(
+                        payment_frequency=PaymentSchedule.MONTHLY,
+                        payment_type=PaymentSchedule.RUNNING_PAYMENT,
+                        activity=activity,
+                    )
+                )
+
+        with freeze_time("2019-12-01"):
+            call_command("renew_payments", "--workers=2", "--batch-size=5")
+
+        executor_mock.assert_called_once()
+        self.assertEqual(executor_mock.call_args.kwargs["max_workers"], 2)
+        connections_mock.close_all.assert_called_once()
+        for payment_schedule in payment_schedules:
+            self.assertEqual(payment_schedule.payments.count(), 36)
+
+
+class TestRefreshExpired(TestCase, BasicTestMixin):
+    @classmethod
+    def setUpTestData(cls):
+        cls.basic_setup()
+
+    def test_refresh_expired(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        with freeze_time("2020-01-01"):
+            create_activity(
+                case=case,
+                appropriation=appropriation,
+                activity_type=MAIN_ACTIVITY,
+                status=STATUS_GRANTED,
+                start_date=date(year=2020, month=1, day=1),
+                end_date=date(year=2020, month=1, day=31),
+            )
+        appropriation.refresh_from_db()
+        case.refresh_from_db()
+        self.assertFalse(appropriation.expired)
+        self.assertFalse(case.expired)
+
+        with freeze_time("2020-02-01"):
+            call_command("refresh_expired")
+
+        appropriation.refresh_from_db()
+        case.refresh_from_db()
+        self.assertTrue(appropriation.expired)
+        self.assertTrue(case.expired)
+
+
+class TestRebuildYearTotals(TestCase, BasicTestMixin):
+    @classmethod
+    def setUpTestData(cls):
+        cls.basic_setup()
+
+    def test_rebuild_year_totals(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+            start_date=date(year=2020, month=1, day=1),
+            end_date=date(year=2020, month=1, day=10),
+        )
+        create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_amount=Decimal("100"),
+            activity=activity,
+        )
+        ActivityYearTotal.objects.all().delete()
+
+        call_command("rebuild_year_totals")
+
+        year_total = ActivityYearTotal.objects.get(activity=activity)
+        self.assertEqual(year_total.year, 2020)
+        self.assertEqual(year_total.granted_sum, Decimal("1000"))
+        self.assertEqual(year_total.expected_sum, Decimal("1000"))
+
+
+class TestRunDSTPayloadJobs(TestCase, BasicTestMixin):
+    @classmethod
+    def setUpTestData(cls):
+        cls.basic_setup()
+
+    def test_run_dst_payload_jobs(self):
+        now = timezone.now().date()
+        case = create_case(self.case_worker, self.municipality, self.district)
+        create_related_person(case, relation_type="far")
+        section = create_section(dst_code="123")
+        appropriation = create_appropriation(
+            sbsys_id="XXX-YYY", case=case, section=section
+        )
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+            start_date=now,
+            end_date=now + timedelta(days=10),
+            appropriation_date=now,
+        )
+        create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            activity=activity,
+        )
+        job = DSTPayloadJob.objects.create(
+            dst_type=PREVENTATIVE_MEASURES, test=False
+        )
+        job.sections.add(section)
+
+        call_command("run_dst_payload_jobs")
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, JOB_DONE)
+        self.assertIsNotNone(job.finished)
+        content = b"".join(job.iter_content())
+        doc = etree.fromstring(content)
+        self.assertEqual(
+            len(
+                doc.xpath(
+                    "x:ForanstaltningStrukturSamling/"
+                    "x:ForanstaltningStruktur",
+                    namespaces={
+                        "x": "http://rep.oio.dk/dst.dk/xml/schemas/2010/04/16/"
+                    },
+                )
+            ),
+            1,
+        )
+        # Payloads which are not tests are saved for later use, and only
+        # stored there.
+        self.assertEqual(job.payload, DSTPayload.objects.get())
+        self.assertIsNone(job.content)
+        self.assertEqual(job.payload.name, job.name)
+        self.assertEqual(b"".join(job.payload.iter_content()), content)
+
+    def test_run_dst_payload_jobs_failed(self):
+        job = DSTPayloadJob.objects.create(dst_type=HANDICAP)
+
+        with mock.patch(
+            "core.models.stream_dst_payload_handicap",
+            side_effect=Exception("Fejl"),
+        ):
+            call_command("run_dst_payload_jobs")
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, JOB_FAILED)
+        self.assertEqual(job.error, "Fejl")
+        self.assertIsNone(job.content)
+
+    def test_run_dst_payload_jobs_stale(self):
+        stale_job = DSTPayloadJob.objects.create(
+            dst_type=HANDICAP,
+            status=JOB_RUNNING,
+            started=timezone.now() - timedelta(hours=2),
+            heartbeat=timezone.now() - timedelta(hours=2),
+        )
+        # A job running for long is not stale while it has a heartbeat.
+        running_job = DSTPayloadJob.objects.create(
+            dst_type=HANDICAP,
+            status=JOB_RUNNING,
+            started=timezone.now() - timedelta(hours=2),
+            heartbeat=timezone.now(),
+        )
+
+        call_command("run_dst_payload_jobs")
+
+        stale_job.refresh_from_db()
+        self.assertEqual(stale_job.status, JOB_FAILED)
+        running_job.refresh_from_db()
+        self.assertEqual(running_job.status, JOB_RUNNING)
+
+    def test_run_dst_payload_job_failed_while_running(self):
+        section = create_section()
+        job = DSTPayloadJob.objects.create(
+            dst_type=PREVENTATIVE_MEASURES, test=False
+        )
+        job.sections.add(section)
+        job = DSTPayloadJob.objects.claim_next()
+        # The job is failed as stale while it runs.
+        DSTPayloadJob.objects.fail_stale(timezone.now() + timedelta(hours=1))
+
+        with self.assertRaises(ValueError):
+            job.run()
+        job.fail("Fejl")
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, JOB_FAILED)
+        self.assertEqual(job.error, "Jobbet blev afbrudt")
+        self.assertIsNone(job.content)
+        self.assertFalse(DSTPayload.objects.exists())
+
+    def test_run_dst_payload_job_heartbeat(self):
+        job = DSTPayloadJob.objects.create(dst_type=HANDICAP)
+        job.sections.add(create_section())
+        with freeze_time("2022-01-01"):
+            job = DSTPayloadJob.objects.claim_next()
+
+        with mock.patch.object(
+            DSTPayloadJob, "HEARTBEAT_INTERVAL", timedelta(0)
+        ):
+            job.run()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, JOB_DONE)
+        self.assertGreater(job.heartbeat, job.started)
+
+    def test_claim_next_skips_claimed_jobs(self):
+        first_job = DSTPayloadJob.objects.create(dst_type=HANDICAP)
+        second_job = DSTPayloadJob.objects.create(dst_type=HANDICAP)
+
+        self.assertEqual(DSTPayloadJob.objects.claim_next(), first_job)
+        self.assertEqual(DSTPayloadJob.objects.claim_next(), second_job)
+        self.assertIsNone(DSTPayloadJob.objects.claim_next())
+        first_job.refresh_from_db()
+        self.assertEqual(first_job.status, JOB_RUNNING)
+        self.assertFalse(
+            DSTPayloadJob.objects.filter(status=JOB_QUEUED).exists()
+        )
+
+
+class TestSendAppropriations(TestCase, BasicTestMixin):
+    @classmethod
+    def setUpTestData(cls):
+        cls.basic_setup()
+
+    def setUp(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        self.appropriation = create_appropriation(
+            sbsys_id="XXX-YYY", case=case
+        )
+        self.activity = create_activity(
+            case=case,
+            appropriation=self.appropriation,
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        self.dispatch = AppropriationDispatch.objects.create(
+            appropriation=self.appropriation
+        )
+        self.dispatch.included_activities.add(self.activity)
+
+    @mock.patch("core.models.send_appropriation_files")
+    @mock.patch("core.models.render_appropriation")
+    def test_send_appropriations(
+        self, render_appropriation_mock, send_appropriation_files_mock
+    ):
+        attachments = [("bevilling.pdf", b"pdf", "application/pdf")]
+        render_appropriation_mock.return_value = attachments
+
+        call_command("send_appropriations")
+
+        self.dispatch.refresh_from_db()
+        self.assertEqual(self.dispatch.status, JOB_DONE)
+        self.assertIsNotNone(self.dispatch.sent)
+        (
+            appropriation,
+            included_activities,
+        ) = render_appropriation_mock.call_args[0]
+        self.assertEqual(appropriation, self.appropriation)
+        self.assertEqual(list(included_activities), [self.activity])
+        send_appropriation_files_mock.assert_called_once_with(attachments)
+
+    @mock.patch("core.models.send_appropriation_files")
+    @mock.patch(
+        "core.models.render_appropriation", side_effect=Exception("Fejl")
+    )
+    def test_send_appropriations_failed(
+        self, render_appropriation_mock, send_appropriation_files_mock
+    ):
+        call_command("send_appropriations")
+
+        self.dispatch.refresh_from_db()
+        # The dispatch is retried later.
+        self.assertEqual(self.dispatch.status, JOB_QUEUED)
+        self.assertEqual(self.dispatch.attempts, 1)
+        self.assertEqual(self.dispatch.error, "Fejl")
+        self.assertGreater(self.dispatch.next_attempt, timezone.now())
+        send_appropriation_files_mock.assert_not_called()
+
+        # The dispatch is given up after too many attempts.
+        self.dispatch.attempts = AppropriationDispatch.MAX_ATTEMPTS - 1
+        self.dispatch.next_attempt = timezone.now()
+        self.dispatch.save()
+
+        call_command("send_appropriations")
+
+        self.dispatch.refresh_from_db()
+        self.assertEqual(self.dispatch.status, JOB_FAILED)
+        self.assertIsNone(self.dispatch.sent)
+
+    @mock.patch("core.models.send_appropriation_files")
+    @mock.patch("core.models.render_appropriation")
+    def test_send_appropriations_stale(
+        self, render_appropriation_mock, send_appropriation_files_mock
+    ):
+        self.dispatch.status = JOB_RUNNING
+        self.dispatch.started = timezone.now() - timedelta(hours=2)
+        self.dispatch.save()
+
+        call_command("send_appropriations")
+
+        self.dispatch.refresh_from_db()
+        self.assertEqual(self.dispatch.status, JOB_DONE)
+
 
 class TestEnsureDbConnection(TestCase):
     def test_ensure_db_connection_success(self):
@@ -885,6 +1356,180 @@ class TestRecalculateOnChangedRate(TestCase, BasicTestMixin):
             payment.refresh_from_db()
             self.assertEqual(payment.amount, 15)
 
+    def create_rate_payment_schedules(self, rate, count):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        payment_schedules = []
+        for i in range(count):
+            appropriation = create_appropriation(
+                case=case, sbsys_id=f"XXX-YYY-{i}"
+            )
+            activity = create_activity(
+                case=case,
+                appropriation=appropriation,
+                activity_type=MAIN_ACTIVITY,
+                status=STATUS_GRANTED,
+                start_date=date(year=2020, month=1, day=1),
+                end_date=date(year=2020, month=3, day=31),
+            )
+            payment_schedules.append(
+                create_payment_schedule(
+                    payment_frequency=PaymentSchedule.MONTHLY,
+                    payment_type=PaymentSchedule.RUNNING_PAYMENT,
+                    payment_units=1,
+                    payment_amount=None,
+                    activity=activity,
+                    payment_cost_type=PaymentSchedule.GLOBAL_RATE_PRICE,
+                    payment_rate=rate,
+                )
+            )
+        return payment_schedules
+
+    def test_recalculate_on_changed_rate_in_batches(self):
+        rate = create_rate()
+        rate.set_rate_amount(10)
+        with freeze_time("2020-01-01"):
+            payment_schedules = self.create_rate_payment_schedules(rate, 3)
+            rate.set_rate_amount(15)
+
+            call_command("recalculate_on_changed_rate", batch_size=2)
+
+        for payment_schedule in payment_schedules:
+            self.assertEqual(
+                set(
+                    payment_schedule.payments.values_list("amount", flat=True)
+                ),
+                {15},
+            )
+        rate.refresh_from_db()
+        self.assertFalse(rate.needs_recalculation)
+        self.assertFalse(JobCheckpoint.objects.exists())
+
+    def test_recalculate_on_changed_rate_resumes_from_checkpoint(self):
+        rate = create_rate()
+        rate.set_rate_amount(10)
+        with freeze_time("2020-01-01"):
+            first, second = self.create_rate_payment_schedules(rate, 2)
+            rate.set_rate_amount(15)
+            JobCheckpoint.objects.create(
+                name="recalculate_on_changed_rate",
+                last_id=first.id,
+                scope=[rate.id],
+            )
+
+            call_command("recalculate_on_changed_rate", batch_size=1)
+
+        self.assertEqual(
+            set(first.payments.values_list("amount", flat=True)), {10}
+        )
+        self.assertEqual(
+            set(second.payments.values_list("amount", flat=True)), {15}
+        )
+        self.assertFalse(JobCheckpoint.objects.exists())
+
+    def test_recalculate_on_changed_rate_restarts_on_changed_rates(self):
+        rate = create_rate()
+        rate.set_rate_amount(10)
+        other_rate = create_rate(name="other rate")
+        other_rate.set_rate_amount(20)
+        with freeze_time("2020-01-01"):
+            first, second = self.create_rate_payment_schedules(rate, 2)
+            PaymentSchedule.objects.filter(pk=first.pk).update(
+                payment_rate=other_rate
+            )
+            rate.set_rate_amount(15)
+            # The other rate is flagged after the run was interrupted.
+            JobCheckpoint.objects.create(
+                name="recalculate_on_changed_rate",
+                last_id=second.id,
+                scope=[rate.id],
+            )
+            other_rate.set_rate_amount(25)
+
+            call_command("recalculate_on_changed_rate")
+
+        self.assertEqual(
+            set(first.payments.values_list("amount", flat=True)), {25}
+        )
+        other_rate.refresh_from_db()
+        self.assertFalse(other_rate.needs_recalculation)
+        self.assertFalse(JobCheckpoint.objects.exists())
+
+    def test_recalculate_on_changed_rate_keeps_rates_flagged_during_run(
+        self,
+    ):
+        rate = create_rate()
+        rate.set_rate_amount(10)
+        other_rate = create_rate(name="other rate")
+        other_rate.set_rate_amount(20)
+        Rate.objects.update(needs_recalculation=False)
+        with freeze_time("2020-01-01"):
+            self.create_rate_payment_schedules(rate, 1)
+            rate.set_rate_amount(15)
+            recalculate_prices = PaymentScheduleQuerySet.recalculate_prices
+
+            def flag_other_rate(queryset):
+                Rate.objects.filter(pk=other_rate.pk).update(
+                    needs_recalculation=True
+                )
+                return recalculate_prices(queryset)
+
+            with mock.patch.object(
+                PaymentScheduleQuerySet,
+                "recalculate_prices",
+                flag_other_rate,
+            ):
+                call_command("recalculate_on_changed_rate")
+
+        rate.refresh_from_db()
+        self.assertFalse(rate.needs_recalculation)
+        other_rate.refresh_from_db()
+        self.assertTrue(other_rate.needs_recalculation)
+
+    def test_recalculate_on_changed_rate_restart(self):
+        rate = create_rate()
+        rate.set_rate_amount(10)
+        with freeze_time("2020-01-01"):
+            first, second = self.create_rate_payment_schedules(rate, 2)
+            rate.set_rate_amount(15)
+            JobCheckpoint.objects.create(
+                name="recalculate_on_changed_rate", last_id=second.id
+            )
+
+            call_command("recalculate_on_changed_rate", restart=True)
+
+        self.assertEqual(
+            set(first.payments.values_list("amount", flat=True)), {15}
+        )
+
+    @override_settings(PUSHGATEWAY_HOST="pushgateway:9091")
+    @mock.patch("core.decorators.pushadd_to_gateway")
+    def test_recalculate_on_changed_rate_chunk_metrics(self, pushadd_mock):
+        rate = create_rate()
+        rate.set_rate_amount(10)
+        with freeze_time("2020-01-01"):
+            self.create_rate_payment_schedules(rate, 3)
+            rate.set_rate_amount(15)
+
+            call_command("recalculate_on_changed_rate", batch_size=2)
+
+        chunk_registries = [
+            call[1]["registry"]
+            for call in pushadd_mock.call_args_list
+            if call[1]["registry"].get_sample_value(
+                "os2bos_recalculate_on_changed_rate_chunk_rows"
+            )
+            is not None
+        ]
+        self.assertEqual(
+            [
+                registry.get_sample_value(
+                    "os2bos_recalculate_on_changed_rate_chunk_rows"
+                )
+                for registry in chunk_registries
+            ],
+            [6, 3],
+        )
+
     @mock.patch("core.management.commands.recalculate_on_changed_rate.logger")
     @mock.patch("core.models.PaymentSchedule.objects.filter")
     def test_recalculate_on_changed_rate_error(
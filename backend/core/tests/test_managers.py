@@ -11,7 +11,9 @@ from decimal import Decimal
 
 from freezegun import freeze_time
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from core.tests.testing_utils import (
@@ -32,9 +34,12 @@ from core.models import (
     MAIN_ACTIVITY,
     SUPPL_ACTIVITY,
     STATUS_GRANTED,
+    STATUS_EXPECTED,
     CASH,
     Activity,
+    ActivityYearTotal,
     Appropriation,
+    get_account_resolver,
 )
 
 
@@ -79,6 +84,98 @@ class PaymentQuerySetTestCase(TestCase, BasicTestMixin):
 
         self.assertIn(payment, Payment.objects.in_year())
 
+    def test_applicable(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case,
+            appropriation,
+            start_date=date(year=2020, month=1, day=1),
+            end_date=date(year=2020, month=1, day=10),
+            status=STATUS_GRANTED,
+        )
+        create_payment_schedule(activity=activity)
+        modifying_activity = create_activity(
+            case,
+            appropriation,
+            start_date=date(year=2020, month=1, day=4),
+            end_date=date(year=2020, month=1, day=10),
+            status=STATUS_GRANTED,
+            modifies=activity,
+        )
+        create_payment_schedule(activity=modifying_activity)
+        expected_activity = create_activity(
+            case,
+            appropriation,
+            start_date=date(year=2020, month=1, day=8),
+            end_date=date(year=2020, month=1, day=10),
+            status=STATUS_EXPECTED,
+            modifies=modifying_activity,
+        )
+        create_payment_schedule(activity=expected_activity)
+
+        payments = Payment.objects.applicable()
+
+        self.assertEqual(
+            payments.filter(payment_schedule__activity=activity).count(), 3
+        )
+        self.assertEqual(
+            payments.filter(
+                payment_schedule__activity=modifying_activity
+            ).count(),
+            4,
+        )
+        self.assertEqual(
+            payments.filter(
+                payment_schedule__activity=expected_activity
+            ).count(),
+            3,
+        )
+
+    @freeze_time("2020-01-01")
+    def test_expected_payments_for_report_list(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case,
+            appropriation,
+            start_date=date(year=2020, month=1, day=1),
+            end_date=date(year=2020, month=1, day=10),
+            status=STATUS_GRANTED,
+        )
+        create_payment_schedule(activity=activity)
+        expected_activity = create_activity(
+            case,
+            appropriation,
+            start_date=date(year=2020, month=1, day=6),
+            end_date=date(year=2020, month=1, day=10),
+            status=STATUS_EXPECTED,
+            modifies=activity,
+        )
+        create_payment_schedule(activity=expected_activity)
+
+        with self.assertNumQueries(1):
+            payments = list(
+                Payment.objects.expected_payments_for_report_list().iterator()
+            )
+
+        self.assertEqual(
+            sorted(
+                (payment.payment_schedule.activity.pk, payment.date)
+                for payment in payments
+            ),
+            sorted(
+                [
+                    (activity.pk, date(year=2020, month=1, day=day))
+                    for day in range(1, 6)
+                ]
+                + [
+                    (expected_activity.pk, date(year=2020, month=1, day=day))
+                    for day in range(6, 11)
+                ]
+            ),
+        )
+
     def test_paid_date_or_date_gte(self):
         case = create_case(self.case_worker, self.municipality, self.district)
         appropriation = create_appropriation(case=case)
@@ -362,6 +459,109 @@ class PaymentQuerySetTestCase(TestCase, BasicTestMixin):
             expected,
         )
 
+    def test_monthly_amounts_by_activity(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        # 4 payments of 500DKK.
+        main_activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+            start_date=date(year=2019, month=2, day=27),
+            end_date=date(year=2019, month=3, day=2),
+        )
+        create_payment_schedule(activity=main_activity)
+        # 2 payments of 500DKK.
+        suppl_activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            activity_type=SUPPL_ACTIVITY,
+            status=STATUS_GRANTED,
+            start_date=date(year=2019, month=3, day=1),
+            end_date=date(year=2019, month=3, day=2),
+        )
+        create_payment_schedule(activity=suppl_activity)
+
+        with self.assertNumQueries(1):
+            amounts = Payment.objects.monthly_amounts_by_activity()
+        self.assertEqual(
+            amounts,
+            {
+                (main_activity.pk, date(2019, 2, 1)): Decimal("1000"),
+                (main_activity.pk, date(2019, 3, 1)): Decimal("1000"),
+                (suppl_activity.pk, date(2019, 3, 1)): Decimal("1000"),
+            },
+        )
+        self.assertEqual(
+            Payment.objects.monthly_payment_plans(),
+            {
+                main_activity.pk: list(main_activity.monthly_payment_plan),
+                suppl_activity.pk: list(suppl_activity.monthly_payment_plan),
+            },
+        )
+        self.assertEqual(
+            suppl_activity.monthly_payment_plan,
+            [{"date_month": "2019-03", "amount": Decimal("1000")}],
+        )
+
+    def test_payable(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        granted_activity = create_activity(
+            case, appropriation, status=STATUS_GRANTED
+        )
+        create_payment_schedule(activity=granted_activity)
+        expected_activity = create_activity(
+            case, appropriation, status=STATUS_EXPECTED
+        )
+        create_payment_schedule(activity=expected_activity)
+
+        payable = Payment.objects.payable()
+
+        self.assertEqual(payable.count(), 10)
+        self.assertTrue(
+            all(
+                payment.payment_schedule.activity == granted_activity
+                for payment in payable
+            )
+        )
+
+    def test_mark_paid(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(case, appropriation, status=STATUS_GRANTED)
+        payment_schedule = create_payment_schedule(activity=activity)
+        payments = payment_schedule.payments.order_by("date")
+        paid_date = date(2019, 1, 11)
+        first_payment_pk = payments[0].pk
+        # The account settings are stored on first use.
+        PaymentSchedule.get_account_settings()
+        get_account_resolver()
+
+        with CaptureQueriesContext(connection) as single_payment:
+            payment_ids = payments.filter(pk=first_payment_pk).mark_paid(
+                paid_date
+            )
+        self.assertEqual(payment_ids, [first_payment_pk])
+
+        # Marking more payments paid doesn't take more queries.
+        with CaptureQueriesContext(connection) as more_payments:
+            payment_ids = payments.filter(paid=False).mark_paid(paid_date)
+        self.assertEqual(len(payment_ids), 9)
+        self.assertEqual(
+            len(more_payments.captured_queries),
+            len(single_payment.captured_queries),
+        )
+        for payment in payments:
+            self.assertTrue(payment.paid)
+            self.assertEqual(payment.paid_date, paid_date)
+            self.assertEqual(payment.paid_amount, payment.amount)
+            self.assertEqual(
+                payment.saved_account_string,
+                payment_schedule.account_string,
+            )
+
 
 class CaseQuerySetTestCase(TestCase, BasicTestMixin):
     @classmethod
@@ -559,6 +759,43 @@ class CaseQuerySetTestCase(TestCase, BasicTestMixin):
 
         self.assertFalse(case in cases)
 
+    @freeze_time("2022-01-01")
+    def test_filter_changed_cases_for_dst_payload_one_query(self):
+        alternate_municipality = create_municipality("Hillerød")
+        changed_case = create_case(
+            self.case_worker, self.municipality, self.district
+        )
+        unchanged_case = create_case(
+            self.case_worker,
+            self.municipality,
+            self.district,
+            sbsys_id="13213",
+        )
+        with freeze_time("2022-02-01"):
+            # Created after from_date, so compared from its creation.
+            created_case = create_case(
+                self.case_worker,
+                self.municipality,
+                self.district,
+                sbsys_id="13214",
+            )
+        with freeze_time("2022-03-01"):
+            changed_case.acting_municipality = alternate_municipality
+            changed_case.save()
+            created_case.acting_municipality = alternate_municipality
+            created_case.save()
+            unchanged_case.note = "Ændret"
+            unchanged_case.save()
+
+        with self.assertNumQueries(1):
+            cases = list(
+                Case.objects.filter_changed_cases_for_dst_payload(
+                    from_date=date(2022, 1, 15)
+                )
+            )
+
+        self.assertCountEqual(cases, [changed_case, created_case])
+
 
 class ActivityQuerySetTestCase(TestCase, BasicTestMixin):
     @classmethod
@@ -634,6 +871,83 @@ class ActivityQuerySetTestCase(TestCase, BasicTestMixin):
 
         self.assertIn(ongoing_activity, Activity.objects.all().ongoing())
 
+    @freeze_time("2020-06-01")
+    def test_annotate_totals(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        granted_activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            start_date=date(year=2019, month=1, day=1),
+            end_date=date(year=2021, month=12, day=31),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        create_payment_schedule(
+            payment_frequency=PaymentSchedule.MONTHLY,
+            payment_amount=Decimal("500"),
+            activity=granted_activity,
+        )
+        expected_activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            start_date=date(year=2020, month=7, day=1),
+            end_date=date(year=2021, month=12, day=31),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_EXPECTED,
+            modifies=granted_activity,
+        )
+        create_payment_schedule(
+            payment_frequency=PaymentSchedule.MONTHLY,
+            payment_amount=Decimal("700"),
+            activity=expected_activity,
+        )
+        # A payment paid in another year than it was scheduled for.
+        Payment.objects.filter(
+            payment_schedule__activity=granted_activity,
+            date=date(year=2019, month=12, day=1),
+        ).update(
+            paid=True,
+            paid_amount=Decimal("450"),
+            paid_date=date(year=2020, month=1, day=3),
+        )
+        # Refresh the year totals changed behind the back of the signals.
+        ActivityYearTotal.objects.refresh([granted_activity.pk])
+        create_activity(
+            case=case,
+            appropriation=appropriation,
+            activity_type=SUPPL_ACTIVITY,
+        )
+
+        activities = Activity.objects.annotate_totals()
+
+        self.assertEqual(activities.count(), 3)
+        for activity in activities:
+            for name, year in [
+                ("previous_year", 2019),
+                ("this_year", 2020),
+                ("next_year", 2021),
+            ]:
+                self.assertEqual(
+                    getattr(activity, f"total_granted_{name}"),
+                    activity.total_granted_in_year(year),
+                )
+                self.assertEqual(
+                    getattr(activity, f"total_expected_{name}"),
+                    activity.total_expected_in_year(year),
+                )
+            self.assertEqual(
+                activity.annotated_total_cost, activity.total_cost
+            )
+
+        granted_activity = activities.get(pk=granted_activity.pk)
+        self.assertEqual(
+            granted_activity.total_expected_this_year, Decimal("3450")
+        )
+        self.assertEqual(
+            granted_activity.total_granted_this_year, Decimal("6450")
+        )
+
 
 class AppropriationQuerySetTestCase(TestCase, BasicTestMixin):
     @classmethod
@@ -698,6 +1012,58 @@ class AppropriationQuerySetTestCase(TestCase, BasicTestMixin):
 
         self.assertIn(appropriation, Appropriation.objects.expired())
 
+    def test_refresh_status(self):
+        today = timezone.now().date()
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            start_date=today,
+            end_date=today + timedelta(days=1),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_EXPECTED,
+        )
+        # Change the activity behind the back of the signals.
+        Activity.objects.filter(pk=activity.pk).update(status=STATUS_GRANTED)
+
+        self.assertIn(
+            appropriation,
+            Appropriation.objects.filter(status=STATUS_EXPECTED),
+        )
+        self.assertEqual(Appropriation.objects.refresh_status(), 1)
+        self.assertIn(
+            appropriation,
+            Appropriation.objects.filter(status=STATUS_GRANTED),
+        )
+        self.assertEqual(Appropriation.objects.refresh_status(), 0)
+
+    @freeze_time("2020-01-01")
+    def test_refresh_expired(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        create_activity(
+            case=case,
+            appropriation=appropriation,
+            start_date=date(2020, 1, 1),
+            end_date=date(2020, 1, 1),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        self.assertIn(appropriation, Appropriation.objects.ongoing())
+
+        with freeze_time("2020-01-02"):
+            self.assertEqual(Appropriation.objects.refresh_expired(), 1)
+            self.assertEqual(Case.objects.refresh_expired(), 1)
+        self.assertIn(appropriation, Appropriation.objects.expired())
+        self.assertIn(case, Case.objects.expired())
+
+        # Back in time, the appropriation and case are ongoing again.
+        self.assertEqual(Appropriation.objects.refresh_expired(), 1)
+        self.assertEqual(Case.objects.refresh_expired(), 1)
+        self.assertIn(appropriation, Appropriation.objects.ongoing())
+        self.assertIn(case, Case.objects.ongoing())
+
     def test_appropriations_for_dst_payload_initial(self):
         now = timezone.now().date()
         start_date = now
@@ -776,3 +1142,158 @@ class AppropriationQuerySetTestCase(TestCase, BasicTestMixin):
         )
 
         self.assertFalse(appropriation in dst_appropriations)
+
+
+class ActivityYearTotalQuerySetTestCase(TestCase, BasicTestMixin):
+    @classmethod
+    def setUpTestData(cls):
+        cls.basic_setup()
+
+    def assert_year_totals(self, activity, expected):
+        self.assertEqual(
+            list(
+                activity.year_totals.order_by("year").values_list(
+                    "year", "granted_sum", "expected_sum", "paid_sum"
+                )
+            ),
+            expected,
+        )
+
+    def test_refresh_on_payment_change(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            start_date=date(year=2020, month=12, day=30),
+            end_date=date(year=2021, month=1, day=2),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        payment_schedule = create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_amount=Decimal("100"),
+            activity=activity,
+        )
+        self.assert_year_totals(
+            activity,
+            [
+                (2020, Decimal("200"), Decimal("200"), Decimal("0")),
+                (2021, Decimal("200"), Decimal("200"), Decimal("0")),
+            ],
+        )
+
+        # A payment paid in the next year.
+        payment = payment_schedule.payments.get(
+            date=date(year=2020, month=12, day=31)
+        )
+        payment.paid = True
+        payment.paid_amount = Decimal("50")
+        payment.paid_date = date(year=2021, month=1, day=5)
+        payment.save()
+        self.assert_year_totals(
+            activity,
+            [
+                (2020, Decimal("100"), Decimal("100"), Decimal("0")),
+                (2021, Decimal("250"), Decimal("250"), Decimal("50")),
+            ],
+        )
+
+        payment_schedule.payments.filter(
+            date__lt=date(year=2020, month=12, day=31)
+        ).delete()
+        self.assert_year_totals(
+            activity, [(2021, Decimal("250"), Decimal("250"), Decimal("50"))]
+        )
+
+    def test_refresh_modified_activity(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        granted_activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            start_date=date(year=2020, month=1, day=1),
+            end_date=date(year=2020, month=1, day=10),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_amount=Decimal("100"),
+            activity=granted_activity,
+        )
+        expected_activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            start_date=date(year=2020, month=1, day=6),
+            end_date=date(year=2020, month=1, day=10),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_EXPECTED,
+            modifies=granted_activity,
+        )
+        create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_amount=Decimal("200"),
+            activity=expected_activity,
+        )
+
+        # The payments overruled by the expected activity are not expected.
+        self.assert_year_totals(
+            granted_activity,
+            [(2020, Decimal("1000"), Decimal("500"), Decimal("0"))],
+        )
+        self.assert_year_totals(
+            expected_activity,
+            [(2020, Decimal("0"), Decimal("1000"), Decimal("0"))],
+        )
+        for activity in [granted_activity, expected_activity]:
+            self.assertEqual(
+                activity.year_totals.get().expected_sum,
+                activity.total_expected_in_year(2020),
+            )
+        self.assertEqual(
+            appropriation.total_expected_in_year(2020), Decimal("1500")
+        )
+
+        expected_activity.delete()
+        self.assert_year_totals(
+            granted_activity,
+            [(2020, Decimal("1000"), Decimal("1000"), Decimal("0"))],
+        )
+
+    def test_rebuild(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            start_date=date(year=2020, month=12, day=30),
+            end_date=date(year=2021, month=1, day=2),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_amount=Decimal("100"),
+            activity=activity,
+        )
+        year_totals = list(
+            ActivityYearTotal.objects.order_by("year").values_list(
+                "activity", "year", "granted_sum", "expected_sum", "paid_sum"
+            )
+        )
+        ActivityYearTotal.objects.all().delete()
+
+        self.assertEqual(ActivityYearTotal.objects.rebuild(), 2)
+        self.assertEqual(
+            list(
+                ActivityYearTotal.objects.order_by("year").values_list(
+                    "activity",
+                    "year",
+                    "granted_sum",
+                    "expected_sum",
+                    "paid_sum",
+                )
+            ),
+            year_totals,
+        )
@@ -14,7 +14,8 @@ from freezegun import freeze_time
 
 from django import forms
 from django.contrib.auth import get_user_model
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.db.models import F
 from django.test import TestCase
 from django.utils import timezone
 from django.core import mail
@@ -47,6 +48,7 @@ from core.models import (
     Municipality,
     SchoolDistrict,
     Activity,
+    ActivityModification,
     ApprovalLevel,
     Team,
     PaymentSchedule,
@@ -64,6 +66,17 @@ from core.models import (
     STATUS_GRANTED,
     STATUS_EXPECTED,
     STATUS_DRAFT,
+    get_account_resolver,
+    resolve_accounts,
+    PaymentDateCalendar,
+    PaymentDateExclusion,
+    SectionInfo,
+    get_payment_date_calendar,
+    CacheRevision,
+    ACCOUNT_RESOLVER_REVISION,
+    RatePerDate,
+    VariableRate,
+    PAYMENT_DATE_CALENDAR_REVISION,
 )
 
 
@@ -166,6 +179,47 @@ class AppropriationTestCase(TestCase, BasicTestMixin):
 
         self.assertEqual(appropriation.status, STATUS_GRANTED)
 
+    def test_appropriation_status_not_refreshed_on_unrelated_change(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_EXPECTED,
+        )
+
+        with mock.patch(
+            "core.models.Appropriation.refresh_status"
+        ) as refresh_status_mock:
+            activity.approval_note = "Godkendt"
+            activity.save()
+            refresh_status_mock.assert_not_called()
+
+            activity.status = STATUS_GRANTED
+            activity.save()
+            refresh_status_mock.assert_called_once()
+
+    def test_appropriation_status_activity_moved(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        other_appropriation = create_appropriation(case=case, sbsys_id="13213")
+        create_activity(
+            case=case,
+            appropriation=appropriation,
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_EXPECTED,
+        )
+        activity = Activity.objects.get(appropriation=appropriation)
+
+        activity.appropriation = other_appropriation
+        activity.save()
+
+        appropriation.refresh_from_db()
+        other_appropriation.refresh_from_db()
+        self.assertEqual(appropriation.status, STATUS_DRAFT)
+        self.assertEqual(other_appropriation.status, STATUS_EXPECTED)
+
     def test_total_expected_this_year(self):
         # generate a start and end span of 3 days
         now = timezone.now().date()
@@ -1871,6 +1925,7 @@ class ActivityTestCase(TestCase, BasicTestMixin):
         )
         create_payment_schedule(activity=activity)
 
+        activity.end_date = date(year=2020, month=2, day=1)
         activity.save()
         self.assertEqual(len(mail.outbox), 2)
         email_message = mail.outbox[1]
@@ -1878,7 +1933,135 @@ class ActivityTestCase(TestCase, BasicTestMixin):
         self.assertIn("Barnets CPR nummer: 0205891234", email_message.body)
         self.assertIn("Beløb: 500,0", email_message.body)
         self.assertIn("Start dato: 1. december 2019", email_message.body)
-        self.assertIn("Slut dato: 1. januar 2020", email_message.body)
+        self.assertIn("Slut dato: 1. februar 2020", email_message.body)
+
+    def test_modification_chain(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(case, appropriation, status=STATUS_GRANTED)
+        first_modification = create_activity(
+            case, appropriation, status=STATUS_GRANTED, modifies=activity
+        )
+        second_modification = create_activity(
+            case,
+            appropriation,
+            status=STATUS_EXPECTED,
+            modifies=first_modification,
+        )
+
+        self.assertEqual(
+            set(
+                ActivityModification.objects.values_list(
+                    "activity", "modified_by", "depth"
+                )
+            ),
+            {
+                (activity.pk, first_modification.pk, 1),
+                (activity.pk, second_modification.pk, 2),
+                (first_modification.pk, second_modification.pk, 1),
+            },
+        )
+        self.assertCountEqual(
+            activity.get_all_modified_by_activities(),
+            [first_modification, second_modification],
+        )
+
+    def test_modification_chain_relinked(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(case, appropriation, status=STATUS_GRANTED)
+        other_activity = create_activity(
+            case, appropriation, status=STATUS_GRANTED
+        )
+        first_modification = create_activity(
+            case, appropriation, status=STATUS_GRANTED, modifies=activity
+        )
+        second_modification = create_activity(
+            case,
+            appropriation,
+            status=STATUS_EXPECTED,
+            modifies=first_modification,
+        )
+
+        first_modification.modifies = other_activity
+        first_modification.save()
+
+        self.assertEqual(
+            set(
+                ActivityModification.objects.values_list(
+                    "activity", "modified_by", "depth"
+                )
+            ),
+            {
+                (other_activity.pk, first_modification.pk, 1),
+                (other_activity.pk, second_modification.pk, 2),
+                (first_modification.pk, second_modification.pk, 1),
+            },
+        )
+
+        first_modification.delete()
+
+        self.assertFalse(ActivityModification.objects.exists())
+
+    def test_save_without_payment_changes_skips_payment_plan(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(case, appropriation)
+        create_payment_schedule(activity=activity)
+        activity = Activity.objects.get(pk=activity.pk)
+
+        with mock.patch("core.models.PaymentSchedule.save") as save_mock:
+            activity.note = "Ny note"
+            activity.save()
+            save_mock.assert_not_called()
+
+            activity.end_date = date(year=2019, month=1, day=20)
+            activity.save()
+            save_mock.assert_called_once()
+
+    def test_updated_note_no_payment_email(self):
+        start_date = date(year=2019, month=12, day=1)
+        end_date = date(year=2020, month=1, day=1)
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case,
+            appropriation,
+            start_date=start_date,
+            end_date=end_date,
+            status=STATUS_GRANTED,
+        )
+        create_payment_schedule(activity=activity)
+        activity = Activity.objects.get(pk=activity.pk)
+
+        activity.note = "Ny note"
+        activity.save()
+
+        # Only the created email is sent.
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_updated_fictive_payment_email(self):
+        start_date = date(year=2019, month=12, day=1)
+        end_date = date(year=2020, month=1, day=1)
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case,
+            appropriation,
+            start_date=start_date,
+            end_date=end_date,
+            status=STATUS_GRANTED,
+        )
+        create_payment_schedule(activity=activity)
+        activity = Activity.objects.get(pk=activity.pk)
+
+        activity.payment_plan.fictive = True
+        activity.payment_plan.save()
+
+        self.assertEqual(len(mail.outbox), 2)
+        email_message = mail.outbox[1]
+        self.assertIn("Aktivitet opdateret", email_message.subject)
+        self.assertIn("Fiktiv: ja", email_message.body)
 
     def test_updated_sd_activity_payment_email(self):
         start_date = date(year=2019, month=12, day=1)
@@ -2693,6 +2876,147 @@ class ActivityTestCase(TestCase, BasicTestMixin):
         # No main activity is found.
         self.assertIsNone(suppl_activity.account_alias)
 
+    def test_resolve_accounts(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        section = create_section()
+        appropriation = create_appropriation(case=case, section=section)
+        main_activity = create_activity(
+            case,
+            appropriation,
+            status=STATUS_GRANTED,
+            activity_type=MAIN_ACTIVITY,
+        )
+        activity_category = create_activity_category()
+        create_section_info(
+            details=main_activity.details,
+            section=section,
+            main_activity_main_account_number="12345",
+            supplementary_activity_main_account_number="5678",
+            activity_category=activity_category,
+        )
+        suppl_activity = create_activity(
+            case,
+            appropriation,
+            status=STATUS_GRANTED,
+            activity_type=SUPPL_ACTIVITY,
+        )
+        account_alias = create_account_alias_mapping(
+            "5678", activity_category.category_id
+        )
+        # Load the resolver up front.
+        get_account_resolver()
+
+        # Only the revision of the resolver and the main activities are
+        # queried.
+        with self.assertNumQueries(2):
+            accounts = resolve_accounts([main_activity, suppl_activity])
+
+        self.assertEqual(
+            accounts[main_activity.pk],
+            (activity_category, "12345-123456", None),
+        )
+        self.assertEqual(
+            accounts[suppl_activity.pk],
+            (activity_category, "5678-123456", account_alias.alias),
+        )
+
+    def test_account_resolver_invalidated_on_change(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        section = create_section()
+        appropriation = create_appropriation(case=case, section=section)
+        activity = create_activity(
+            case,
+            appropriation,
+            status=STATUS_GRANTED,
+            activity_type=MAIN_ACTIVITY,
+        )
+        self.assertIsNone(activity.account_number)
+        # Only the revision of the resolver is queried.
+        with self.assertNumQueries(1):
+            self.assertIsNone(activity.account_alias)
+
+        section_info = create_section_info(
+            details=activity.details,
+            section=section,
+            main_activity_main_account_number="12345",
+        )
+        self.assertIsNone(activity.account_number)
+
+        activity_category = create_activity_category()
+        section_info.activity_category = activity_category
+        section_info.save()
+        self.assertEqual(activity.account_number, "12345-123456")
+
+        account_alias = create_account_alias_mapping("12345", "123456")
+        self.assertEqual(activity.account_alias, account_alias.alias)
+
+        account_alias.delete()
+        self.assertIsNone(activity.account_alias)
+
+    def test_account_resolver_reloaded_on_other_process_change(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        section = create_section()
+        appropriation = create_appropriation(case=case, section=section)
+        activity = create_activity(
+            case,
+            appropriation,
+            status=STATUS_GRANTED,
+            activity_type=MAIN_ACTIVITY,
+        )
+        create_section_info(
+            details=activity.details,
+            section=section,
+            main_activity_main_account_number="12345",
+            activity_category=create_activity_category(),
+        )
+        self.assertEqual(activity.account_number, "12345-123456")
+
+        # Another process changes the account tables and bumps the
+        # revision, bypassing the signals of this process.
+        SectionInfo.objects.filter(
+            activity_details=activity.details, section=section
+        ).update(main_activity_main_account_number="54321")
+        self.assertEqual(activity.account_number, "12345-123456")
+        CacheRevision.objects.filter(name=ACCOUNT_RESOLVER_REVISION).update(
+            revision=F("revision") + 1
+        )
+
+        self.assertEqual(activity.account_number, "54321-123456")
+
+    def test_account_resolver_rolled_back(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        section = create_section()
+        appropriation = create_appropriation(case=case, section=section)
+        activity = create_activity(
+            case,
+            appropriation,
+            status=STATUS_GRANTED,
+            activity_type=MAIN_ACTIVITY,
+        )
+        self.assertIsNone(activity.account_number)
+
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                create_section_info(
+                    details=activity.details,
+                    section=section,
+                    main_activity_main_account_number="12345",
+                    activity_category=create_activity_category(),
+                )
+                self.assertEqual(activity.account_number, "12345-123456")
+                revision = CacheRevision.get_revision(
+                    ACCOUNT_RESOLVER_REVISION
+                )
+                raise IntegrityError
+
+        # Another process commits a different change under the same
+        # revision as the rolled back one.
+        CacheRevision.objects.filter(name=ACCOUNT_RESOLVER_REVISION).update(
+            revision=revision
+        )
+
+        self.assertIsNone(activity.account_number)
+
     def test_activity_category_main_activity(self):
         case = create_case(self.case_worker, self.municipality, self.district)
         section = create_section()
@@ -3480,6 +3804,254 @@ class PaymentScheduleTestCase(TestCase, BasicTestMixin):
 
         self.assertEqual(payment_schedule.payments.count(), 10)
 
+    def test_generate_payments_with_changing_rate(self):
+        rate = create_rate()
+        rate.set_rate_amount(
+            Decimal(100), end_date=date(year=2019, month=1, day=6)
+        )
+        rate.set_rate_amount(
+            Decimal(200), start_date=date(year=2019, month=1, day=6)
+        )
+        payment_schedule = create_payment_schedule(
+            payment_type=PaymentSchedule.RUNNING_PAYMENT,
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_amount=None,
+            payment_units=Decimal("2"),
+            payment_cost_type=PaymentSchedule.GLOBAL_RATE_PRICE,
+            payment_rate=rate,
+        )
+        start_date = date(year=2019, month=1, day=1)
+        end_date = date(year=2019, month=1, day=10)
+
+        payment_schedule.generate_payments(start_date, end_date)
+
+        amounts = list(
+            payment_schedule.payments.order_by("date").values_list(
+                "amount", flat=True
+            )
+        )
+        self.assertEqual(amounts, [Decimal("200")] * 5 + [Decimal("400")] * 5)
+
+    def test_calculate_per_payment_amounts_unsorted_dates(self):
+        rate = create_rate()
+        rate.set_rate_amount(
+            Decimal(100), end_date=date(year=2019, month=1, day=6)
+        )
+        rate.set_rate_amount(
+            Decimal(200), start_date=date(year=2019, month=1, day=6)
+        )
+        payment_schedule = create_payment_schedule(
+            payment_amount=None,
+            payment_units=Decimal("1"),
+            payment_cost_type=PaymentSchedule.GLOBAL_RATE_PRICE,
+            payment_rate=rate,
+        )
+        dates = [
+            date(year=2019, month=1, day=7),
+            date(year=2019, month=1, day=1),
+            date(year=2019, month=1, day=6),
+        ]
+
+        amounts = payment_schedule.calculate_per_payment_amounts(
+            Decimal("100"), dates
+        )
+
+        self.assertEqual(
+            amounts, [Decimal("200"), Decimal("100"), Decimal("200")]
+        )
+
+    def test_update_payments(self):
+        payment_schedule = create_payment_schedule(
+            payment_type=PaymentSchedule.RUNNING_PAYMENT,
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_amount=Decimal("100"),
+        )
+        payment_schedule.generate_payments(
+            date(year=2019, month=1, day=1), date(year=2019, month=1, day=5)
+        )
+        kept = payment_schedule.payments.get(date=date(2019, 1, 3))
+        payment_schedule.payment_amount = Decimal("200")
+        payment_schedule.recipient_name = "Jens Jensen"
+
+        payment_schedule.update_payments(
+            date(year=2019, month=1, day=3), date(year=2019, month=1, day=7)
+        )
+
+        payments = payment_schedule.payments.order_by("date")
+        self.assertEqual(
+            [payment.date for payment in payments],
+            [date(2019, 1, day) for day in range(3, 8)],
+        )
+        self.assertTrue(
+            all(payment.amount == Decimal("200") for payment in payments)
+        )
+        self.assertTrue(
+            all(
+                payment.recipient_name == "Jens Jensen" for payment in payments
+            )
+        )
+        self.assertEqual(payments.first().pk, kept.pk)
+
+    def test_update_payments_unchanged(self):
+        payment_schedule = create_payment_schedule(
+            payment_type=PaymentSchedule.RUNNING_PAYMENT,
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_amount=Decimal("100"),
+        )
+        start_date = date(year=2019, month=1, day=1)
+        end_date = date(year=2019, month=1, day=10)
+        payment_schedule.generate_payments(start_date, end_date)
+
+        # Only the existing payments are read.
+        with self.assertNumQueries(1):
+            payment_schedule.update_payments(start_date, end_date)
+
+        self.assertEqual(payment_schedule.payments.count(), 10)
+
+    def test_update_payments_on_draft_activity_save(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(case, appropriation, status=STATUS_DRAFT)
+        payment_schedule = create_payment_schedule(
+            payment_type=PaymentSchedule.RUNNING_PAYMENT,
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_amount=Decimal("100"),
+            activity=activity,
+        )
+        payment_ids = set(
+            payment_schedule.payments.values_list("pk", flat=True)
+        )
+
+        payment_schedule.payment_amount = Decimal("150")
+        payment_schedule.save()
+
+        self.assertEqual(
+            set(payment_schedule.payments.values_list("pk", flat=True)),
+            payment_ids,
+        )
+        self.assertEqual(
+            set(payment_schedule.payments.values_list("amount", flat=True)),
+            {Decimal("150")},
+        )
+
+    def test_get_dirty_fields(self):
+        payment_schedule = create_payment_schedule()
+        payment_schedule = PaymentSchedule.objects.get(pk=payment_schedule.pk)
+        self.assertEqual(payment_schedule.get_dirty_fields(), set())
+
+        payment_schedule.payment_amount = Decimal("600")
+        payment_schedule.fictive = True
+        self.assertEqual(
+            payment_schedule.get_dirty_fields(), {"payment_amount", "fictive"}
+        )
+
+        payment_schedule.save()
+        self.assertEqual(payment_schedule.get_dirty_fields(), set())
+
+    @mock.patch("core.models.PaymentSchedule.update_payments")
+    def test_save_without_payment_changes_skips_payments(
+        self, update_payments_mock
+    ):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(case, appropriation, status=STATUS_DRAFT)
+        payment_schedule = create_payment_schedule(activity=activity)
+        payment_schedule = PaymentSchedule.objects.get(pk=payment_schedule.pk)
+        update_payments_mock.reset_mock()
+
+        payment_schedule.fictive = True
+        payment_schedule.save()
+        update_payments_mock.assert_not_called()
+
+        payment_schedule.payment_amount = Decimal("600")
+        payment_schedule.save()
+        update_payments_mock.assert_called_once()
+
+    def test_recalculate_prices(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        service_provider = create_service_provider(vat_factor=Decimal("50"))
+        activity = create_activity(
+            case,
+            appropriation,
+            service_provider=service_provider,
+        )
+        rate = create_rate()
+        rate.set_rate_amount(Decimal(100))
+        payment_schedule = create_payment_schedule(
+            payment_type=PaymentSchedule.RUNNING_PAYMENT,
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_amount=None,
+            payment_units=Decimal("2"),
+            payment_cost_type=PaymentSchedule.GLOBAL_RATE_PRICE,
+            payment_rate=rate,
+            activity=activity,
+        )
+        paid_date = date(year=2019, month=1, day=8)
+        payment_schedule.payments.filter(date=paid_date).update(
+            paid=True, paid_amount=Decimal(100), paid_date=paid_date
+        )
+        rate.set_rate_amount(
+            Decimal(300), start_date=date(year=2019, month=1, day=6)
+        )
+
+        summary = payment_schedule.recalculate_prices()
+
+        self.assertEqual(summary, {"payments": 4, "payment_schedules": 1})
+        amounts = list(
+            payment_schedule.payments.order_by("date").values_list(
+                "amount", flat=True
+            )
+        )
+        self.assertEqual(
+            amounts,
+            [Decimal("100")] * 5
+            + [Decimal("300")] * 2
+            + [Decimal("100")]
+            + [Decimal("300")] * 2,
+        )
+
+    def test_recalculate_prices_individual_payment(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(case, appropriation)
+        rate = create_rate()
+        rate.set_rate_amount(Decimal(100))
+        payment_schedule = create_payment_schedule(
+            payment_type=PaymentSchedule.INDIVIDUAL_PAYMENT,
+            payment_frequency=None,
+            payment_amount=None,
+            payment_units=Decimal("2"),
+            payment_cost_type=PaymentSchedule.GLOBAL_RATE_PRICE,
+            payment_rate=rate,
+            activity=activity,
+        )
+        payment = create_payment(
+            payment_schedule,
+            date=date(year=2019, month=1, day=8),
+            amount=Decimal("150"),
+        )
+        rate.set_rate_amount(Decimal(300))
+
+        summary = payment_schedule.recalculate_prices()
+
+        # Individual payments keep the amounts entered by hand.
+        self.assertEqual(summary, {"payments": 0, "payment_schedules": 0})
+        payment.refresh_from_db()
+        self.assertEqual(payment.amount, Decimal("150"))
+
+    def test_recalculate_prices_unchanged(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(case, appropriation)
+        payment_schedule = create_payment_schedule(activity=activity)
+
+        summary = PaymentSchedule.objects.filter(
+            pk=payment_schedule.pk
+        ).recalculate_prices()
+
+        self.assertEqual(summary, {"payments": 0, "payment_schedules": 0})
+
     def test_generate_payments_with_monthly_date(self):
         payment_schedule = create_payment_schedule(
             payment_type=PaymentSchedule.RUNNING_PAYMENT,
@@ -4027,6 +4599,80 @@ class VariableRateTestCase(TestCase, BasicTestMixin):
 
         self.assertEqual(str(variable_rate), f"{today}, {tomorrow}: 100.00")
 
+    def test_get_rate_amounts(self):
+        variable_rate = create_variable_rate()
+        today = date.today()
+        tomorrow = today + timedelta(days=1)
+        next_week = today + timedelta(days=7)
+        create_rate_per_date(
+            variable_rate, rate=100, start_date=None, end_date=tomorrow
+        )
+        create_rate_per_date(
+            variable_rate, rate=200, start_date=next_week, end_date=None
+        )
+        variable_rate.refresh_from_db()
+
+        self.assertEqual(
+            variable_rate.get_rate_amounts(
+                [today, tomorrow, next_week, datetime.now()]
+            ),
+            [Decimal(100), 0, Decimal(200), Decimal(100)],
+        )
+
+    def test_timeline_memoized(self):
+        variable_rate = create_variable_rate()
+        create_rate_per_date(variable_rate, rate=100)
+        variable_rate.refresh_from_db()
+        variable_rate.get_rate_amount(date.today())
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                variable_rate.get_rate_amount(date.today()), Decimal(100)
+            )
+
+    def test_timeline_rolled_back(self):
+        variable_rate = create_variable_rate()
+        create_rate_per_date(variable_rate, rate=100)
+        variable_rate.refresh_from_db()
+        revision = variable_rate.revision
+
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                RatePerDate.objects.filter(main_rate=variable_rate).update(
+                    rate=200
+                )
+                VariableRate.invalidate_timeline(variable_rate.pk)
+                variable_rate.refresh_from_db()
+                self.assertEqual(
+                    variable_rate.get_rate_amount(date.today()), Decimal(200)
+                )
+                raise IntegrityError
+
+        # Another process commits a different change under the same
+        # revision as the rolled back one.
+        RatePerDate.objects.filter(main_rate=variable_rate).update(rate=300)
+        VariableRate.objects.filter(pk=variable_rate.pk).update(
+            revision=revision + 1
+        )
+        variable_rate.refresh_from_db()
+
+        self.assertEqual(
+            variable_rate.get_rate_amount(date.today()), Decimal(300)
+        )
+
+    def test_timeline_invalidated_on_rate_per_date_delete(self):
+        variable_rate = create_variable_rate()
+        rate_per_date = create_rate_per_date(variable_rate, rate=100)
+        variable_rate.refresh_from_db()
+        self.assertEqual(
+            variable_rate.get_rate_amount(date.today()), Decimal(100)
+        )
+
+        rate_per_date.delete()
+        variable_rate.refresh_from_db()
+
+        self.assertEqual(variable_rate.get_rate_amount(date.today()), 0)
+
 
 class RateTestCase(TestCase, BasicTestMixin):
     @classmethod
@@ -4078,6 +4724,17 @@ class RateTestCase(TestCase, BasicTestMixin):
         self.assertEqual(rate.get_rate_amount(yesterday), Decimal(10))
         self.assertEqual(rate.get_rate_amount(today), Decimal(20))
 
+    def test_set_rate_amount_invalidates_timeline(self):
+        rate = create_rate()
+        rate.set_rate_amount(Decimal(10))
+        self.assertEqual(rate.get_rate_amount(date.today()), Decimal(10))
+        revision = rate.revision
+
+        rate.set_rate_amount(Decimal(20))
+
+        self.assertGreater(rate.revision, revision)
+        self.assertEqual(rate.get_rate_amount(date.today()), Decimal(20))
+
     def test_needs_recalculation(self):
         rate = create_rate()
 
@@ -4110,6 +4767,126 @@ class PaymentDateExclusionTestCase(TestCase):
         self.assertEqual(str(payment_date_exclusion), str(date.today()))
 
 
+class PaymentDateCalendarTestCase(TestCase, BasicTestMixin):
+    @classmethod
+    def setUpTestData(cls):
+        cls.basic_setup()
+        # Start without the exclusions added by the migrations.
+        PaymentDateExclusion.objects.all().delete()
+
+    def test_next_business_days(self):
+        # Saturday and Sunday are excluded.
+        calendar = PaymentDateCalendar([date(2020, 6, 6), date(2020, 6, 7)])
+
+        self.assertEqual(
+            calendar.next_business_days(date(2020, 6, 5), 2),
+            [date(2020, 6, 5), date(2020, 6, 8)],
+        )
+        self.assertEqual(
+            calendar.next_business_days(date(2020, 6, 6), 1),
+            [date(2020, 6, 8)],
+        )
+
+    def test_prism_dates(self):
+        # Saturday and Sunday are excluded.
+        calendar = PaymentDateCalendar([date(2020, 6, 6), date(2020, 6, 7)])
+
+        self.assertEqual(
+            calendar.prism_dates(date(2020, 6, 4)), [date(2020, 6, 4)]
+        )
+        self.assertEqual(
+            calendar.prism_dates(date(2020, 6, 5)),
+            [
+                date(2020, 6, 5),
+                date(2020, 6, 6),
+                date(2020, 6, 7),
+                date(2020, 6, 8),
+            ],
+        )
+
+    def test_get_payment_date_calendar(self):
+        create_payment_date_exclusion(date=date(2020, 6, 6))
+
+        # The revision and the exclusions are queried.
+        with self.assertNumQueries(2):
+            calendar = get_payment_date_calendar()
+        self.assertTrue(calendar.is_excluded(date(2020, 6, 6)))
+        self.assertFalse(calendar.is_excluded(date(2020, 6, 5)))
+
+        # Only the revision is queried once the calendar is loaded.
+        with self.assertNumQueries(1):
+            self.assertIs(get_payment_date_calendar(), calendar)
+
+    def test_payment_date_calendar_reloaded_on_other_process_change(self):
+        create_payment_date_exclusion(date=date(2020, 6, 6))
+        self.assertFalse(
+            get_payment_date_calendar().is_excluded(date(2020, 6, 7))
+        )
+
+        # Another process adds an exclusion and bumps the revision,
+        # bypassing the signals of this process.
+        PaymentDateExclusion.objects.bulk_create(
+            [PaymentDateExclusion(date=date(2020, 6, 7))]
+        )
+        self.assertFalse(
+            get_payment_date_calendar().is_excluded(date(2020, 6, 7))
+        )
+        CacheRevision.objects.filter(
+            name=PAYMENT_DATE_CALENDAR_REVISION
+        ).update(revision=F("revision") + 1)
+
+        self.assertTrue(
+            get_payment_date_calendar().is_excluded(date(2020, 6, 7))
+        )
+
+    def test_payment_date_calendar_rolled_back(self):
+        create_payment_date_exclusion(date=date(2020, 6, 6))
+        get_payment_date_calendar()
+        revision = CacheRevision.get_revision(PAYMENT_DATE_CALENDAR_REVISION)
+
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                create_payment_date_exclusion(date=date(2020, 6, 7))
+                self.assertTrue(
+                    get_payment_date_calendar().is_excluded(date(2020, 6, 7))
+                )
+                raise IntegrityError
+
+        # Another process commits a different change under the same
+        # revision as the rolled back one.
+        PaymentDateExclusion.objects.bulk_create(
+            [PaymentDateExclusion(date=date(2020, 6, 8))]
+        )
+        CacheRevision.objects.filter(
+            name=PAYMENT_DATE_CALENDAR_REVISION
+        ).update(revision=revision + 1)
+
+        calendar = get_payment_date_calendar()
+        self.assertFalse(calendar.is_excluded(date(2020, 6, 7)))
+        self.assertTrue(calendar.is_excluded(date(2020, 6, 8)))
+
+    @freeze_time("2020-06-04")
+    def test_is_valid_activity_start_date(self):
+        create_payment_date_exclusion(date=date(2020, 6, 6))
+        create_payment_date_exclusion(date=date(2020, 6, 7))
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case,
+            appropriation,
+            start_date=date(2020, 6, 8),
+            end_date=date(2020, 6, 30),
+        )
+        create_payment_schedule(payment_method=CASH, activity=activity)
+
+        # Friday and Monday are the first two payment days.
+        with self.assertNumQueries(2):
+            self.assertTrue(activity.is_valid_activity_start_date())
+
+        activity.start_date = date(2020, 6, 7)
+        self.assertFalse(activity.is_valid_activity_start_date())
+
+
 class AccountAliasMappingTestCase(TestCase):
     def test_str(self):
         account_alias = create_account_alias_mapping(
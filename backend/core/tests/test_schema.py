@@ -4,6 +4,8 @@ from base64 import b64encode
 from decimal import Decimal
 from freezegun import freeze_time
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django.contrib.auth import get_user_model
@@ -297,6 +299,105 @@ class TestActivitySchema(AuthenticatedTestCase, BasicTestMixin):
         self.assertEqual(node["totalGrantedNextYear"], 0.0)
         self.assertEqual(node["totalExpectedNextYear"], 0.0)
 
+    def test_activities_computed_fields_batched(self):
+        reverse_url = reverse("graphql-api")
+        self.client.login(username=self.username, password=self.password)
+        case = create_case(self.case_worker, self.municipality, self.district)
+        year = timezone.now().year
+        json = {
+            "query": """
+                query {
+                    activities {
+                        edges {
+                            node {
+                                pk,
+                                totalGrantedThisYear,
+                                totalCostThisYear,
+                                totalCostFullYear,
+                                monthlyPaymentPlan {
+                                    dateMonth,
+                                    amount
+                                }
+                            }
+                        }
+                    }
+                    appropriations {
+                        edges {
+                            node {
+                                grantedFromDate,
+                                grantedToDate,
+                                case {
+                                    sbsysId
+                                }
+                            }
+                        }
+                    }
+                }
+            """
+        }
+
+        def create_granted_activity(sbsys_id):
+            appropriation = create_appropriation(case=case, sbsys_id=sbsys_id)
+            activity = create_activity(
+                case=case,
+                appropriation=appropriation,
+                activity_type=MAIN_ACTIVITY,
+                status=STATUS_GRANTED,
+                start_date=date(year=year, month=1, day=1),
+                end_date=date(year=year, month=2, day=15),
+            )
+            create_payment_schedule(
+                payment_frequency=PaymentSchedule.WEEKLY,
+                payment_type=PaymentSchedule.RUNNING_PAYMENT,
+                activity=activity,
+            )
+            return activity
+
+        activities = [create_granted_activity("1")]
+        with CaptureQueriesContext(connection) as one_activity_queries:
+            self.client.post(reverse_url, json)
+        activities += [create_granted_activity(str(i)) for i in range(2, 5)]
+        with CaptureQueriesContext(connection) as four_activities_queries:
+            response = self.client.post(reverse_url, json)
+
+        self.assertEqual(
+            len(four_activities_queries), len(one_activity_queries)
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()["data"]
+        nodes = {
+            edge["node"]["pk"]: edge["node"]
+            for edge in data["activities"]["edges"]
+        }
+        for activity in activities:
+            node = nodes[activity.pk]
+            self.assertEqual(
+                node["totalGrantedThisYear"],
+                float(activity.total_granted_in_year(year)),
+            )
+            self.assertEqual(
+                node["totalCostThisYear"],
+                float(activity.total_cost_in_year(year)),
+            )
+            self.assertEqual(
+                node["totalCostFullYear"],
+                float(activity.total_cost_full_year),
+            )
+            self.assertEqual(
+                node["monthlyPaymentPlan"],
+                [
+                    {
+                        "dateMonth": row["date_month"],
+                        "amount": str(row["amount"]),
+                    }
+                    for row in activity.monthly_payment_plan
+                ],
+            )
+        for edge in data["appropriations"]["edges"]:
+            self.assertEqual(edge["node"]["grantedFromDate"], f"{year}-01-01")
+            self.assertEqual(edge["node"]["grantedToDate"], f"{year}-02-15")
+            self.assertEqual(edge["node"]["case"]["sbsysId"], case.sbsys_id)
+
 
 class TestActivityDetailsSchema(AuthenticatedTestCase):
     def test_activity_details_get(self):
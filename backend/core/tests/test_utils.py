@@ -6,6 +6,8 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import csv
+import tempfile
 from datetime import timedelta, date
 from decimal import Decimal
 from unittest import mock
@@ -14,7 +16,9 @@ from lxml import etree
 from freezegun import freeze_time
 import requests
 
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from core.models import (
@@ -31,6 +35,8 @@ from core.models import (
     Payment,
     SectionInfo,
     Case,
+    AppropriationDispatch,
+    invalidate_account_resolver,
 )
 from core.utils import (
     get_cpr_data,
@@ -42,7 +48,12 @@ from core.utils import (
     generate_records_for_prism,
     due_payments_for_prism,
     export_prism_payments_for_date,
+    generate_prism_payments,
+    mark_prism_payments_paid,
     generate_payments_report_list_v0,
+    generate_payments_report_rows,
+    write_payments_reports,
+    expected_payments_report_row_versions,
     generate_cases_report_list_v0,
     generate_payment_date_exclusion_dates,
     validate_cvr,
@@ -466,6 +477,53 @@ class SendAppropriationTestCase(TestCase, BasicTestMixin):
             render_call_args["context"]["sbsys_template_id"], "900"
         )
 
+    @mock.patch("core.utils.HTML")
+    @mock.patch("core.utils.get_template")
+    def test_render_dispatch_granted_approval(
+        self, get_template_mock, html_mock
+    ):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        section = create_section()
+        appropriation = create_appropriation(
+            sbsys_id="XXX-YYY", case=case, section=section
+        )
+        granted_level = create_approval_level(name="egenkompetence")
+        later_level = create_approval_level(name="teamleder")
+
+        now = timezone.now().date()
+        activity = create_activity(
+            case,
+            appropriation,
+            start_date=now - timedelta(days=5),
+            end_date=now + timedelta(days=5),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        section.main_activities.add(activity.details)
+        dispatch = AppropriationDispatch.objects.create(
+            appropriation=appropriation,
+            approval_level=granted_level,
+            approval_note="Bevilget",
+            approval_user=self.case_worker,
+            granted=timezone.now() - timedelta(days=1),
+        )
+        dispatch.included_activities.add(activity)
+        # The activity is granted again before the dispatch is sent.
+        activity.approval_level = later_level
+        activity.approval_note = "Bevilget igen"
+        activity.appropriation_date = now
+        activity.save()
+
+        dispatch.render()
+
+        render_call_args = get_template_mock.return_value.render.call_args[1]
+        [rendered] = render_call_args["context"]["main_activities"]
+        self.assertEqual(rendered, activity)
+        self.assertEqual(rendered.approval_level, granted_level)
+        self.assertEqual(rendered.approval_note, "Bevilget")
+        self.assertEqual(rendered.approval_user, self.case_worker)
+        self.assertEqual(rendered.appropriation_date, now - timedelta(days=1))
+
 
 class SamlLoginTestcase(TestCase, BasicTestMixin):
     def test_saml_before_login(self):
@@ -651,6 +709,64 @@ class SendToPrismTestCase(TestCase, BasicTestMixin):
         # payments.
         export_prism_payments_for_date()
 
+    def test_mark_prism_payments_paid(self):
+        now = timezone.now().date()
+        case = create_case(self.case_worker, self.municipality, self.district)
+        section = create_section()
+        appropriation = create_appropriation(
+            sbsys_id="XXX-YYY", case=case, section=section
+        )
+        main_activity_details = create_activity_details()
+        create_section_info(
+            main_activity_details,
+            section,
+            main_activity_main_account_number="1234",
+        )
+        activity = create_activity(
+            case,
+            appropriation,
+            start_date=now,
+            end_date=now + timedelta(days=4),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+            details=main_activity_details,
+        )
+        payment_schedule = create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_type=PaymentSchedule.RUNNING_PAYMENT,
+            recipient_type=PaymentSchedule.PERSON,
+            payment_method=CASH,
+            payment_amount=Decimal(666),
+            activity=activity,
+        )
+        payments = payment_schedule.payments.all()
+        account_string = payments.first().account_string
+        prism_payments = list(generate_prism_payments(payments))
+        self.assertEqual(len(prism_payments), 5)
+        self.assertTrue(
+            all(p.account_string == account_string for p in prism_payments)
+        )
+
+        history_counts = {
+            payment.pk: payment.history.count() for payment in payments
+        }
+        # One update and one insert of history for all the payments, and
+        # seven queries refreshing the year totals of their activities: the
+        # modified activities, a savepoint, the lock, the totals, deleting
+        # and inserting them and releasing the savepoint.
+        with self.assertNumQueries(9):
+            mark_prism_payments_paid(prism_payments, now)
+
+        for payment in payment_schedule.payments.all():
+            self.assertTrue(payment.paid)
+            self.assertEqual(payment.paid_amount, payment.amount)
+            self.assertEqual(payment.paid_date, now)
+            self.assertEqual(payment.saved_account_string, account_string)
+            self.assertEqual(
+                payment.history.count(), history_counts[payment.pk] + 1
+            )
+            self.assertTrue(payment.history.latest().paid)
+
     @freeze_time("2020-05-13")
     def test_export_prism_payments_with_exclusions_wednesday(self):
         now = timezone.now().date()
@@ -1220,6 +1336,128 @@ class GeneratePaymentsReportTestCase(TestCase, BasicTestMixin):
             )
         )
 
+    def test_generate_payments_report_rows_bulk_queries(self):
+        now = timezone.now().date()
+        case = create_case(self.case_worker, self.municipality, self.district)
+        create_related_person(case, "mor test", "mor", "2222222222")
+        section = create_section()
+        appropriation = create_appropriation(
+            sbsys_id="XXX-YYY", case=case, section=section
+        )
+        main_activity = create_activity(
+            case,
+            appropriation,
+            start_date=now,
+            end_date=now + timedelta(days=5),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_type=PaymentSchedule.RUNNING_PAYMENT,
+            activity=main_activity,
+        )
+        payments = Payment.objects.expected_payments_for_report_list()
+        # The account settings are stored on first use.
+        PaymentSchedule.get_account_settings()
+        invalidate_account_resolver()
+        with CaptureQueriesContext(connection) as single_activity:
+            rows = list(generate_payments_report_rows(payments))
+        self.assertEqual(len(rows), 6)
+
+        # Adding more activities and payments doesn't add more queries.
+        for details_id in ["111111", "222222"]:
+            activity = create_activity(
+                case,
+                appropriation,
+                start_date=now,
+                end_date=now + timedelta(days=10),
+                activity_type=SUPPL_ACTIVITY,
+                status=STATUS_GRANTED,
+                details=create_activity_details(
+                    name=f"Aktivitet {details_id}",
+                    activity_id=details_id,
+                ),
+            )
+            create_payment_schedule(
+                payment_frequency=PaymentSchedule.DAILY,
+                payment_type=PaymentSchedule.RUNNING_PAYMENT,
+                activity=activity,
+            )
+        invalidate_account_resolver()
+        with CaptureQueriesContext(connection) as many_activities:
+            rows = list(generate_payments_report_rows(payments))
+        self.assertEqual(len(rows), 28)
+        self.assertEqual(
+            len(many_activities.captured_queries),
+            len(single_activity.captured_queries),
+        )
+        self.assertTrue(all(row["mother_cpr"] == "2222222222" for row in rows))
+        self.assertTrue(
+            all(
+                row["main_activity_id"] == main_activity.details.activity_id
+                for row in rows
+            )
+        )
+
+    def test_write_payments_reports(self):
+        now = timezone.now().date()
+        case = create_case(self.case_worker, self.municipality, self.district)
+        section = create_section()
+        appropriation = create_appropriation(
+            sbsys_id="XXX-YYY", case=case, section=section
+        )
+        activity = create_activity(
+            case,
+            appropriation,
+            start_date=now,
+            end_date=now + timedelta(days=5),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_type=PaymentSchedule.RUNNING_PAYMENT,
+            activity=activity,
+        )
+        payments = Payment.objects.expected_payments_for_report_list()
+
+        with tempfile.TemporaryDirectory() as report_dir:
+            filenames = write_payments_reports(
+                payments,
+                os.path.join(report_dir, "expected_payments_{version}.csv"),
+                expected_payments_report_row_versions,
+            )
+            self.assertEqual(
+                filenames,
+                [
+                    os.path.join(report_dir, f"expected_payments_{v}.csv")
+                    for v in ["0", "1", "2", "3"]
+                ],
+            )
+            reports = []
+            for filename in filenames:
+                with open(filename) as csvfile:
+                    reports.append(list(csv.DictReader(csvfile)))
+
+        self.assertTrue(all(len(report) == 6 for report in reports))
+        self.assertNotIn("activity_category__name", reports[0][0])
+        self.assertIn("activity_category__name", reports[1][0])
+        self.assertNotIn("note", reports[1][0])
+        self.assertIn("note", reports[2][0])
+        self.assertNotIn("approval_level", reports[2][0])
+        self.assertIn("approval_level", reports[3][0])
+
+    def test_write_payments_reports_no_payments(self):
+        with tempfile.TemporaryDirectory() as report_dir:
+            filenames = write_payments_reports(
+                Payment.objects.none(),
+                os.path.join(report_dir, "expected_payments_{version}.csv"),
+                expected_payments_report_row_versions,
+            )
+            self.assertEqual(filenames, [])
+            self.assertEqual(os.listdir(report_dir), [])
+
 
 class ValidateCVRTestCase(TestCase):
     def test_validate_cvr_success(self):
@@ -2855,3 +3093,85 @@ class DSTUtilities(TestCase, BasicTestMixin):
             .text,
             "Ny",
         )
+
+    def test_generate_dst_payload_preventative_query_count(self):
+        now = timezone.now().date()
+        section = create_section(dst_code="123")
+
+        def create_dst_appropriation(case_sbsys_id, sbsys_id, cpr_number):
+            case = create_case(
+                self.case_worker,
+                self.municipality,
+                self.district,
+                sbsys_id=case_sbsys_id,
+            )
+            create_related_person(
+                case, relation_type="mor", cpr_number=cpr_number
+            )
+            appropriation = create_appropriation(
+                sbsys_id=sbsys_id, case=case, section=section
+            )
+            activity = create_activity(
+                case,
+                appropriation,
+                start_date=now,
+                end_date=now + timedelta(days=5),
+                activity_type=MAIN_ACTIVITY,
+                status=STATUS_GRANTED,
+                appropriation_date=now,
+            )
+            create_payment_schedule(
+                payment_frequency=PaymentSchedule.DAILY,
+                payment_type=PaymentSchedule.RUNNING_PAYMENT,
+                activity=activity,
+            )
+            return appropriation
+
+        create_dst_appropriation(
+            "27.24.00-G01-1-21", "27.12.06-G01-1-19", "1111111111"
+        )
+        ns = {"x": "http://rep.oio.dk/dst.dk/xml/schemas/2010/04/16/"}
+        generate_dst_payload_preventive_measures(initial_load=True)
+        with CaptureQueriesContext(connection) as single_appropriation:
+            doc = generate_dst_payload_preventive_measures(initial_load=True)
+        self.assertEqual(
+            len(
+                doc.xpath(
+                    "x:ForanstaltningStrukturSamling/"
+                    "x:ForanstaltningStruktur",
+                    namespaces=ns,
+                )
+            ),
+            1,
+        )
+
+        # Adding more appropriations, including ones to consolidate,
+        # doesn't add more queries.
+        create_dst_appropriation(
+            "27.24.00-G01-2-21", "27.12.06-G01-2-19", "2222222222"
+        )
+        create_dst_appropriation(
+            "27.24.00-G01-3-21", "27.12.06-G01-3-19-gl", "3333333333"
+        )
+        create_dst_appropriation(
+            "27.24.00-G01-4-21", "27.12.06-G01-3-19-ny", "3333333333"
+        )
+        with CaptureQueriesContext(connection) as many_appropriations:
+            doc = generate_dst_payload_preventive_measures(initial_load=True)
+        self.assertEqual(
+            len(many_appropriations.captured_queries),
+            len(single_appropriation.captured_queries),
+        )
+        self.assertEqual(
+            [
+                structure.xpath("x:FormynderCPRidentifikator", namespaces=ns)[
+                    0
+                ].text
+                for structure in doc.xpath(
+                    "x:ForanstaltningStrukturSamling/"
+                    "x:ForanstaltningStruktur",
+                    namespaces=ns,
+                )
+            ],
+            ["1111111111", "2222222222", "3333333333"],
+        )
@@ -5,6 +5,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
 from unittest import mock
 from datetime import date, timedelta
 from decimal import Decimal
@@ -13,6 +14,7 @@ from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
+from django.core import mail
 from django.db.models import F
 from django.test import override_settings
 
@@ -26,13 +28,19 @@ from core.models import (
     EffortStep,
     ServiceProvider,
     DSTPayload,
+    DSTPayloadJob,
+    HANDICAP,
+    PREVENTATIVE_MEASURES,
+    JOB_QUEUED,
     MAIN_ACTIVITY,
     SUPPL_ACTIVITY,
     STATUS_GRANTED,
     STATUS_DRAFT,
     STATUS_EXPECTED,
     INTERNAL,
+    SD,
 )
+from core.pagination import PaymentKeysetPagination
 
 from core.tests.testing_utils import (
     AuthenticatedTestCase,
@@ -48,6 +56,7 @@ from core.tests.testing_utils import (
     create_service_provider,
     create_related_person,
 )
+from core.utils import compress_chunks
 
 User = get_user_model()
 
@@ -145,6 +154,17 @@ class TestCaseViewSet(AuthenticatedTestCase, BasicTestMixin):
     def setUpTestData(cls):
         cls.basic_setup()
 
+    def test_get_sparse_fields(self):
+        create_case(self.case_worker, self.municipality, self.district)
+        reverse_url = reverse("case-list")
+
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(reverse_url, data={"fields": "id,expired"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+        self.assertCountEqual(response.json()[0].keys(), ["id", "expired"])
+
     def test_history_action_no_history(self):
         case = create_case(self.case_worker, self.municipality, self.district)
         reverse_url = reverse("case-history", kwargs={"pk": case.pk})
@@ -673,8 +693,7 @@ class TestAppropriationViewSet(AuthenticatedTestCase, BasicTestMixin):
             "Kan ikke godkende følgeydelser, før hovedydelsen er godkendt.",
         )
 
-    @mock.patch("core.models.send_appropriation")
-    def test_grant_one_time_in_past_included(self, send_appropriation_mock):
+    def test_grant_one_time_in_past_included(self):
         case = create_case(self.case_worker, self.municipality, self.district)
         section = create_section()
         appropriation = create_appropriation(
@@ -718,10 +737,13 @@ class TestAppropriationViewSet(AuthenticatedTestCase, BasicTestMixin):
             url, json, content_type="application/json"
         )
         self.assertEqual(response.status_code, 200)
-        # Assert one_time_activity was sent in call to send_appropriation.
-        self.assertIn(
-            one_time_activity, send_appropriation_mock.call_args[0][1]
-        )
+        # Assert one_time_activity is included in the dispatch to SBSYS.
+        dispatch = appropriation.dispatches.get()
+        self.assertEqual(dispatch.status, JOB_QUEUED)
+        self.assertIn(one_time_activity, dispatch.included_activities.all())
+        # The approval is kept with the dispatch as it was when granted.
+        self.assertEqual(dispatch.approval_level, approval_level)
+        self.assertEqual(dispatch.approval_user.username, self.username)
 
     @freeze_time("2020-01-01")
     def test_grant_granted(self):
@@ -1075,7 +1097,12 @@ class TestAppropriationViewSet(AuthenticatedTestCase, BasicTestMixin):
             "attachment;"
             " filename=P_151_L201_P2022M01_V01_D20220101T000000.xml",
         )
-        self.assertEqual(DSTPayload.objects.count(), 1)
+        # The payload is saved once it has been streamed.
+        self.assertEqual(DSTPayload.objects.count(), 0)
+        content = b"".join(response.streaming_content)
+        payload = DSTPayload.objects.get()
+        self.assertEqual(b"".join(payload.iter_content()), content)
+        self.assertEqual(payload.size, len(content))
 
     @freeze_time("2022-01-01")
     def test_generate_dst_preventative_measures_file_specific_section(self):
@@ -1194,7 +1221,12 @@ class TestAppropriationViewSet(AuthenticatedTestCase, BasicTestMixin):
             "attachment;"
             " filename=P_151_L231_P2022M01_V01_D20220101T000000.xml",
         )
-        self.assertEqual(DSTPayload.objects.count(), 1)
+        # The payload is saved once it has been streamed.
+        self.assertEqual(DSTPayload.objects.count(), 0)
+        content = b"".join(response.streaming_content)
+        payload = DSTPayload.objects.get()
+        self.assertEqual(b"".join(payload.iter_content()), content)
+        self.assertEqual(payload.size, len(content))
 
     @freeze_time("2022-01-01")
     def test_generate_dst_handicap_file_specific_section(self):
@@ -1287,6 +1319,71 @@ class TestPaymentViewSet(AuthenticatedTestCase, BasicTestMixin):
             ),
         )
 
+    def test_get_keyset_pagination(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+            start_date=date(year=2020, month=1, day=1),
+            end_date=date(year=2020, month=1, day=10),
+        )
+        create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_type=PaymentSchedule.RUNNING_PAYMENT,
+            activity=activity,
+        )
+
+        url = reverse("payment-list")
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(url, data={"cursor": "", "page_size": 4})
+        ids_list = []
+        pages = 0
+        while True:
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("count", response.json())
+            ids_list += [
+                payment["id"] for payment in response.json()["results"]
+            ]
+            pages += 1
+            if not response.json()["next"]:
+                break
+            response = self.client.get(response.json()["next"])
+
+        self.assertEqual(pages, 3)
+        self.assertSequenceEqual(
+            ids_list,
+            Payment.objects.order_by("date", "id").values_list(
+                "id", flat=True
+            ),
+        )
+
+    def test_get_keyset_pagination_invalid_cursor(self):
+        url = reverse("payment-list")
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(url, data={"cursor": "invalid"})
+
+        self.assertEqual(response.status_code, 404)
+
+    @parameterized.expand(
+        [
+            (["x", "y"],),
+            (["2020-01-01", "x"],),
+            (["2020-13-01", 1],),
+            ([None, 1],),
+            ([[1], 1],),
+        ]
+    )
+    def test_get_keyset_pagination_invalid_cursor_values(self, position):
+        url = reverse("payment-list")
+        self.client.login(username=self.username, password=self.password)
+        cursor = PaymentKeysetPagination().encode_cursor(position)
+        response = self.client.get(url, data={"cursor": cursor})
+
+        self.assertEqual(response.status_code, 404)
+
     def test_get_payment_date_or_date__lte_filter(self):
         case = create_case(self.case_worker, self.municipality, self.district)
         appropriation = create_appropriation(case=case)
@@ -1801,6 +1898,38 @@ class TestActivityViewSet(AuthenticatedTestCase, BasicTestMixin):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()[0]["id"], activity.id)
 
+    @freeze_time("2020-01-01")
+    def test_get_annotated_totals(self):
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            start_date=date(year=2020, month=1, day=1),
+            end_date=date(year=2020, month=1, day=10),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_type=PaymentSchedule.RUNNING_PAYMENT,
+            payment_amount=Decimal("100"),
+            activity=activity,
+        )
+        url = reverse("activity-list")
+        self.client.login(username=self.username, password=self.password)
+
+        with mock.patch(
+            "core.models.Activity.total_granted_in_year"
+        ) as total_granted_mock:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        total_granted_mock.assert_not_called()
+        self.assertEqual(response.json()[0]["total_granted_this_year"], 1000)
+        self.assertEqual(response.json()[0]["total_expected_this_year"], 1000)
+        self.assertEqual(response.json()[0]["total_granted_next_year"], 0)
+
     def test_delete(self):
         now = timezone.now().date()
         case = create_case(self.case_worker, self.municipality, self.district)
@@ -2166,6 +2295,61 @@ class TestActivityViewSet(AuthenticatedTestCase, BasicTestMixin):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()["service_provider"], None)
 
+    def test_patch_payment_plan_payment_email(self):
+        now = timezone.now().date()
+        case = create_case(self.case_worker, self.municipality, self.district)
+        appropriation = create_appropriation(case=case)
+        activity = create_activity(
+            case=case,
+            appropriation=appropriation,
+            start_date=now - timedelta(days=6),
+            end_date=now + timedelta(days=6),
+            activity_type=MAIN_ACTIVITY,
+            status=STATUS_GRANTED,
+        )
+        payment_plan = create_payment_schedule(
+            payment_frequency=PaymentSchedule.DAILY,
+            payment_type=PaymentSchedule.RUNNING_PAYMENT,
+            recipient_type=PaymentSchedule.PERSON,
+            payment_method=SD,
+            activity=activity,
+        )
+        mail.outbox = []
+        url = reverse("activity-detail", kwargs={"pk": activity.pk})
+        self.client.login(username=self.username, password=self.password)
+
+        # Only the payment amount of the payment plan changes.
+        data = {
+            "id": activity.id,
+            "status": "GRANTED",
+            "appropriation": str(appropriation.pk),
+            "activity_type": "MAIN_ACTIVITY",
+            "details": str(activity.details.pk),
+            "start_date": str(activity.start_date),
+            "end_date": str(activity.end_date),
+            "payment_plan": {
+                "id": payment_plan.pk,
+                "payment_type": "RUNNING_PAYMENT",
+                "payment_frequency": "DAILY",
+                "payment_cost_type": "FIXED",
+                "payment_amount": "600",
+                "recipient_type": "PERSON",
+                "recipient_id": "0205891234",
+                "recipient_name": "Jens Testersen",
+                "payment_method": "SD",
+                "payment_day_of_month": 1,
+            },
+        }
+        response = self.client.patch(
+            url, data=data, content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 1)
+        email_message = mail.outbox[0]
+        self.assertIn("Aktivitet opdateret", email_message.subject)
+        self.assertIn("Beløb: 600,0", email_message.body)
+
 
 class TestServiceProviderViewSet(AuthenticatedTestCase, BasicTestMixin):
     @classmethod
@@ -2355,6 +2539,109 @@ class TestAuditModelViewSetMixin(AuthenticatedTestCase, BasicTestMixin):
         self.assertEqual(response.json()["user_modified"], self.username)
 
 
+class TestDSTPayloadJobViewSet(AuthenticatedTestCase, BasicTestMixin):
+    @classmethod
+    def setUpTestData(cls):
+        cls.basic_setup()
+
+    @freeze_time("2022-01-01")
+    def test_create_job(self):
+        section = create_section(dst_handicap=True)
+        create_section(
+            paragraph="SEL-52-3",
+            dst_preventative_measures=True,
+            dst_handicap=False,
+        )
+        self.client.login(username=self.username, password=self.password)
+        url = reverse("dstpayloadjob-list")
+
+        response = self.client.post(
+            url,
+            {"dst_type": HANDICAP, "test": False, "to_date": "2021-12-31"},
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, 201)
+        job = DSTPayloadJob.objects.get(pk=response.json()["id"])
+        self.assertEqual(job.status, JOB_QUEUED)
+        self.assertEqual(
+            job.name, "P_151_L231_P2022M01_V01_D20220101T000000.xml"
+        )
+        # The sections reported in the type of payload are the default.
+        self.assertEqual(list(job.sections.all()), [section])
+        self.assertNotIn("content", response.json())
+
+    def test_download(self):
+        job = DSTPayloadJob.objects.create(dst_type=HANDICAP)
+        self.client.login(username=self.username, password=self.password)
+        url = reverse("dstpayloadjob-download", kwargs={"pk": job.pk})
+
+        # The payload can't be downloaded before the job is done.
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 400)
+
+        job.sections.add(create_section(dst_handicap=True))
+        DSTPayloadJob.objects.claim_next().run()
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response["Content-Disposition"],
+            f"attachment; filename={job.name}",
+        )
+        content = b"".join(response.streaming_content)
+        self.assertIn(b"BoernMedHandicapLeveranceL231Struktur", content)
+
+    def test_download_payload(self):
+        job = DSTPayloadJob.objects.create(dst_type=HANDICAP, test=False)
+        job.sections.add(create_section(dst_handicap=True))
+        DSTPayloadJob.objects.claim_next().run()
+        self.client.login(username=self.username, password=self.password)
+        url = reverse("dstpayloadjob-download", kwargs={"pk": job.pk})
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        content = b"".join(response.streaming_content)
+        self.assertIn(b"BoernMedHandicapLeveranceL231Struktur", content)
+
+        # The content is gone with the payload.
+        DSTPayload.objects.all().delete()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+
+class TestDSTPayloadViewSet(AuthenticatedTestCase):
+    def test_list_metadata(self):
+        content = b"<?xml version='1.0' encoding='utf-8'?>\n<payload/>"
+        payload = DSTPayload.objects.create(
+            name="T_151_T201_P2022M01_V01_D20220101T000000.xml",
+            dst_type=PREVENTATIVE_MEASURES,
+            **compress_chunks([content]),
+        )
+        self.client.login(username=self.username, password=self.password)
+
+        response = self.client.get(reverse("dstpayload-list"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("content", response.json()[0])
+        self.assertEqual(response.json()[0]["size"], len(content))
+        self.assertEqual(
+            response.json()[0]["checksum"], hashlib.sha256(content).hexdigest()
+        )
+
+        response = self.client.get(
+            reverse("dstpayload-download", kwargs={"pk": payload.pk})
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response["Content-Disposition"],
+            f"attachment; filename={payload.name}",
+        )
+        self.assertEqual(b"".join(response.streaming_content), content)
+
+
 class TestFrontendSettingsView(AuthenticatedTestCase, BasicTestMixin):
     @classmethod
     def setUpTestData(cls):
@@ -43,6 +43,7 @@ from core.models import (
     DSTPayload,
     PREVENTATIVE_MEASURES,
 )
+from core.utils import compress_chunks
 
 
 User = get_user_model()
@@ -384,12 +385,15 @@ def create_approval_level(name="niveau"):
 
 def create_dst_payload(
     name="test.xml",
-    content="<xml></xml>",
+    content=b"<xml></xml>",
     from_date=date.today(),
     dst_type=PREVENTATIVE_MEASURES,
 ):
-    dst_payload, _ = DSTPayload.objects.get_or_create(
-        name=name, content=content, from_date=from_date, dst_type=dst_type
+    dst_payload = DSTPayload.objects.create(
+        name=name,
+        from_date=from_date,
+        dst_type=dst_type,
+        **compress_chunks([content]),
     )
 
     return dst_payload
@@ -7,13 +7,19 @@
 """Utilities used by other parts of this app."""
 
 
+import io
 import os
+import bisect
+import contextlib
 import logging
 import requests
 import datetime
+import hashlib
 import itertools
 import re
 import csv
+import zlib
+from collections import deque, namedtuple
 
 from lxml.builder import ElementMaker
 from lxml import etree
@@ -31,11 +37,14 @@ from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.utils.html import strip_tags
 from django.db import transaction
-from django.db.models import Q, BooleanField, Func
+from django.db.models import prefetch_related_objects
+from django.db.models import Q, BooleanField
 from django.db.models.expressions import Case, When
 
 from constance import config
 
+from simple_history.utils import bulk_update_with_history
+
 from weasyprint import HTML
 from weasyprint.fonts import FontConfiguration
 
@@ -61,6 +70,9 @@ virk_logger = logging.getLogger("bevillingsplatform.virk")
 dst_logger = logging.getLogger("bevillingsplatform.dst")
 logger = logging.getLogger(__name__)
 
+# Number of payments fetched per round trip when generating reports.
+PAYMENTS_REPORT_CHUNK_SIZE = 2000
+
 
 def get_person_info(cpr):
     """Get CPR data on a person and his/her relations."""
@@ -255,12 +267,17 @@ def send_activity_deleted_email(activity):
     send_activity_email(subject, template, activity)
 
 
-def send_appropriation(appropriation, included_activities=None):
-    """Generate PDF and XML files from appropriation and send them to SBSYS.
+def render_appropriation(
+    appropriation, included_activities=None, approval=None
+):
+    """Generate PDF and XML files from appropriation for SBSYS.
 
     :param appropriation: the Appropriation from which to generate PDF and XML.
     :param included_activities: Activities which should be explicitly included.
+    :param approval: approval fields to show the included activities with
+        instead of their current values, e.g. from when they were granted.
 
+    Return the files as email attachments.
     """
     if included_activities is None:
         included_activities_qs = models.Activity.objects.none()
@@ -270,7 +287,10 @@ def send_appropriation(appropriation, included_activities=None):
             id__in=(a.id for a in included_activities)
         )
 
-    today = datetime.date.today()
+    if approval and approval.get("appropriation_date"):
+        today = approval["appropriation_date"]
+    else:
+        today = datetime.date.today()
 
     # Fetch all currently granted main activities.
     approved_main_activities_ids = (
@@ -318,6 +338,14 @@ def send_appropriation(appropriation, included_activities=None):
         )
     )
 
+    if approval:
+        main_activities = list(main_activities)
+        suppl_activities = list(suppl_activities)
+        for activity in main_activities + suppl_activities:
+            if activity.is_new:
+                for field, value in approval.items():
+                    setattr(activity, field, value)
+
     render_context = {
         "appropriation": appropriation,
         "main_activities": main_activities,
@@ -348,20 +376,36 @@ def send_appropriation(appropriation, included_activities=None):
     pdf_data = HTML(string=html_data).write_pdf(font_config=font_config)
     pdf_file_name = f"{appropriation.sbsys_id}.pdf"
 
-    # Send as email
+    return [
+        (xml_file_name, xml_data, "text/xml"),
+        (pdf_file_name, pdf_data, "application/pdf"),
+    ]
+
+
+def send_appropriation_files(attachments):
+    """Send the rendered files of an appropriation to SBSYS as email."""
     msg = EmailMessage()
     msg.subject = "Bevillingsskrivelse"
     msg.body = ""
     msg.from_email = config.DEFAULT_FROM_EMAIL
     msg.to = [config.SBSYS_EMAIL]
-    msg.attachments = [
-        (xml_file_name, xml_data, "text/xml"),
-        (pdf_file_name, pdf_data, "application/pdf"),
-    ]
+    msg.attachments = attachments
 
     msg.send()
 
 
+def send_appropriation(appropriation, included_activities=None):
+    """Generate PDF and XML files from appropriation and send them to SBSYS.
+
+    :param appropriation: the Appropriation from which to generate PDF and XML.
+    :param included_activities: Activities which should be explicitly included.
+
+    """
+    send_appropriation_files(
+        render_appropriation(appropriation, included_activities)
+    )
+
+
 def saml_before_login(user_data):  # noqa: D401
     """Hook called after userdata is received from IdP, before login."""
     user_changed = False
@@ -422,13 +466,41 @@ def saml_create_user(user_data):  # noqa: D401
 # TODO: At some point, factor out customer specific third party integrations.
 
 
-def format_prism_financial_record(payment, line_no, record_no):
+# The columns of a payment needed for the PRISM records.
+PrismPayment = namedtuple(
+    "PrismPayment",
+    [
+        "pk",
+        "date",
+        "amount",
+        "recipient_id",
+        "payment_id",
+        "cpr_number",
+        "account_string",
+        "account_alias",
+        "activity_id",
+    ],
+)
+
+# Number of payments fetched and written per round trip in PRISM exports.
+PRISM_EXPORT_CHUNK_SIZE = 2000
+
+
+def format_prism_financial_record(
+    payment, line_no, record_no, org_unit=None, machine_no=None
+):
     """Format a single financial record for PRISM, on a single line.
 
     This follows documentation provided by Ballerup Kommune based on
     KMD's interface specification GQ311001Q for financial records (transaction
-    type G69).
+    type G69). The payment is a PrismPayment, the org unit and machine
+    number are looked up if not given.
     """
+    if org_unit is None:
+        org_unit = config.PRISM_ORG_UNIT
+    if machine_no is None:
+        machine_no = config.PRISM_MACHINE_NO
+
     # The fields that are hard coded *never* change.
     # We specify them as variables below, but in reality we might as
     # well hardcode them in the actual output.
@@ -443,7 +515,7 @@ def format_prism_financial_record(payment, line_no, record_no):
     # with leading zeroes, as per the specification.
     header = (
         f"{reg_location}{interface_type}{line_no:05d}"
-        + f"{config.PRISM_ORG_UNIT:04d}{org_type}{post_type}{line_format}"
+        + f"{org_unit:04d}{org_type}{post_type}{line_format}"
     )
 
     # Now the actual posting fields. These are marked with a leading '&' and
@@ -478,9 +550,8 @@ def format_prism_financial_record(payment, line_no, record_no):
     153 - posting text.
     """
 
-    case_cpr = payment.payment_schedule.activity.appropriation.case.cpr_number
     fields = {
-        "103": f"{config.PRISM_MACHINE_NO:05d}",
+        "103": f"{machine_no:05d}",
         "104": f"{record_no:07d}",
         "110": f"{payment.date.strftime('%Y%m%d')}",
         "111": f"{payment.account_alias}",
@@ -488,8 +559,8 @@ def format_prism_financial_record(payment, line_no, record_no):
         "113": "D",
         "114": f"{payment.date.year}",
         "132": "02",
-        "133": f"{case_cpr}",
-        "153": f"{payment.payment_schedule.payment_id}",
+        "133": f"{payment.cpr_number}",
+        "153": f"{payment.payment_id}",
     }
     fields["117"] = fields["110"] + fields["103"] + fields["104"]
 
@@ -500,13 +571,21 @@ def format_prism_financial_record(payment, line_no, record_no):
     return header + field_string
 
 
-def format_prism_payment_record(payment, line_no, record_no):
+def format_prism_payment_record(
+    payment, line_no, record_no, org_unit=None, machine_no=None
+):
     """Format a single payment record for PRISM, on a single line.
 
     This follows documentation provided by Ballerup Kommune based on
     KMD's interface specification GF200001Q for creditor records
-    (transaction type G68).
+    (transaction type G68). The payment is a PrismPayment, the org unit
+    and machine number are looked up if not given.
     """
+    if org_unit is None:
+        org_unit = config.PRISM_ORG_UNIT
+    if machine_no is None:
+        machine_no = config.PRISM_MACHINE_NO
+
     # First, we format the header.
     # The header has the following fields that never change and might as
     # well be hard coded:
@@ -518,7 +597,7 @@ def format_prism_payment_record(payment, line_no, record_no):
 
     header = (
         f"{reg_location}{interface_type}{line_no:05d}"
-        + f"{config.PRISM_ORG_UNIT:04d}{transaction_type}{line_format}"
+        + f"{org_unit:04d}{transaction_type}{line_format}"
     )
 
     # Now the mandatory fields. In the file, they are preceded with "&"
@@ -546,9 +625,9 @@ def format_prism_payment_record(payment, line_no, record_no):
     40 - posting text.
     """
 
-    payment_id = payment.payment_schedule.payment_id
+    payment_id = payment.payment_id
     fields = {
-        "02": f"{config.PRISM_ORG_UNIT:04d}",
+        "02": f"{org_unit:04d}",
         "03": "00",
         "08": f"{int(payment.amount*100):011d}",
         "09": "+",
@@ -558,9 +637,7 @@ def format_prism_payment_record(payment, line_no, record_no):
         "17": f"{payment.pk:020d}",
         "40": f"Fra Ballerup Kommune ref: {payment_id}",
     }
-    fields[
-        "16"
-    ] = f"{fields['12']}{config.PRISM_MACHINE_NO:05d}{record_no:07d}"
+    fields["16"] = f"{fields['12']}{machine_no:05d}{record_no:07d}"
 
     field_string = "".join(
         f"&{field_no}{fields[field_no]}" for field_no in sorted(fields)
@@ -571,8 +648,13 @@ def format_prism_payment_record(payment, line_no, record_no):
 
 def due_payments_for_prism(date):
     """Return payments which are due on date and should be sent to PRISM."""
+    return due_payments_for_prism_on_dates([date])
+
+
+def due_payments_for_prism_on_dates(dates):
+    """Return payments due on the dates which should be sent to PRISM."""
     return models.Payment.objects.filter(
-        date=date,
+        date__in=dates,
         recipient_type=models.PaymentSchedule.PERSON,
         payment_method=models.CASH,
         paid=False,
@@ -582,18 +664,95 @@ def due_payments_for_prism(date):
     )
 
 
-def generate_records_for_prism(due_payments):
-    """Generate the list of records for writing to PRISM file."""
-    prism_records = (
-        (
+def generate_prism_payments(due_payments):
+    """Generate the PrismPayments of the due payments.
+
+    The needed columns are fetched in one joined query and streamed in
+    chunks, resolving the account info of the activities in bulk for
+    each chunk.
+    """
+    rows = (
+        due_payments.order_by("date", "pk")
+        .values_list(
+            "pk",
+            "date",
+            "amount",
+            "recipient_id",
+            "payment_schedule__payment_id",
+            "payment_schedule__activity__appropriation__case__cpr_number",
+            "saved_account_string",
+            "saved_account_alias",
+            "payment_schedule__activity_id",
+        )
+        .iterator(chunk_size=PRISM_EXPORT_CHUNK_SIZE)
+    )
+    account_settings = models.PaymentSchedule.get_account_settings()
+
+    accounts = {}
+    for chunk in iter(
+        lambda: list(itertools.islice(rows, PRISM_EXPORT_CHUNK_SIZE)), []
+    ):
+        activity_ids = {row[-1] for row in chunk} - accounts.keys()
+        if activity_ids:
+            accounts.update(
+                models.resolve_accounts(
+                    models.Activity.objects.filter(
+                        pk__in=activity_ids
+                    ).select_related("appropriation")
+                )
+            )
+        for (
+            *columns,
+            saved_account_string,
+            saved_account_alias,
+            activity_id,
+        ) in chunk:
+            account_info = accounts[activity_id]
+            # Due payments are always cash payments to persons.
+            account_string = (
+                saved_account_string
+                or models.PaymentSchedule.format_account_string(
+                    models.PaymentSchedule.PERSON,
+                    models.CASH,
+                    account_info.account_number,
+                    account_settings,
+                )
+            )
+            account_alias = (
+                saved_account_alias or account_info.account_alias or ""
+            )
+            yield PrismPayment(
+                *columns, account_string, account_alias, activity_id
+            )
+
+
+def generate_prism_records(prism_payments):
+    """Generate the pairs of records to write to the PRISM file."""
+    org_unit = config.PRISM_ORG_UNIT
+    machine_no = config.PRISM_MACHINE_NO
+    for i, p in enumerate(prism_payments, 1):
+        yield (
             format_prism_financial_record(
                 p,
                 line_no=2 * i - 1,
                 record_no=i,
+                org_unit=org_unit,
+                machine_no=machine_no,
+            ),
+            format_prism_payment_record(
+                p,
+                line_no=2 * i,
+                record_no=i,
+                org_unit=org_unit,
+                machine_no=machine_no,
             ),
-            format_prism_payment_record(p, line_no=2 * i, record_no=i),
         )
-        for i, p in enumerate(due_payments, 1)
+
+
+def generate_records_for_prism(due_payments):
+    """Generate the list of records for writing to PRISM file."""
+    prism_records = generate_prism_records(
+        generate_prism_payments(due_payments)
     )
     # Flatten for easier handling.
     prism_records = list(itertools.chain(*prism_records))
@@ -601,53 +760,50 @@ def generate_records_for_prism(due_payments):
     return prism_records
 
 
+def mark_prism_payments_paid(prism_payments, paid_date):
+    """Mark exported payments paid, in bulk and with history.
+
+    The account string and alias are saved on the payments, just like
+    when saving a paid payment. The year totals of their activities are
+    refreshed afterwards, which takes a constant number of queries.
+    """
+    payments = [
+        models.Payment(
+            pk=p.pk,
+            paid=True,
+            paid_amount=p.amount,
+            paid_date=paid_date,
+            saved_account_string=p.account_string,
+            saved_account_alias=p.account_alias,
+        )
+        for p in prism_payments
+    ]
+    bulk_update_with_history(
+        payments,
+        models.Payment,
+        [
+            "paid",
+            "paid_amount",
+            "paid_date",
+            "saved_account_string",
+            "saved_account_alias",
+        ],
+        batch_size=PRISM_EXPORT_CHUNK_SIZE,
+    )
+    models.refresh_year_totals({p.activity_id for p in prism_payments})
+
+
 def due_payments_for_prism_with_exclusions(date):
     """Process payments with exclusions for PRISME.
 
     We check the day after tomorrow for one or several payment date exclusions
     and include payments for those found.
     """
-    # Retrieve payments for the date.
-    payment_ids = list(
-        due_payments_for_prism(date).values_list("id", flat=True)
-    )
-
-    # We include payments until we reach two consecutive days
-    # with no exclusions.
-    payment_date_exclusions_found = False
-    consecutive_days = 1
-    days_delta = 1
-    while consecutive_days < 2:
-        while models.PaymentDateExclusion.objects.filter(
-            date=date + relativedelta(days=days_delta)
-        ).exists():
-            payment_date_exclusions_found = True
-            payment_ids.extend(
-                list(
-                    due_payments_for_prism(
-                        date + relativedelta(days=days_delta)
-                    ).values_list("id", flat=True)
-                )
-            )
-            days_delta += 1
-            consecutive_days = 0
-
-        # Also include payments for the first day after
-        # one or more PaymentDateExclusion dates.
-        if payment_date_exclusions_found:
-            payment_ids.extend(
-                list(
-                    due_payments_for_prism(
-                        date + relativedelta(days=days_delta)
-                    ).values_list("id", flat=True)
-                )
-            )
-        consecutive_days += 1
-        days_delta += 1
-        payment_date_exclusions_found = False
-
-    payments = models.Payment.objects.filter(id__in=payment_ids)
-    return payments
+    # Date only, no datetime.
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    dates = models.get_payment_date_calendar().prism_dates(date)
+    return due_payments_for_prism_on_dates(dates)
 
 
 def create_rrule(
@@ -739,45 +895,110 @@ def validate_cvr(cvr):
     return bool(match)
 
 
-def generate_payments_report_list_v0(payments, new_account_alias=False):
-    """Generate a payments report list of payment dicts from payments."""
-    payments_report_list = []
-    for payment in payments:
-        activity = payment.payment_schedule.activity
-        if not activity:
-            logger.exception(
-                f"PaymentSchedule {payment.payment_schedule.pk}"
-                f" has no activity"
+def _fetch_payments_report_chunk_data(payments):
+    """Fetch the data needed for a chunk of payment report rows in bulk."""
+    activities = [payment.payment_schedule.activity for payment in payments]
+    appropriation_ids = {activity.appropriation_id for activity in activities}
+    cases = [activity.appropriation.case for activity in activities]
+    case_ids = {case.pk for case in cases}
+
+    # Main activities - the *first* main activity of each appropriation.
+    main_activities = {}
+    for main_activity in (
+        models.Activity.objects.filter(
+            appropriation__in=appropriation_ids,
+            activity_type=models.MAIN_ACTIVITY,
+            modifies__isnull=True,
+        )
+        .select_related("details")
+        .order_by("pk")
+    ):
+        main_activities.setdefault(
+            main_activity.appropriation_id, main_activity
+        )
+
+    # Parents of the cases.
+    parents = {}
+    for related_person in models.RelatedPerson.objects.filter(
+        main_case__in=case_ids, relation_type__in=["mor", "far"]
+    ).order_by("pk"):
+        parents.setdefault(
+            (related_person.main_case_id, related_person.relation_type),
+            related_person,
+        )
+
+    # Historical cases for the paid payments.
+    historical_cases = {}
+    paid_case_ids = {
+        payment.payment_schedule.activity.appropriation.case_id
+        for payment in payments
+        if payment.paid_date
+    }
+    if paid_case_ids:
+        for historical_case in (
+            models.Case.history.filter(id__in=paid_case_ids)
+            .select_related("effort_step")
+            .order_by("id", "history_date", "history_id")
+        ):
+            historical_cases.setdefault(historical_case.id, []).append(
+                historical_case
             )
-            continue
 
-        case = activity.appropriation.case
-        appropriation = activity.appropriation
+    prefetch_related_objects(cases, "efforts")
+
+    return {
+        "main_activities": main_activities,
+        "account_resolver": models.get_account_resolver(),
+        "parents": parents,
+        "historical_cases": historical_cases,
+        "account_settings": models.PaymentSchedule.get_account_settings(),
+    }
+
+
+def _historical_case_as_of(historical_cases, paid_datetime):
+    """Find the historical case as of the given time, like history.as_of.
+
+    If the case had not yet been created, the earliest version is used.
+    """
+    index = bisect.bisect_right(
+        [historical_case.history_date for historical_case in historical_cases],
+        paid_datetime,
+    )
+    if index and historical_cases[index - 1].history_type != "-":
+        return historical_cases[index - 1]
+    return historical_cases[0]
+
+
+def _generate_payments_report_chunk_rows(payments):
+    """Generate full payment report rows for a chunk of payments."""
+    chunk_data = _fetch_payments_report_chunk_data(payments)
+    accounts = {}
+
+    for payment in payments:
         payment_schedule = payment.payment_schedule
+        activity = payment_schedule.activity
+        appropriation = activity.appropriation
+        case = appropriation.case
 
+        main_activity = chunk_data["main_activities"].get(appropriation.pk)
         main_activity_id = (
-            appropriation.main_activity.details.activity_id
-            if appropriation.main_activity
-            else None
+            main_activity.details.activity_id if main_activity else None
         )
-
         main_activity_name = (
-            appropriation.main_activity.details.name
-            if appropriation.main_activity
-            else None
+            main_activity.details.name if main_activity else None
         )
         # Get the historical effort_step and scaling_step.
-        if payment.paid_date:
+        historical_cases = chunk_data["historical_cases"].get(case.pk)
+        if payment.paid_date and historical_cases:
             paid_datetime = timezone.make_aware(
                 datetime.datetime.combine(
                     payment.paid_date, datetime.time.max
                 ),
                 timezone=timezone.utc,
             )
-            try:
-                historical_case = case.history.as_of(paid_datetime)
-            except case.DoesNotExist:
-                historical_case = case.history.earliest()
+            historical_case = _historical_case_as_of(
+                historical_cases, paid_datetime
+            )
             effort_step = historical_case.effort_step
             scaling_step = historical_case.scaling_step
         else:
@@ -796,18 +1017,35 @@ def generate_payments_report_list_v0(payments, new_account_alias=False):
             )
         )
 
-        mother = case.related_persons.filter(relation_type="mor").first()
-        father = case.related_persons.filter(relation_type="far").first()
+        if activity.pk not in accounts:
+            accounts[activity.pk] = chunk_data[
+                "account_resolver"
+            ].resolve_with_main_activity(activity, main_activity)
+        category, account_number, account_alias = accounts[activity.pk]
+
+        account_string = (
+            payment.saved_account_string
+            or models.PaymentSchedule.format_account_string(
+                payment_schedule.recipient_type,
+                payment_schedule.payment_method,
+                account_number,
+                chunk_data["account_settings"],
+            )
+        )
+        account_alias = payment.saved_account_alias or account_alias or ""
+
+        mother = chunk_data["parents"].get((case.pk, "mor"))
+        father = chunk_data["parents"].get((case.pk, "far"))
 
-        payment_dict = {
+        yield {
             # payment specific.
             "id": payment.pk,
             "amount": payment.amount,
             "paid_amount": payment.paid_amount,
             "date": payment.date,
             "paid_date": payment.paid_date,
-            "account_string": payment.account_string,
-            "account_alias": payment.account_alias,
+            "account_string": account_string,
+            "account_alias": account_alias,
             # payment_schedule specific.
             "payment_schedule__payment_id": payment_schedule.payment_id,
             "payment_schedule__"
@@ -854,21 +1092,117 @@ def generate_payments_report_list_v0(payments, new_account_alias=False):
             "residence_municipality": str(case.residence_municipality),
             "mother_cpr": mother.cpr_number if mother else None,
             "father_cpr": father.cpr_number if father else None,
+            # v1 - activity category.
+            "activity_category__category_id": category.category_id
+            if category
+            else None,
+            "activity_category__name": category.name if category else None,
+            # v2 - note.
+            "note": payment.note,
+            # v3 - approval data.
+            "approval_level": activity.approval_level.name
+            if activity.approval_level
+            else None,
+            "approval_user": activity.approval_user.username
+            if activity.approval_user
+            else None,
+            "appropriation_date": activity.appropriation_date,
         }
 
-        # TODO: Also add the activity_category to the new file.
-        category = activity.activity_category
-        category_name = activity.activity_category.name if category else None
-        category_id = (
-            activity.activity_category.category_id if category else None
-        )
-        if new_account_alias:
-            payment_dict["activity_category__category_id"] = category_id
-            payment_dict["activity_category__name"] = category_name
 
-        payments_report_list.append(payment_dict)
+def generate_payments_report_rows(payments):
+    """Generate full payment report rows, streaming the payments.
+
+    The payments are fetched in chunks and the related data for each
+    chunk is fetched in a few bulk queries, so rows can be written
+    out as they are generated. Each row holds the fields of all
+    report versions.
+    """
+    payments = payments.select_related(
+        "payment_schedule__activity__appropriation__case__case_worker__team"
+        "__leader",
+        "payment_schedule__activity__appropriation__case__paying_municipality",
+        "payment_schedule__activity__appropriation__case__acting_municipality",
+        "payment_schedule__activity__appropriation__case"
+        "__residence_municipality",
+        "payment_schedule__activity__appropriation__case__target_group",
+        "payment_schedule__activity__appropriation__case__effort_step",
+        "payment_schedule__activity__appropriation__section",
+        "payment_schedule__activity__details",
+        "payment_schedule__activity__approval_level",
+        "payment_schedule__activity__approval_user",
+        "payment_schedule__price_per_unit",
+        "payment_schedule__payment_rate",
+    )
+    chunk = []
+    for payment in payments.iterator(chunk_size=PAYMENTS_REPORT_CHUNK_SIZE):
+        if not payment.payment_schedule.activity:
+            logger.exception(
+                f"PaymentSchedule {payment.payment_schedule.pk}"
+                f" has no activity"
+            )
+            continue
+        chunk.append(payment)
+        if len(chunk) == PAYMENTS_REPORT_CHUNK_SIZE:
+            yield from _generate_payments_report_chunk_rows(chunk)
+            chunk = []
+    if chunk:
+        yield from _generate_payments_report_chunk_rows(chunk)
+
+
+# Fields added to the payment report rows by the later report versions.
+PAYMENTS_REPORT_V1_FIELDS = (
+    "activity_category__category_id",
+    "activity_category__name",
+)
+PAYMENTS_REPORT_V2_FIELDS = ("note",)
+PAYMENTS_REPORT_V3_FIELDS = (
+    "approval_level",
+    "approval_user",
+    "appropriation_date",
+)
+
+
+def payments_report_row_v0(row):
+    """Restrict a full payment report row to the v0 fields."""
+    excluded_fields = (
+        PAYMENTS_REPORT_V1_FIELDS
+        + PAYMENTS_REPORT_V2_FIELDS
+        + PAYMENTS_REPORT_V3_FIELDS
+    )
+    return {
+        key: value for key, value in row.items() if key not in excluded_fields
+    }
+
+
+def payments_report_row_v1(row):
+    """Restrict a full payment report row to the v1 fields."""
+    excluded_fields = PAYMENTS_REPORT_V2_FIELDS + PAYMENTS_REPORT_V3_FIELDS
+    return {
+        key: value for key, value in row.items() if key not in excluded_fields
+    }
+
+
+def payments_report_row_v2(row):
+    """Restrict a full payment report row to the v2 fields."""
+    return {
+        key: value
+        for key, value in row.items()
+        if key not in PAYMENTS_REPORT_V3_FIELDS
+    }
 
-    return payments_report_list
+
+def payments_report_row_v3(row):
+    """Return a full payment report row as the v3 fields."""
+    return row
+
+
+def generate_payments_report_list_v0(payments, new_account_alias=False):
+    """Generate a payments report list of payment dicts from payments."""
+    row_func = (
+        payments_report_row_v1 if new_account_alias else payments_report_row_v0
+    )
+    return [row_func(row) for row in generate_payments_report_rows(payments)]
 
 
 def generate_payments_report_list_v1(payments):
@@ -878,45 +1212,54 @@ def generate_payments_report_list_v1(payments):
 
 def generate_payments_report_list_v2(payments):
     """Generate payments report list v2 (v1 with note added)."""
-    payments_report_list = generate_payments_report_list_v1(payments)
-    notes = {pk: note for (pk, note) in payments.values_list("id", "note")}
-
-    for entry in payments_report_list:
-        entry["note"] = notes[entry["id"]]
-    return payments_report_list
+    return [
+        payments_report_row_v2(row)
+        for row in generate_payments_report_rows(payments)
+    ]
 
 
 def generate_payments_report_list_v3(payments):
     """Generate payments report list v3 (v2 with approval data added)."""
-    payments_report_list = generate_payments_report_list_v2(payments)
+    return [
+        payments_report_row_v3(row)
+        for row in generate_payments_report_rows(payments)
+    ]
 
-    approval_values_list = payments.values_list(
-        "id",
-        "payment_schedule__activity__approval_level__name",
-        "payment_schedule__activity__approval_user__username",
-        "payment_schedule__activity__appropriation_date",
-    )
 
-    approval_data = {
-        pk: (approval_level, approval_user, appropriation_date)
-        for (
-            pk,
-            approval_level,
-            approval_user,
-            appropriation_date,
-        ) in approval_values_list
-    }
+def write_payments_reports(payments, filename_format, versions):
+    """Write all versions of a payments report in a single pass.
+
+    Rows are written as they are generated, one file per version.
+    Return the names of the files written - no files are written if
+    there are no payments.
+    """
+    rows = generate_payments_report_rows(payments)
+    first_row = next(rows, None)
+    if first_row is None:
+        return []
+
+    writers = {}
+    with contextlib.ExitStack() as stack:
+        for version, row_func in versions.items():
+            csvfile = stack.enter_context(
+                open(filename_format.format(version=version), "w")
+            )
+            writer = csv.DictWriter(
+                csvfile, fieldnames=row_func(first_row).keys()
+            )
+            writer.writeheader()
+            writers[csvfile.name] = (writer, row_func)
 
-    for entry in payments_report_list:
-        entry["approval_level"] = approval_data[entry["id"]][0]
-        entry["approval_user"] = approval_data[entry["id"]][1]
-        entry["appropriation_date"] = approval_data[entry["id"]][2]
-    return payments_report_list
+        for row in itertools.chain([first_row], rows):
+            for writer, row_func in writers.values():
+                writer.writerow(row_func(row))
+
+    return list(writers)
 
 
 @transaction.atomic
 def write_prism_file_v0(filename, date, payments, tomorrow):
-    """Write the actual PRISM file."""
+    """Write the actual PRISM file from a list of PrismPayments."""
     # The output directory is not configurable - this is mapped through Docker.
     output_dir = settings.PRISM_OUTPUT_DIR
 
@@ -942,14 +1285,27 @@ def write_prism_file_v0(filename, date, payments, tomorrow):
             f"{trans_code}{hdisp}{user_number}{media_type}{evolbr}"
             + f"{day_of_year}{mixed}"
         )
-        f.write(f"{preamble_string}\n")
-        # Generate and write the records.
-        prism_records = generate_records_for_prism(payments)
-        f.write("\n".join(prism_records))
+        f.write(f"{preamble_string}")
+        # Generate and write the records in chunks.
+        record_count = 0
+        prism_records = generate_prism_records(payments)
+        for chunk in iter(
+            lambda: list(
+                itertools.islice(prism_records, PRISM_EXPORT_CHUNK_SIZE)
+            ),
+            [],
+        ):
+            f.write(
+                "".join(
+                    f"\n{financial_record}\n{payment_record}"
+                    for financial_record, payment_record in chunk
+                )
+            )
+            record_count += 2 * len(chunk)
 
         # Generate and write the final line.
         cslutd = "SLUTD"  # Don't ask.
-        fantrec = f"{len(prism_records):05d}"
+        fantrec = f"{record_count:05d}"
         f.write(f"\n{cslutd}{fantrec}\n")
     return filepath
 
@@ -1000,8 +1356,10 @@ def export_prism_payments_for_date(date=None):
     if not date:
         date = tomorrow
 
-    payments = due_payments_for_prism_with_exclusions(date)
-    if not payments.exists():
+    payments = list(
+        generate_prism_payments(due_payments_for_prism_with_exclusions(date))
+    )
+    if not payments:
         # No payments
         return
 
@@ -1019,11 +1377,7 @@ def export_prism_payments_for_date(date=None):
         filepath = export_func(filename, date, payments, tomorrow)
         prism_files.extend([filepath])
 
-    for p in payments:
-        p.paid = True
-        p.paid_amount = p.amount
-        p.paid_date = tomorrow
-        p.save()
+    mark_prism_payments_paid(payments, tomorrow.date())
 
     return prism_files
 
@@ -1074,61 +1428,22 @@ def parse_account_alias_mapping_data_from_csv_path(path):
 
 def generate_payments_report():
     """Generate a payments report as CSV."""
+    report_dir = settings.PAYMENTS_REPORT_DIR
     payment_reports = []
 
     # generate expected payment reports.
-    payments = models.Payment.objects.expected_payments_for_report_list()
-    for (
-        version,
-        payments_func,
-    ) in generate_expected_payments_report_list_versions.items():
-        expected_payments_list = payments_func(payments)
-        report_dir = settings.PAYMENTS_REPORT_DIR
-
-        if not expected_payments_list:
-            continue
-
-        with open(
-            os.path.join(report_dir, f"expected_payments_{version}.csv"),
-            "w",
-        ) as csvfile:
-            writer = csv.DictWriter(
-                csvfile,
-                fieldnames=expected_payments_list[0].keys(),
-            )
-
-            writer.writeheader()
-            for payment_dict in expected_payments_list:
-                writer.writerow(payment_dict)
-
-            payment_reports.append(csvfile.name)
+    payment_reports += write_payments_reports(
+        models.Payment.objects.expected_payments_for_report_list(),
+        os.path.join(report_dir, "expected_payments_{version}.csv"),
+        expected_payments_report_row_versions,
+    )
 
     # generate granted payment reports.
-    payments = models.Payment.objects.granted_payments_for_report_list()
-    for (
-        version,
-        payments_func,
-    ) in generate_granted_payments_report_list_versions.items():
-        granted_payments_list = payments_func(payments)
-        report_dir = settings.PAYMENTS_REPORT_DIR
-
-        if not granted_payments_list:
-            continue
-
-        with open(
-            os.path.join(report_dir, f"granted_payments_{version}.csv"),
-            "w",
-        ) as csvfile:
-            writer = csv.DictWriter(
-                csvfile,
-                fieldnames=granted_payments_list[0].keys(),
-            )
-
-            writer.writeheader()
-            for payment_dict in granted_payments_list:
-                writer.writerow(payment_dict)
-
-            payment_reports.append(csvfile.name)
+    payment_reports += write_payments_reports(
+        models.Payment.objects.granted_payments_for_report_list(),
+        os.path.join(report_dir, "granted_payments_{version}.csv"),
+        granted_payments_report_row_versions,
+    )
 
     return payment_reports
 
@@ -1165,15 +1480,15 @@ def generate_cases_report():
 
 
 # Defined versions of output utilities.
-generate_expected_payments_report_list_versions = {
-    "0": generate_payments_report_list_v0,
-    "1": generate_payments_report_list_v1,
-    "2": generate_payments_report_list_v2,
-    "3": generate_payments_report_list_v3,
+expected_payments_report_row_versions = {
+    "0": payments_report_row_v0,
+    "1": payments_report_row_v1,
+    "2": payments_report_row_v2,
+    "3": payments_report_row_v3,
 }
 
-generate_granted_payments_report_list_versions = {
-    "3": generate_payments_report_list_v3,
+granted_payments_report_row_versions = {
+    "3": payments_report_row_v3,
 }
 
 generate_cases_report_list_versions = {"0": generate_cases_report_list_v0}
@@ -1184,6 +1499,12 @@ write_prism_file_versions = {"0": write_prism_file_v0}
 # DST xml namespaces
 dst_default_namespace = "http://rep.oio.dk/dst.dk/xml/schemas/2010/04/16/"
 dst_envelope_namespace = "http://rep.oio.dk/dst.dk/xml/schemas/2002/06/28/"
+dst_nsmap = {None: dst_default_namespace, "dst": dst_envelope_namespace}
+
+# Number of appropriations fetched at a time and bytes written at a time
+# when streaming a DST payload.
+DST_PAYLOAD_CHUNK_SIZE = 2000
+DST_PAYLOAD_BUFFER_SIZE = 64 * 1024
 
 
 def generate_dst_payload_metadata_element(form_id):
@@ -1198,7 +1519,7 @@ def generate_dst_payload_metadata_element(form_id):
 
     now = timezone.now()
 
-    E = ElementMaker(namespace=dst_default_namespace)
+    E = ElementMaker(namespace=dst_default_namespace, nsmap=dst_nsmap)
     envelope_E = ElementMaker(namespace=dst_envelope_namespace)
 
     doc = E.DeliveryMetadataNewStructure(
@@ -1260,7 +1581,7 @@ def generate_dst_payload_preventive_measures_element(
     end_date,
 ):
     """Generate a XML payload element for DST for "Preventitive Measures"."""
-    E = ElementMaker(namespace=dst_default_namespace)
+    E = ElementMaker(namespace=dst_default_namespace, nsmap=dst_nsmap)
 
     appropriation_structure = E.ForanstaltningStruktur(
         E.UdsatBarnCPRidentifikator(cpr_number),
@@ -1277,175 +1598,272 @@ def generate_dst_payload_preventive_measures_element(
 
 
 def extract_dst_date_tuple_for_appropriation(appropriation):
-    """Extract a (start_date, end_date) tuple for DST for an appropriation."""
-    main_activity = appropriation.main_activity
+    """Extract a (start_date, end_date) tuple for DST for an appropriation.
 
+    The appropriation must be annotated with annotate_dst_payload_details.
+    """
     if (
-        main_activity.payment_plan.payment_type
+        appropriation.main_activity_payment_type
         == models.PaymentSchedule.ONE_TIME_PAYMENT
-        and not main_activity.start_date
-        and not main_activity.end_date
+        and not appropriation.main_activity_start_date
+        and not appropriation.main_activity_end_date
     ):
-        start_date = main_activity.payment_plan.payment_date
-        end_date = main_activity.payment_plan.payment_date
+        start_date = appropriation.main_activity_payment_date
+        end_date = appropriation.main_activity_payment_date
     else:
-        start_date = appropriation.granted_from_date
-        end_date = appropriation.granted_to_date
+        start_date = appropriation.annotated_granted_from_date
+        end_date = appropriation.annotated_granted_to_date
 
     return (start_date, end_date)
 
 
-def generate_dst_payload_preventive_measures(
-    from_date=None, to_date=None, sections=None, test=True, initial_load=False
+def get_dst_payload_appropriations(
+    from_date=None, to_date=None, sections=None, initial_load=False
 ):
-    """
-    Generate a XML payload for DST for "Preventive Measures".
+    """Get the appropriations of a DST payload with the details needed.
 
-    "Forebyggende foranstaltninger". Specified in "Bilag 2" here:
-    https://www.retsinformation.dk/eli/lta/2021/1502
-    #id6e560773-349b-4779-872c-126f3fad2858
+    The appropriations are ordered by 'common sbsys_id', so appropriations
+    to consolidate follow each other.
     """
     appropriations = models.Appropriation.objects.select_related(
-        "case"
-    ).prefetch_related("case__related_persons", "activities__payment_plan")
+        "case__case_worker", "section"
+    )
 
     if sections is not None:
         appropriations = appropriations.filter(section__in=sections)
 
-    appropriations = appropriations.appropriations_for_dst_payload(
-        from_date, to_date
+    return (
+        appropriations.appropriations_for_dst_payload(
+            from_date, to_date, initial_load
+        )
+        .annotate_dst_payload_details()
+        .order_by("sbsys_common", "pk")
     )
 
-    E = ElementMaker(
-        namespace=dst_default_namespace,
-        nsmap={
-            None: dst_default_namespace,
-            "xsi": "http://www.w3.org/2001/XMLSchema-instance",
-            "dst": dst_envelope_namespace,
-        },
-    )
 
-    appropriations_root = E.ForanstaltningStrukturSamling()
+def consolidate_dst_payload_appropriations(appropriations):
+    """Group the appropriations of a DST payload into payload elements.
 
-    # 'common sbsys_id' duplicate appropriations are a special case and
-    # should be consolidated into a single element in the XML payload.
-    duplicate_appropriation_objects = (
-        appropriations.get_duplicate_sbsys_id_appropriations_for_dst()
-    )
-    for obj in duplicate_appropriation_objects:
-        duplicate_appropriations = appropriations.filter(id__in=obj["ids"])
-        sorted_appr_start_date_tuples = sorted(
-            [
-                (appr, extract_dst_date_tuple_for_appropriation(appr)[0])
-                for appr in duplicate_appropriations
-            ],
-            key=lambda appr_start_tuple: appr_start_tuple[1],
-        )
-        first_appropriation = sorted_appr_start_date_tuples[0][0]
-        case = duplicate_appropriations.first().case
-        father_or_mother = case.related_persons.filter(
-            Q(relation_type="mor") | Q(relation_type="far")
-        ).first()
-        if not father_or_mother:
-            dst_logger.info(
-                f"no far or mor related person found"
-                f" for appropriations with ids: {obj['ids']}"
-            )
+    'common sbsys_id' duplicate appropriations are a special case and
+    should be consolidated into a single element in the XML payload.
+
+    Yield (identifier, appropriations, start_date, end_date) tuples, where
+    the appropriations are sorted by start date and the dates span all of
+    them.
+    """
+    for sbsys_common, group in itertools.groupby(
+        appropriations.iterator(chunk_size=DST_PAYLOAD_CHUNK_SIZE),
+        key=lambda appropriation: appropriation.sbsys_common,
+    ):
+        group = list(group)
+        if sbsys_common is None or len(group) == 1:
+            for appropriation in group:
+                (
+                    start_date,
+                    end_date,
+                ) = extract_dst_date_tuple_for_appropriation(appropriation)
+                yield (
+                    appropriation.sbsys_id,
+                    [appropriation],
+                    start_date,
+                    end_date,
+                )
             continue
-        identifier = obj["sbsys_common"]
+
         date_tuples = [
-            extract_dst_date_tuple_for_appropriation(appr)
-            for appr in duplicate_appropriations
+            extract_dst_date_tuple_for_appropriation(appr) for appr in group
         ]
-        # extract from_dates from list of date tuples.
-        granted_from_dates = list(zip(*date_tuples))[0]
+        granted_from_dates, granted_to_dates = zip(*date_tuples)
         start_date = min(granted_from_dates)
-
-        # extract to_dates from list of date tuples.
-        granted_to_dates = list(zip(*date_tuples))[1]
         if None in granted_to_dates:
             end_date = None
         else:
             end_date = max(granted_to_dates)
-
-        granted_to_dates = [
-            appr.granted_to_date for appr in duplicate_appropriations
+        sorted_appropriations = [
+            appr
+            for appr, granted_from_date in sorted(
+                zip(group, granted_from_dates),
+                key=lambda appr_start_tuple: appr_start_tuple[1],
+            )
         ]
-        if None in granted_to_dates:
-            end_date = None
-        else:
-            end_date = max(granted_to_dates)
+        yield (sbsys_common, sorted_appropriations, start_date, end_date)
 
-        appropriation_structure = (
-            generate_dst_payload_preventive_measures_element(
-                case.cpr_number,
-                father_or_mother.cpr_number,
-                identifier,
-                first_appropriation.section.dst_code,
-                start_date,
-                end_date,
-            )
-        )
-        appropriations_root.append(appropriation_structure)
 
-    # Exclude the ids from the "normal" appropriations.
-    duplicate_appropriation_objects_ids = (
-        duplicate_appropriation_objects.annotate(
-            ids=Func("ids", function="unnest")
-        ).values_list("ids", flat=True)
+def stream_dst_payload(
+    root_tag, schema_file, form_id, collection_tag, elements
+):
+    """Write a XML payload for DST incrementally, yielding encoded chunks.
+
+    Only the current element is kept in memory, so a payload for all
+    appropriations can be streamed as it is generated.
+    """
+    output = io.BytesIO()
+    schema_location = etree.QName(
+        "http://www.w3.org/2001/XMLSchema-instance", "schemaLocation"
     )
-    appropriations = appropriations.exclude(
-        id__in=duplicate_appropriation_objects_ids
+
+    with etree.xmlfile(output, encoding="utf-8", buffered=False) as xf:
+        xf.write_declaration()
+        with xf.element(
+            etree.QName(dst_default_namespace, root_tag),
+            {schema_location: f"{dst_default_namespace}{schema_file}"},
+            nsmap={
+                **dst_nsmap,
+                "xsi": "http://www.w3.org/2001/XMLSchema-instance",
+            },
+        ):
+            xf.write(generate_dst_payload_metadata_element(form_id))
+            with xf.element(
+                etree.QName(dst_default_namespace, collection_tag)
+            ):
+                for element in elements:
+                    xf.write(element)
+                    if output.tell() >= DST_PAYLOAD_BUFFER_SIZE:
+                        yield output.getvalue()
+                        output.seek(0)
+                        output.truncate()
+    yield output.getvalue()
+
+
+def generate_dst_payload_filename(dst_type, test, now=None):
+    """Generate the filename of a DST payload generated at a given time."""
+    if now is None:
+        now = timezone.now()
+
+    prefix = "T" if test else "P"
+    test_payload_type, payload_type = {
+        models.PREVENTATIVE_MEASURES: ("T201", "L201"),
+        models.HANDICAP: ("T231", "L231"),
+    }[dst_type]
+    municipality_code = config.DST_MUNICIPALITY_CODE
+    period = now.strftime("%YM%m")
+    generation_timestamp = now.strftime("%Y%m%dT%H%M%S")
+    return (
+        f"{prefix}_{municipality_code}_"
+        f"{test_payload_type if test else payload_type}_"
+        f"P{period}_"
+        f"V01_D{generation_timestamp}.xml"
     )
-    for appropriation in appropriations:
-        case = appropriation.case
-        father_or_mother = case.related_persons.filter(
-            Q(relation_type="mor") | Q(relation_type="far")
-        ).first()
-        if not father_or_mother:
-            dst_logger.info(
-                f"no far or mor related person found"
-                f" for appropriation: {appropriation.id}"
-            )
-            continue
-        start_date, end_date = extract_dst_date_tuple_for_appropriation(
-            appropriation
-        )
 
-        identifier = appropriation.sbsys_id
-        appropriation_structure = (
-            generate_dst_payload_preventive_measures_element(
-                case.cpr_number,
-                father_or_mother.cpr_number,
+
+def compress_stream(chunks, compressed):
+    """Pass on the chunks of a payload, compressing them with gzip.
+
+    Once the chunks are exhausted, the compressed content and the size
+    and SHA-256 checksum of the uncompressed content are set in the
+    given dict.
+    """
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    checksum = hashlib.sha256()
+    size = 0
+    content = []
+    for chunk in chunks:
+        checksum.update(chunk)
+        size += len(chunk)
+        content.append(compressor.compress(chunk))
+        yield chunk
+    content.append(compressor.flush())
+    compressed.update(
+        content=b"".join(content), size=size, checksum=checksum.hexdigest()
+    )
+
+
+def compress_chunks(chunks):
+    """Compress the chunks of a payload with gzip.
+
+    Return a dict of the compressed content and the size and checksum of
+    the uncompressed content.
+    """
+    compressed = {}
+    deque(compress_stream(chunks, compressed), maxlen=0)
+    return compressed
+
+
+def decompress_chunks(data, chunk_size=DST_PAYLOAD_BUFFER_SIZE):
+    """Decompress a gzip compressed payload, yielding it in chunks."""
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    data = memoryview(data)
+    for start in range(0, len(data), chunk_size):
+        end = start + chunk_size
+        chunk = decompressor.decompress(data[start:end])
+        if chunk:
+            yield chunk
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+
+def save_streamed_dst_payload(chunks, **kwargs):
+    """Pass on the chunks of a DST payload, saving the payload at the end."""
+    compressed = {}
+    yield from compress_stream(chunks, compressed)
+    models.DSTPayload.objects.create(**compressed, **kwargs)
+
+
+def stream_dst_payload_preventive_measures(
+    from_date=None, to_date=None, sections=None, test=True, initial_load=False
+):
+    """
+    Stream a XML payload for DST for "Preventive Measures".
+
+    "Forebyggende foranstaltninger". Specified in "Bilag 2" here:
+    https://www.retsinformation.dk/eli/lta/2021/1502
+    #id6e560773-349b-4779-872c-126f3fad2858
+    """
+    # Preventive measures are not reported as new or changed, so they
+    # are always found as for a delta load.
+    appropriations = get_dst_payload_appropriations(
+        from_date, to_date, sections
+    )
+
+    def generate_elements():
+        for (
+            identifier,
+            appropriation_group,
+            start_date,
+            end_date,
+        ) in consolidate_dst_payload_appropriations(appropriations):
+            first_appropriation = appropriation_group[0]
+            if not first_appropriation.father_or_mother_cpr_number:
+                dst_logger.info(
+                    f"no far or mor related person found"
+                    f" for appropriations with ids: "
+                    f"{[appr.id for appr in appropriation_group]}"
+                )
+                continue
+            yield generate_dst_payload_preventive_measures_element(
+                first_appropriation.case.cpr_number,
+                first_appropriation.father_or_mother_cpr_number,
                 identifier,
-                appropriation.section.dst_code,
+                first_appropriation.section.dst_code,
                 start_date,
                 end_date,
             )
-        )
-
-        appropriations_root.append(appropriation_structure)
 
-    attr_qname = etree.QName(
-        "http://www.w3.org/2001/XMLSchema-instance", "schemaLocation"
-    )
-    doc = E.UdsatteBoernOgUngeLeveranceL201U1Struktur(
-        {
-            attr_qname: (
-                "http://rep.oio.dk/dst.dk/xml/schemas/2010/04/16/"
-                "DST_UdsatteBoernOgUngeLeveranceL201U1Struktur.xsd"
-            )
-        }
+    return stream_dst_payload(
+        "UdsatteBoernOgUngeLeveranceL201U1Struktur",
+        "DST_UdsatteBoernOgUngeLeveranceL201U1Struktur.xsd",
+        "T201" if test else "L201",
+        "ForanstaltningStrukturSamling",
+        generate_elements(),
     )
 
-    if test:
-        form_id = "T201"
-    else:
-        form_id = "L201"
-    doc.append(generate_dst_payload_metadata_element(form_id))
-    doc.append(appropriations_root)
 
-    return doc
+def generate_dst_payload_preventive_measures(
+    from_date=None, to_date=None, sections=None, test=True, initial_load=False
+):
+    """Generate a XML payload for DST for "Preventive Measures".
+
+    The whole payload is parsed into memory - use
+    stream_dst_payload_preventive_measures to write it.
+    """
+    return etree.fromstring(
+        b"".join(
+            stream_dst_payload_preventive_measures(
+                from_date, to_date, sections, test, initial_load
+            )
+        )
+    )
 
 
 def generate_dst_payload_handicap_element(
@@ -1458,7 +1876,7 @@ def generate_dst_payload_handicap_element(
     case_worker,
 ):
     """Generate a XML payload element for DST for "Handicap"."""
-    E = ElementMaker(namespace=dst_default_namespace)
+    E = ElementMaker(namespace=dst_default_namespace, nsmap=dst_nsmap)
 
     appropriation_structure = E.BoernMedHandicapSagStruktur(
         E.INDSATSFORLOEB_ID(identifier),
@@ -1474,133 +1892,67 @@ def generate_dst_payload_handicap_element(
     return appropriation_structure
 
 
-def generate_dst_payload_handicap(
+def stream_dst_payload_handicap(
     from_date=None, to_date=None, sections=None, test=True, initial_load=False
 ):
     """
-    Generate an XML payload for DST for "Handicap".
+    Stream an XML payload for DST for "Handicap".
 
     "Børn og unge med nedsat psykisk eller fysisk funktionsevne"
     Specified in "Bilag 8" here:
     https://www.retsinformation.dk/eli/lta/2021/1502
     #id8eb5787a-6efa-40ac-b911-0b0c817c2104
     """
-    appropriations = models.Appropriation.objects.select_related(
-        "case"
-    ).prefetch_related("case__related_persons", "activities__payment_plan")
-
-    if sections is not None:
-        appropriations = appropriations.filter(section__in=sections)
-
-    appropriations = appropriations.appropriations_for_dst_payload(
-        from_date, to_date, initial_load
-    )
-
-    E = ElementMaker(
-        namespace=dst_default_namespace,
-        nsmap={
-            None: dst_default_namespace,
-            "xsi": "http://www.w3.org/2001/XMLSchema-instance",
-            "dst": dst_envelope_namespace,
-        },
+    appropriations = get_dst_payload_appropriations(
+        from_date, to_date, sections, initial_load
     )
 
-    appropriations_root = E.BoernMedHandicapSagStrukturSamling()
-
-    # 'common sbsys_id' duplicate appropriations are a special case and
-    # should be consolidated into a single element in the XML payload.
-    duplicate_appropriation_objects = (
-        appropriations.get_duplicate_sbsys_id_appropriations_for_dst()
-    )
-    for obj in duplicate_appropriation_objects:
-        duplicate_appropriations = appropriations.filter(id__in=obj["ids"])
-        dst_report_type = (
-            "Ændring"
-            if "Ændring"
-            in [appr.dst_report_type for appr in duplicate_appropriations]
-            else "Ny"
-        )
-        sorted_appr_start_date_tuples = sorted(
-            [
-                (appr, extract_dst_date_tuple_for_appropriation(appr)[0])
-                for appr in duplicate_appropriations
-            ],
-            key=lambda appr_start_tuple: appr_start_tuple[1],
-        )
-        first_appropriation = sorted_appr_start_date_tuples[0][0]
-        case = first_appropriation.case
-        case_worker = case.case_worker
-        identifier = obj["sbsys_common"]
-        date_tuples = [
-            extract_dst_date_tuple_for_appropriation(appr)
-            for appr in duplicate_appropriations
-        ]
-        # extract from_dates from list of date tuples.
-        granted_from_dates = list(zip(*date_tuples))[0]
-        start_date = min(granted_from_dates)
-
-        # extract to_dates from list of date tuples.
-        granted_to_dates = list(zip(*date_tuples))[1]
-        if None in granted_to_dates:
-            end_date = None
-        else:
-            end_date = max(granted_to_dates)
-
-        appropriation_structure = generate_dst_payload_handicap_element(
+    def generate_elements():
+        for (
             identifier,
-            dst_report_type,
-            case.cpr_number,
-            first_appropriation.section.dst_code,
+            appropriation_group,
             start_date,
             end_date,
-            case_worker,
-        )
-        appropriations_root.append(appropriation_structure)
+        ) in consolidate_dst_payload_appropriations(appropriations):
+            first_appropriation = appropriation_group[0]
+            dst_report_type = (
+                "Ændring"
+                if "Ændring"
+                in [appr.dst_report_type for appr in appropriation_group]
+                else "Ny"
+            )
+            case = first_appropriation.case
+            yield generate_dst_payload_handicap_element(
+                identifier,
+                dst_report_type,
+                case.cpr_number,
+                first_appropriation.section.dst_code,
+                start_date,
+                end_date,
+                case.case_worker,
+            )
 
-    # Exclude the ids from the "normal" appropriations.
-    duplicate_appropriation_objects_ids = (
-        duplicate_appropriation_objects.annotate(
-            ids=Func("ids", function="unnest")
-        ).values_list("ids", flat=True)
-    )
-    appropriations = appropriations.exclude(
-        id__in=duplicate_appropriation_objects_ids
+    return stream_dst_payload(
+        "BoernMedHandicapLeveranceL231Struktur",
+        "DST_BoernMedHandicapLeveranceL231Struktur.xsd",
+        "T231" if test else "L231",
+        "BoernMedHandicapSagStrukturSamling",
+        generate_elements(),
     )
-    for appropriation in appropriations:
-        case = appropriation.case
-        start_date, end_date = extract_dst_date_tuple_for_appropriation(
-            appropriation
-        )
 
-        identifier = appropriation.sbsys_id
-        appropriation_structure = generate_dst_payload_handicap_element(
-            identifier,
-            appropriation.dst_report_type,
-            case.cpr_number,
-            appropriation.section.dst_code,
-            start_date,
-            end_date,
-            case.case_worker,
-        )
 
-        appropriations_root.append(appropriation_structure)
+def generate_dst_payload_handicap(
+    from_date=None, to_date=None, sections=None, test=True, initial_load=False
+):
+    """Generate an XML payload for DST for "Handicap".
 
-    attr_qname = etree.QName(
-        "http://www.w3.org/2001/XMLSchema-instance", "schemaLocation"
-    )
-    doc = E.BoernMedHandicapLeveranceL231Struktur(
-        {
-            attr_qname: (
-                "http://rep.oio.dk/dst.dk/xml/schemas/2010/04/16/"
-                "DST_BoernMedHandicapLeveranceL231Struktur.xsd"
+    The whole payload is parsed into memory - use
+    stream_dst_payload_handicap to write it.
+    """
+    return etree.fromstring(
+        b"".join(
+            stream_dst_payload_handicap(
+                from_date, to_date, sections, test, initial_load
             )
-        }
+        )
     )
-    if test:
-        form_id = "T231"
-    else:
-        form_id = "L231"
-    doc.append(generate_dst_payload_metadata_element(form_id))
-    doc.append(appropriations_root)
-
-    return doc
@@ -12,14 +12,12 @@ from django.contrib.auth import get_user_model
 from django.db import transaction
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
-from django.http import HttpResponse
-from django.utils import timezone
+from django.http import StreamingHttpResponse
 
-from rest_framework import viewsets
+from rest_framework import viewsets, mixins
 from rest_framework.views import APIView
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.pagination import PageNumberPagination
 from rest_framework import status
 from rest_framework.decorators import (
     authentication_classes,
@@ -28,12 +26,9 @@ from rest_framework.decorators import (
 )
 from rest_framework.request import Request
 
-from lxml import etree
 
 from graphene_django.views import GraphQLView
 
-from constance import config
-
 from core.models import (
     Case,
     Appropriation,
@@ -58,7 +53,9 @@ from core.models import (
     Effort,
     ActivityCategory,
     DSTPayload,
+    DSTPayloadJob,
     STATUS_GRANTED,
+    JOB_DONE,
     PREVENTATIVE_MEASURES,
     HANDICAP,
 )
@@ -92,6 +89,8 @@ from core.serializers import (
     EffortSerializer,
     ActivityCategorySerializer,
     DSTPayloadSerializer,
+    DSTPayloadJobSerializer,
+    get_requested_fields,
 )
 from core.filters import (
     CaseFilter,
@@ -103,8 +102,10 @@ from core.filters import (
 from core.utils import (
     get_person_info,
     get_company_info_from_search_term,
-    generate_dst_payload_preventive_measures,
-    generate_dst_payload_handicap,
+    stream_dst_payload_preventive_measures,
+    stream_dst_payload_handicap,
+    save_streamed_dst_payload,
+    generate_dst_payload_filename,
 )
 
 from core.mixins import (
@@ -115,6 +116,8 @@ from core.mixins import (
 
 from core.authentication import CsrfExemptSessionAuthentication
 
+from core.pagination import KeysetPagination, PaymentKeysetPagination
+
 from core.permissions import (
     IsUserAllowedREST,
     IsUserAllowedGraphQL,
@@ -185,6 +188,7 @@ class CaseViewSet(AuditModelViewSetMixin, AuditViewSet):
     queryset = Case.objects.all()
     serializer_class = CaseSerializer
     filterset_class = CaseFilter
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         """Avoid Django's default lazy loading to improve performance."""
@@ -276,6 +280,7 @@ class AppropriationViewSet(AuditModelViewSetMixin, AuditViewSet):
         "retrieve": AppropriationSerializer,
     }
     filterset_class = AppropriationFilter
+    pagination_class = KeysetPagination
 
     def get_serializer_class(self):
         """Use a different Serializer depending on the action."""
@@ -333,36 +338,23 @@ class AppropriationViewSet(AuditModelViewSetMixin, AuditViewSet):
         else:
             sections = Section.objects.filter(dst_preventative_measures=True)
 
-        doc = etree.tostring(
-            generate_dst_payload_preventive_measures(
-                from_date, to_date, sections, test, initial_load
-            ),
-            xml_declaration=True,
-            encoding="utf-8",
-        )
-        prefix = "T" if test else "P"
-        payload_type = "T201" if test else "L201"
-        municipality_code = config.DST_MUNICIPALITY_CODE
-        now = timezone.now()
-        period = now.strftime("%YM%m")
-        generation_timestamp = now.strftime("%Y%m%dT%H%M%S")
-        filename = (
-            f"{prefix}_{municipality_code}_"
-            f"{payload_type}_"
-            f"P{period}_"
-            f"V01_D{generation_timestamp}.xml"
+        filename = generate_dst_payload_filename(PREVENTATIVE_MEASURES, test)
+        # The payload is written while it is sent, which keeps a payload
+        # for all appropriations from timing out.
+        content = stream_dst_payload_preventive_measures(
+            from_date, to_date, sections, test, initial_load
         )
         # If payload is not a test we save it for later use.
         if not test:
-            DSTPayload.objects.create(
+            content = save_streamed_dst_payload(
+                content,
                 name=filename,
-                content=doc.decode("utf-8"),
                 from_date=from_date,
                 to_date=to_date,
                 dst_type=PREVENTATIVE_MEASURES,
             )
 
-        response = HttpResponse(doc, content_type="text/xml")
+        response = StreamingHttpResponse(content, content_type="text/xml")
         response["Content-Disposition"] = f"attachment; filename={filename}"
 
         return response
@@ -382,36 +374,23 @@ class AppropriationViewSet(AuditModelViewSetMixin, AuditViewSet):
         else:
             sections = Section.objects.filter(dst_handicap=True)
 
-        doc = etree.tostring(
-            generate_dst_payload_handicap(
-                from_date, to_date, sections, test, initial_load
-            ),
-            xml_declaration=True,
-            encoding="utf-8",
-        )
-        prefix = "T" if test else "P"
-        payload_type = "T231" if test else "L231"
-        municipality_code = config.DST_MUNICIPALITY_CODE
-        now = timezone.now()
-        period = now.strftime("%YM%m")
-        generation_timestamp = now.strftime("%Y%m%dT%H%M%S")
-        filename = (
-            f"{prefix}_{municipality_code}_"
-            f"{payload_type}_"
-            f"P{period}_"
-            f"V01_D{generation_timestamp}.xml"
+        filename = generate_dst_payload_filename(HANDICAP, test)
+        # The payload is written while it is sent, which keeps a payload
+        # for all appropriations from timing out.
+        content = stream_dst_payload_handicap(
+            from_date, to_date, sections, test, initial_load
         )
         # If payload is not a test we save it for later use.
         if not test:
-            DSTPayload.objects.create(
+            content = save_streamed_dst_payload(
+                content,
                 name=filename,
-                content=doc.decode("utf-8"),
                 from_date=from_date,
                 to_date=to_date,
                 dst_type=HANDICAP,
             )
 
-        response = HttpResponse(doc, content_type="text/xml")
+        response = StreamingHttpResponse(content, content_type="text/xml")
         response["Content-Disposition"] = f"attachment; filename={filename}"
 
         return response
@@ -425,6 +404,15 @@ class ActivityViewSet(AuditModelViewSetMixin, AuditViewSet):
         "retrieve": ActivitySerializer,
     }
     filterset_fields = "__all__"
+    pagination_class = KeysetPagination
+    total_fields = {
+        "total_granted_this_year",
+        "total_expected_this_year",
+        "total_granted_previous_year",
+        "total_expected_previous_year",
+        "total_granted_next_year",
+        "total_expected_next_year",
+    }
 
     def get_serializer_class(self):
         """Use a different Serializer depending on the action."""
@@ -437,6 +425,14 @@ class ActivityViewSet(AuditModelViewSetMixin, AuditViewSet):
         """Avoid Django's default lazy loading to improve performance."""
         queryset = Activity.objects.all()
         queryset = self.get_serializer_class().setup_eager_loading(queryset)
+        requested_fields = get_requested_fields(self.request)
+        if self.action in self.serializer_action_classes and (
+            requested_fields is None
+            or not requested_fields.isdisjoint(self.total_fields)
+        ):
+            # Read only actions can use the annotated totals, unless
+            # none of them are requested.
+            queryset = queryset.annotate_totals()
         return queryset
 
     def destroy(self, request, *args, **kwargs):
@@ -489,12 +485,13 @@ class PaymentScheduleViewSet(AuditViewSet):
 class PaymentViewSet(AuditViewSet):
     """Expose payments in REST API.
 
-    Note, this viewset supports pagination.
+    Note, this viewset supports pagination - by page number or, given a
+    cursor, by date and id.
     """
 
     serializer_class = PaymentSerializer
     queryset = Payment.objects.all()
-    pagination_class = PageNumberPagination
+    pagination_class = PaymentKeysetPagination
     permission_classes = (
         EditPaymentPermission,
         DeletePaymentPermission,
@@ -711,11 +708,70 @@ class ActivityCategoryViewSet(ClassificationViewSetMixin, ReadOnlyViewset):
 
 
 class DSTPayloadViewSet(ReadOnlyViewset):
-    """Expose DST payloads in REST API."""
+    """Expose DST payloads in REST API.
+
+    Only the metadata of the payloads is listed, download the content
+    separately.
+    """
 
-    queryset = DSTPayload.objects.all()
+    queryset = DSTPayload.objects.defer("content")
     serializer_class = DSTPayloadSerializer
 
+    @action(detail=True, methods=["get"])
+    def download(self, request, pk=None):
+        """Stream the content of a payload."""
+        payload = self.get_object()
+
+        response = StreamingHttpResponse(
+            payload.iter_content(), content_type="text/xml"
+        )
+        response[
+            "Content-Disposition"
+        ] = f"attachment; filename={payload.name}"
+
+        return response
+
+
+class DSTPayloadJobViewSet(
+    AuditMixin,
+    mixins.CreateModelMixin,
+    mixins.ListModelMixin,
+    mixins.RetrieveModelMixin,
+    viewsets.GenericViewSet,
+):
+    """Queue DST payloads for generation in the background.
+
+    Poll a created job until its status is DONE, then download the
+    payload.
+    """
+
+    authentication_classes = (CsrfExemptSessionAuthentication,)
+    permission_classes = (IsUserAllowedREST,)
+    queryset = DSTPayloadJob.objects.defer("content")
+    serializer_class = DSTPayloadJobSerializer
+
+    @action(detail=True, methods=["get"])
+    def download(self, request, pk=None):
+        """Stream the payload of a finished job."""
+        job = self.get_object()
+        if job.status != JOB_DONE:
+            return Response(
+                {"errors": [_("Udtrækket er ikke færdigt")]},
+                status.HTTP_400_BAD_REQUEST,
+            )
+        if not job.test and job.payload_id is None:
+            return Response(
+                {"errors": [_("Udtrækket er slettet")]},
+                status.HTTP_404_NOT_FOUND,
+            )
+
+        response = StreamingHttpResponse(
+            job.iter_content(), content_type="text/xml"
+        )
+        response["Content-Disposition"] = f"attachment; filename={job.name}"
+
+        return response
+
 
 class FrontendSettingsView(APIView):
     """Expose a relevant selection of settings to the frontend."""